@@ -6,6 +6,10 @@ from .node import ConnectionRefused, FCPException, FCPGetFailed, \
 
 from .node import fcpVersion
 
+from .asyncnode import AsyncFCPNode, AsyncJob
+
+from .cluster import FCPCluster
+
 from .node import SILENT, FATAL, CRITICAL, ERROR, INFO, DETAIL, DEBUG, NOISY
 
 #from put import main as put
@@ -23,10 +27,11 @@ isDoze = sys.platform.lower().startswith("win")
 
 if not isDoze:
     from . import freenetfs
+    from . import gateway
 
 
 __all__ = ['node', 'sitemgr', 'xmlrpc',
-           'FCPNode', 'JobTicket',
+           'FCPNode', 'JobTicket', 'AsyncFCPNode', 'AsyncJob', 'FCPCluster',
            'ConnectionRefused', 'FCPException', 'FCPPutFailed',
            'FCPProtocolError',
            'get', 'put', 'genkey', 'invertkey', 'redirect', 'names',
@@ -35,5 +40,6 @@ __all__ = ['node', 'sitemgr', 'xmlrpc',
 
 if not isDoze:
     __all__.append('freenetfs')
+    __all__.append('gateway')
 
 
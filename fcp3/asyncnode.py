@@ -0,0 +1,898 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+"""
+An asyncio implementation of the freenet client protocol.
+
+AsyncFCPNode offers the main primitives of FCPNode as coroutines on
+top of asyncio streams, so thousands of requests can be in flight on
+one connection without a thread per request:
+
+    async with AsyncFCPNode(name="myclient") as node:
+        pub, priv = await node.genkey()
+        uri = await node.put("CHK@", data=b"hello")
+        mimetype, data, msg = await node.get(uri)
+
+The request methods return an AsyncJob right away. Awaiting it gives
+the same result the synchronous FCPNode call would return, and
+iterating over job.progress() with 'async for' yields the progress
+messages the node sends meanwhile.
+
+Messages are encoded and decoded with the same codec as FCPNode.
+"""
+
+import asyncio
+import base64
+import os
+import stat
+import sys
+
+from . import node as _node
+from .codec import FCPMessageDecoder, encodeMessage
+from .node import (FCPException, FCPGetFailed, FCPPutFailed, FCPProtocolError,
+                   FCPNodeFailure, FCPNodeTimeout,
+                   ERROR, DETAIL, DEBUG,
+                   ONE_YEAR, expectedVersion, dataChunkSize,
+                   getDataLength, guessMimetype, toBool, sha256dda, readdir)
+
+
+#: message headers which are passed to progress() iterators by default
+progressHeaders = (
+    'SimpleProgress', 'SubscribedUSKUpdate', 'URIGenerated',
+    'StartedCompression', 'FinishedCompression', 'SendingToNetwork',
+    'EnterFiniteCooldown', 'PutFetchable', 'ExpectedMIME',
+    'ExpectedDataLength', 'CompatibilityMode', 'ExpectedHashes',
+    'DataFound', 'SubscribedUSK', 'SubscribedUSKRoundFinished',
+    'SubscribedUSKSendingToNetwork',
+    )
+
+_keyTypes = ('SSK@', 'KSK@', 'CHK@', 'USK@', 'SVK@')
+
+# marks the end of a progress() iteration
+_jobDone = object()
+
+
+class AsyncJob:
+    """
+    A request running on an AsyncFCPNode
+
+    Await the job for its result, or iterate over progress() for the
+    messages the node sends until the job completes.
+
+    Attributes of interest:
+        - id - the job Identifier
+        - cmd - the FCP message header word
+        - kw - the fields of the FCP message
+        - msgs - messages collected for list replies such as ListPeers
+    """
+
+    def __init__(self, node, id, cmd, kw, **opts):
+        """
+        You should never instantiate an AsyncJob object yourself
+        """
+        self.node = node
+        self.id = id
+        self.cmd = cmd
+        self.kw = kw
+        self.msgs = []
+        self.mimetype = None
+        self.followRedirect = opts.get('followRedirect', True)
+        self.stream = opts.get('stream', None)
+        self.timeout = opts.get('timeout', ONE_YEAR)
+        self.convert = opts.get('convert', None)
+        self.future = node._loop.create_future()
+        self._listeners = []
+
+    def __await__(self):
+        return self.wait().__await__()
+
+    async def wait(self, timeout=None):
+        """
+        Waits for the job to complete and returns its result
+
+        Raises the exception the job failed with, or FCPNodeTimeout if
+        the timeout (by default the job's own) expires first.
+        """
+        if timeout is None:
+            timeout = self.timeout
+        try:
+            return await asyncio.wait_for(asyncio.shield(self.future),
+                                          timeout)
+        except asyncio.TimeoutError:
+            raise FCPNodeTimeout(
+                header="Command '%s' took too long for node response" % self.cmd)
+
+    def isComplete(self):
+        """
+        Returns True if the job has been completed
+        """
+        return self.future.done()
+
+    async def progress(self, headers=progressHeaders):
+        """
+        Async iterator over the progress messages of this job
+
+        Keywords:
+            - headers - only yield messages with these headers
+
+        The iteration ends when the job completes.
+        """
+        queue = asyncio.Queue()
+        self._listeners.append(queue)
+        try:
+            while not self.future.done() or not queue.empty():
+                msg = await queue.get()
+                if msg is _jobDone:
+                    return
+                if msg['header'] in headers:
+                    yield msg
+        finally:
+            self._listeners.remove(queue)
+
+    def _pending(self, msg):
+        for queue in self._listeners:
+            queue.put_nowait(msg)
+
+    def _putResult(self, result):
+        if not self.future.done():
+            if isinstance(result, Exception):
+                self.future.set_exception(result)
+            else:
+                self.future.set_result(result)
+        for queue in self._listeners:
+            queue.put_nowait(_jobDone)
+        self.node.jobs.pop(self.id, None)
+
+    def __repr__(self):
+        if "URI" in self.kw:
+            uri = " URI=%s" % self.kw['URI']
+        else:
+            uri = ""
+        return "<async FCP job %s:%s%s>" % (self.id, self.cmd, uri)
+
+
+class AsyncFCPNode:
+    """
+    Represents an asyncio connection to a freenet node via its FCP port
+
+    Use it as an async context manager, or call connect() and close()
+    yourself. The request methods take the same keywords as their
+    FCPNode counterparts, except 'async', 'callback' and
+    'waituntilsent', and return AsyncJob objects.
+    """
+
+    nodeIsAlive = False
+    connectionidentifier = None
+    compressionCodecs = [("GZIP", 0), ("BZIP2", 1), ("LZMA", 2)] # safe defaults
+
+    def __init__(self, **kw):
+        """
+        Create an unconnected node object
+
+        Keywords:
+            - name - name of client to use with reqs, defaults to random
+            - host - hostname, defaults to FCP_HOST or defaultFCPHost
+            - port - port number, defaults to FCP_PORT or defaultFCPPort
+            - logfile - a writable file object for log messages, defaults
+              to stdout
+            - verbosity - how detailed the log messages should be
+        """
+        env = os.environ
+        self.name = kw.get('name', self._getUniqueId())
+        self.host = kw.get('host', env.get("FCP_HOST", _node.defaultFCPHost))
+        self.port = int(kw.get('port', env.get("FCP_PORT", _node.defaultFCPPort)))
+        self.logfile = kw.get('logfile', sys.stdout)
+        self.verbosity = kw.get('verbosity', _node.defaultVerbosity)
+
+        self.jobs = {} # keyed by request ID
+        self.testedDDA = {}
+        self._watchingGlobal = False
+        self.nodeHello = None
+
+        self._loop = None
+        self._reader = None
+        self._writer = None
+        self._readTask = None
+        self._decoder = FCPMessageDecoder(streamFor=self._streamFor)
+        self._ddaLock = None
+        self._sendLock = None
+
+    async def __aenter__(self):
+        await self.connect()
+        return self
+
+    async def __aexit__(self, type, value, traceback):
+        await self.close()
+
+    async def connect(self):
+        """
+        Opens the connection and does the ClientHello handshake
+        """
+        self._loop = asyncio.get_running_loop()
+        self._ddaLock = asyncio.Lock()
+        self._sendLock = asyncio.Lock()
+        try:
+            self._reader, self._writer = await asyncio.open_connection(
+                self.host, self.port)
+        except OSError as e:
+            raise type(e)("Failed to connect to %s:%s - %s" % (
+                self.host, self.port, e))
+
+        await self._send("ClientHello", Name=self.name,
+                         ExpectedVersion=expectedVersion)
+        msgs = []
+        while not msgs:
+            msgs = await self._readMsgs()
+        resp = msgs.pop(0)
+        if resp['header'] != 'NodeHello':
+            raise FCPProtocolError(resp)
+        self.nodeHello = resp
+        self.connectionidentifier = resp.get("ConnectionIdentifier", None)
+        try:
+            self.compressionCodecs = _node.FCPNode._parseCompressionCodecs(
+                self, resp["CompressionCodecs"])
+        except (KeyError, IndexError, ValueError):
+            pass
+
+        self.nodeIsAlive = True
+        self._readTask = self._loop.create_task(self._readLoop(msgs))
+        return resp
+
+    async def close(self):
+        """
+        Closes the connection, failing all unfinished jobs
+        """
+        if self._readTask is not None:
+            self._readTask.cancel()
+            try:
+                await self._readTask
+            except (asyncio.CancelledError, Exception):
+                pass
+            self._readTask = None
+        if self._writer is not None:
+            self._writer.close()
+            try:
+                await self._writer.wait_closed()
+            except OSError:
+                pass
+            self._writer = None
+        self._failAll(FCPNodeFailure("connection closed"))
+
+    # basic FCP primitives
+
+    def genkey(self, **kw):
+        """
+        Generates an SSK keypair, as in FCPNode.genkey
+
+        Keywords:
+            - usk - default False - if True, returns USK uris
+            - name - the path to put at end, optional
+        """
+        id = kw.pop("id", None) or self._getUniqueId()
+        name = kw.get("name", None)
+        usk = kw.get("usk", False)
+
+        def keys(result):
+            pub, priv = result
+            if name:
+                pub, priv = pub + name, priv + name
+                if usk:
+                    pub = pub.replace("SSK@", "USK@") + "/0"
+                    priv = priv.replace("SSK@", "USK@") + "/0"
+            return pub, priv
+
+        return self._submit(id, "GenerateSSK", {'Identifier': id},
+                            convert=keys)
+
+    def fcpPluginMessage(self, **kw):
+        """
+        Sends an FCPPluginMessage, see FCPNode.fcpPluginMessage
+
+        Keywords:
+            - plugin_name - the class name of the plugin
+            - plugin_params - a dict of parameters for the plugin
+        """
+        id = kw.pop("id", None) or self._getUniqueId()
+        fields = {'PluginName': kw.get('plugin_name'), 'Identifier': id}
+        for key, val in kw.get('plugin_params', {}).items():
+            fields['Param.%s' % str(key)] = val
+        return self._submit(id, "FCPPluginMessage", fields)
+
+    def listpeers(self, **kw):
+        """
+        Gets the list of peers from the node
+
+        Keywords:
+            - WithMetadata - default False - if True, returns a peer's metadata
+            - WithVolatile - default False - if True, returns a peer's volatile info
+        """
+        id = kw.pop("id", None) or self._getUniqueId()
+        kw['Identifier'] = id
+        return self._submit(id, "ListPeers", kw)
+
+    def get(self, uri, **kw):
+        """
+        Does a direct get of a key, see FCPNode.get for the keywords
+
+        The result is the same tuple FCPNode.get returns. Domain names
+        are resolved only through the local namesite cache.
+        """
+        id = kw.pop("id", None) or self._getUniqueId()
+        job = self._newJob(id, "ClientGet", {},
+                           followRedirect=kw.pop('followRedirect', True),
+                           stream=kw.get('stream', None),
+                           timeout=int(kw.pop('timeout', ONE_YEAR)))
+        self._loop.create_task(self._startGet(job, uri, kw))
+        return job
+
+    def put(self, uri="CHK@", **kw):
+        """
+        Inserts a key, see FCPNode.put for the keywords
+
+        The result is the URI of the inserted key.
+        """
+        if 'dir' in kw:
+            return self.putdir(uri, **kw)
+        id = kw.pop("id", None) or self._getUniqueId()
+        opts = self._putOpts(uri, id, kw)
+        return self._submit(id, "ClientPut", opts,
+                            timeout=int(kw.get("timeout", ONE_YEAR)),
+                            watchGlobal=opts['Global'] == "true")
+
+    def genchk(self, **kw):
+        """
+        Returns the CHK URI under which a data item would be inserted
+        """
+        return self.put(chkonly=True, **kw)
+
+    def putdir(self, uri, **kw):
+        """
+        Inserts a freesite, see FCPNode.putdir for the keywords
+
+        With 'filebyfile', the files are inserted concurrently, at most
+        'maxconcurrent' (default 10) at a time, and the manifest refers
+        to them by redirects. Otherwise the node reads the files from
+        disk.
+        """
+        id = kw.pop("id", None) or self._getUniqueId()
+        job = self._newJob(id, "ClientPutComplexDir", {},
+                           timeout=int(kw.get('timeout', ONE_YEAR)))
+        self._loop.create_task(self._startPutdir(job, uri, kw))
+        return job
+
+    def subscribeUSK(self, uri, **kw):
+        """
+        Subscribes to updates of a USK
+
+        The job never completes by itself; iterate over
+        job.progress(('SubscribedUSKUpdate',)) for the new editions.
+
+        Keywords:
+            - DontPoll - default False - if True, only passively watch
+        """
+        id = kw.pop("id", None) or self._getUniqueId()
+        fields = {'URI': uri, 'Identifier': id,
+                  'DontPoll': toBool(kw.get('DontPoll', 'false'))}
+        return self._submit(id, "SubscribeUSK", fields)
+
+    async def listenGlobal(self):
+        """
+        Enable listening on global queue
+        """
+        self._watchingGlobal = True
+        await self._send("WatchGlobal", Enabled="true")
+
+    async def ignoreGlobal(self):
+        """
+        Stop listening on global queue
+        """
+        self._watchingGlobal = False
+        await self._send("WatchGlobal", Enabled="false")
+
+    async def testDDA(self, **kw):
+        """
+        Test for Direct Disk Access capability on a directory, see
+        FCPNode.testDDA
+        """
+        DDAkey = (kw["Directory"], kw.get("WantReadDirectory", False),
+                  kw.get("WantWriteDirectory", False))
+        try:
+            return self.testedDDA[DDAkey]
+        except KeyError:
+            pass
+        # the replies have no Identifier, so like FCPNode we run one
+        # test at a time under '__global'
+        async with self._ddaLock:
+            try:
+                return self.testedDDA[DDAkey]
+            except KeyError:
+                pass
+            try:
+                requestResult = await self._submit("__global", "TestDDARequest", kw)
+            except FCPProtocolError as e:
+                self._log(DETAIL, str(e))
+                return False
+            responseResult = await self._respondDDA(requestResult)
+        self.testedDDA[DDAkey] = responseResult
+        return responseResult
+
+    async def _respondDDA(self, requestResult):
+        """
+        Does the file handling a TestDDAReply asks for, and returns the
+        TestDDAComplete for it
+        """
+        reply = {'Directory': requestResult['Directory']}
+        writeFilename = None
+        if 'ReadFilename' in requestResult:
+            readFilename = requestResult['ReadFilename']
+            try:
+                with open(readFilename, 'rb') as f:
+                    readFileContents = f.read().decode('utf-8')
+            except FileNotFoundError:
+                readFileContents = ''
+            reply['ReadFilename'] = readFilename
+            reply['ReadContent'] = readFileContents
+        if 'WriteFilename' in requestResult and 'ContentToWrite' in requestResult:
+            writeFilename = requestResult['WriteFilename']
+            try:
+                with open(writeFilename, "w+b") as f:
+                    f.write(requestResult['ContentToWrite'].encode('utf-8'))
+                mode = os.stat(writeFilename).st_mode
+                os.chmod(writeFilename, mode | stat.S_IREAD | stat.S_IRUSR |
+                         stat.S_IRGRP | stat.S_IROTH)
+            except FileNotFoundError:
+                pass
+
+        responseResult = await self._submit("__global", "TestDDAResponse", reply)
+        if writeFilename is not None:
+            try:
+                os.remove(writeFilename)
+            except OSError:
+                pass
+        return responseResult
+
+    # request setup
+
+    async def _startGet(self, job, uri, kw):
+        """
+        Builds and sends a ClientGet, after any TestDDA it needs
+        """
+        try:
+            opts = {}
+            opts['Persistence'] = kw.pop('persistence', 'connection')
+            opts['Global'] = "true" if kw.get('Global', False) else "false"
+            opts['Verbosity'] = kw.get('Verbosity', 0)
+            if opts['Global'] == 'true' and opts['Persistence'] == 'connection':
+                raise Exception("Global requests must be persistent")
+
+            file = kw.pop("file", None)
+            if file:
+                file = os.path.abspath(file)
+                opts['ReturnType'] = "disk"
+                opts['Filename'] = file
+                await self.testDDA(Directory=os.path.dirname(file),
+                                   WantWriteDirectory=True)
+            elif kw.get('nodata', False):
+                opts['ReturnType'] = "none"
+            else:
+                opts['ReturnType'] = "direct"
+
+            opts['Identifier'] = job.id
+            opts["IgnoreDS"] = "true" if kw.get("ignoreds", False) else "false"
+            opts["DSOnly"] = "true" if kw.get("dsonly", False) else "false"
+            opts['URI'] = self._resolveUri(uri)
+            opts['MaxRetries'] = kw.get("maxretries", -1)
+            opts['MaxSize'] = kw.get("maxsize", "1000000000000")
+            opts['PriorityClass'] = int(kw.get("priority", 2))
+
+            job.kw.update(opts)
+            if opts['Global'] == "true":
+                await self._watchGlobal()
+            await self._send("ClientGet", **job.kw)
+        except Exception as e:
+            job._putResult(e)
+
+    def _putOpts(self, uri, id, kw):
+        """
+        Returns the ClientPut fields for FCPNode.put style keywords
+        """
+        opts = {}
+        opts['Persistence'] = kw.pop('persistence', 'connection')
+        opts['Global'] = "true" if kw.get('Global', False) else "false"
+        if opts['Global'] == 'true' and opts['Persistence'] == 'connection':
+            raise Exception("Global requests must be persistent")
+
+        uri = self._resolveUri(uri)
+        opts['URI'] = uri
+
+        mimetype = kw.get("mimetype", None)
+        if mimetype is None:
+            if os.path.splitext(uri)[1]:
+                filename = os.path.basename(uri)
+            elif kw.get('file', None) is not None:
+                filename = os.path.basename(kw['file'])
+            else:
+                filename = uri
+            mimetype = guessMimetype(filename)
+        opts['Metadata.ContentType'] = mimetype
+        opts['Identifier'] = id
+
+        chkOnly = toBool(kw.get("chkonly", "false"))
+        opts['Verbosity'] = kw.get('Verbosity', 0)
+        opts['MaxRetries'] = kw.get("maxretries", -1)
+        opts['PriorityClass'] = kw.get("priority", 3)
+        opts['RealTimeFlag'] = toBool(kw.get("realtime", "false"))
+        opts['GetCHKOnly'] = chkOnly
+        opts['DontCompress'] = toBool(kw.get("nocompress", "false"))
+        opts['Codecs'] = kw.get('Codecs', ", ".join(
+            [name for name, num in self.compressionCodecs]))
+        opts['LocalRequestOnly'] = kw.get('LocalRequestOnly', False)
+
+        if "file" in kw:
+            filepath = os.path.abspath(kw['file'])
+            opts['UploadFrom'] = "disk"
+            opts['Filename'] = filepath
+            if "mimetype" not in kw:
+                opts['Metadata.ContentType'] = guessMimetype(kw['file'])
+            opts['FileHash'] = base64.b64encode(
+                sha256dda(self.connectionidentifier, id,
+                          path=filepath)).decode('utf-8')
+        elif "data" in kw:
+            opts["UploadFrom"] = "direct"
+            opts["Data"] = kw['data']
+            if kw.get('name'):
+                opts["TargetFilename"] = kw['name']
+        elif "redirect" in kw:
+            opts["UploadFrom"] = "redirect"
+            opts["TargetURI"] = kw['redirect']
+        elif chkOnly != "true":
+            raise Exception("Must specify file, data or redirect keywords")
+
+        if "TargetFilename" in kw:
+            opts["TargetFilename"] = kw["TargetFilename"]
+        if opts.get('Metadata.ContentType', None) == "application/octet-stream":
+            del opts['Metadata.ContentType']
+        if "IgnoreUSKDatehints" in kw:
+            opts["IgnoreUSKDatehints"] = kw["IgnoreUSKDatehints"]
+        return opts
+
+    async def _startPutdir(self, job, uri, kw):
+        """
+        Inserts the files of a freesite if needed, then its manifest
+        """
+        try:
+            sitename = kw.get('name', 'freesite')
+            uriFull = uri + sitename + "/"
+            if kw.get('usk', False):
+                uriFull += "%d/" % int(kw.get('version', 0))
+                uriFull = uriFull.replace("SSK@", "USK@")
+                while uriFull.endswith("/"):
+                    uriFull = uriFull[:-1]
+
+            globalMode = kw.get('globalqueue', False) or kw.get('Global', False)
+            persistence = "forever" if globalMode else "connection"
+            priority = kw.get('priority', 4)
+            Verbosity = kw.get('Verbosity', 0)
+            manifest = readdir(kw['dir'])
+
+            fields = {'Identifier': job.id,
+                      'Verbosity': Verbosity,
+                      'MaxRetries': kw.get('maxretries', 3),
+                      'PriorityClass': priority,
+                      'URI': uriFull,
+                      'Codecs': kw.get('Codecs', ", ".join(
+                          [name for name, num in self.compressionCodecs])),
+                      'Persistence': persistence,
+                      'Global': "true" if globalMode else "false",
+                      'DefaultName': "index.html",
+                      }
+
+            filebyfile = (kw.get('filebyfile', False) or 'allatonce' in kw
+                          or 'maxconcurrent' in kw)
+            if filebyfile:
+                slots = asyncio.Semaphore(kw.get('maxconcurrent', 10))
+
+                async def insert(filerec):
+                    async with slots:
+                        # streamed to the node, never read as a whole
+                        with open(filerec['fullpath'], "rb") as f:
+                            return await self.put("CHK@", data=f,
+                                                  mimetype=filerec['mimetype'],
+                                                  Verbosity=Verbosity,
+                                                  priority=priority,
+                                                  Global=globalMode,
+                                                  persistence=persistence)
+
+                results = await asyncio.gather(
+                    *[insert(rec) for rec in manifest], return_exceptions=True)
+                n = 0
+                for filerec, result in zip(manifest, results):
+                    if isinstance(result, Exception):
+                        self._log(ERROR, "File %s failed to insert" % filerec['relpath'])
+                        continue
+                    fields["Files.%d.Name" % n] = filerec['relpath']
+                    fields["Files.%d.UploadFrom" % n] = "redirect"
+                    fields["Files.%d.TargetURI" % n] = result
+                    n += 1
+            else:
+                for n, filerec in enumerate(manifest):
+                    fields["Files.%d.Name" % n] = filerec['relpath']
+                    fields["Files.%d.UploadFrom" % n] = "disk"
+                    fields["Files.%d.Filename" % n] = filerec['fullpath']
+
+            job.kw.update(fields)
+            if globalMode:
+                await self._watchGlobal()
+            await self._send("ClientPutComplexDir", **job.kw)
+        except Exception as e:
+            job._putResult(e)
+
+    async def _watchGlobal(self):
+        """
+        Listens to the global queue, unless we already do, so that the
+        replies to a Global request reach us
+        """
+        if not self._watchingGlobal:
+            await self.listenGlobal()
+
+    def _resolveUri(self, uri):
+        """
+        Strips 'freenet:' and resolves domain names from the namesite cache
+        """
+        uri = uri.split("freenet:")[-1]
+        if len(uri) >= 4 and uri[:4] in _keyTypes:
+            return uri
+        domain, sep, rest = uri.partition("/")
+        tgtUri = None
+        try:
+            with open(os.path.join(os.path.expanduser("~"), ".freenames")) as f:
+                env = _node.pseudopythonparser.Parser().parse(f.read())
+            for rec in env.get('locals', []):
+                tgtUri = rec['cache'].get(domain, tgtUri)
+        except (OSError, ValueError, KeyError):
+            pass
+        if not tgtUri:
+            raise _node.FCPNameLookupFailure(
+                "Failed to resolve freenet domain '%s'" % domain)
+        if rest:
+            return (tgtUri + "/" + rest).replace("//", "/")
+        return tgtUri
+
+    def _newJob(self, id, cmd, fields, **opts):
+        if self._loop is None or not self.nodeIsAlive:
+            raise FCPNodeFailure("%s:%s: node not connected" % (cmd, id))
+        job = AsyncJob(self, id, cmd, fields, **opts)
+        self.jobs[id] = job
+        return job
+
+    def _submit(self, id, cmd, fields, convert=None, watchGlobal=False, **opts):
+        """
+        Registers a job for the given message and sends it, after a
+        WatchGlobal if watchGlobal is set
+        """
+        job = self._newJob(id, cmd, fields, convert=convert, **opts)
+
+        async def send():
+            try:
+                if watchGlobal:
+                    await self._watchGlobal()
+                await self._send(cmd, **fields)
+            except Exception as e:
+                job._putResult(e)
+
+        self._loop.create_task(send())
+        return job
+
+    # low level node comms
+
+    async def _send(self, msgType, **kw):
+        """
+        Encodes and sends one message
+
+        The Data may be bytes, a str or a file object, which is read
+        from its current position in chunks as the node takes them.
+        """
+        data = kw.pop("Data", None)
+        if isinstance(data, str):
+            data = data.encode('utf-8')
+        if data is None:
+            raw = encodeMessage(msgType, kw)
+        else:
+            length = getDataLength(data)
+            raw = encodeMessage(msgType, kw, dataLength=length)
+        if self.verbosity >= DETAIL:
+            for line in raw.decode('utf-8').splitlines():
+                self._log(DETAIL, "CLIENT: %s" % line)
+        # header and data go out under the lock, so messages from
+        # concurrent jobs never interleave
+        async with self._sendLock:
+            self._writer.write(raw)
+            if hasattr(data, "read"):
+                await self._sendStream(data, length)
+            elif data is not None:
+                self._writer.write(data)
+            await self._writer.drain()
+
+    async def _sendStream(self, data, length):
+        """
+        Sends exactly length bytes from a file object, one chunk at a
+        time
+        """
+        sent = 0
+        while sent < length:
+            chunk = data.read(min(dataChunkSize, length - sent))
+            if not chunk:
+                break
+            self._writer.write(chunk)
+            sent += len(chunk)
+            await self._writer.drain()
+        if sent != length:
+            # the node waits for the rest, so this connection is broken
+            self.nodeIsAlive = False
+            raise FCPNodeFailure(
+                "data source ended after %d of %d bytes" % (sent, length))
+
+    async def _readMsgs(self):
+        """
+        Reads from the node and returns the messages completed by it
+        """
+        chunk = await self._reader.read(self._decoder.recvSize)
+        if not chunk:
+            raise FCPNodeFailure("FCP socket closed by node")
+        return self._decoder.feed(chunk)
+
+    async def _readLoop(self, msgs):
+        """
+        Dispatches node messages until the connection ends
+        """
+        try:
+            while True:
+                for msg in msgs:
+                    self._on_rxMsg(msg)
+                msgs = await self._readMsgs()
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            self.nodeIsAlive = False
+            self._log(ERROR, "AsyncFCPNode: connection failed: %s" % e)
+            self._failAll(e if isinstance(e, FCPNodeFailure) else FCPNodeFailure(str(e)))
+
+    def _failAll(self, exc):
+        self.nodeIsAlive = False
+        for job in list(self.jobs.values()):
+            job._putResult(exc)
+
+    def _streamFor(self, msg):
+        job = self.jobs.get(msg.get('Identifier'), None)
+        if job is None:
+            return None
+        return job.stream
+
+    def _on_rxMsg(self, msg):
+        """
+        Hands an incoming message to the job it belongs to
+
+        Messages without an Identifier, such as the replies to a
+        TestDDARequest, go to the job under '__global':
+
+        >>> async def testDDA(node):
+        ...     node._loop, node._ddaLock = asyncio.get_running_loop(), asyncio.Lock()
+        ...     node.nodeIsAlive = True
+        ...     replies = {'TestDDARequest': b"TestDDAReply\\nDirectory=/srv\\nEndMessage\\n",
+        ...                'TestDDAResponse': b"TestDDAComplete\\nDirectory=/srv\\n"
+        ...                                   b"ReadDirectoryAllowed=true\\nEndMessage\\n"}
+        ...     async def send(header, **kw):
+        ...         for msg in node._decoder.feed(replies[header]):
+        ...             node._on_rxMsg(msg)
+        ...     node._send = send
+        ...     return await node.testDDA(Directory="/srv", WantReadDirectory=True)
+        >>> asyncio.run(testDDA(AsyncFCPNode(verbosity=0)))['ReadDirectoryAllowed']
+        'true'
+        """
+        hdr = msg['header']
+        id = msg.get('Identifier', '__global')
+        if self.verbosity >= DEBUG:
+            self._log(DEBUG, "NODE: %s %s" % (hdr, id))
+        job = self.jobs.get(id, None)
+        if job is None:
+            self._log(DETAIL, "Got %s for unknown job %s" % (hdr, id))
+            return
+
+        handler = self._handlers.get(hdr, None)
+        if handler is None:
+            job._pending(msg)
+            return
+        handler(self, job, msg)
+
+    # message handlers, keyed by header in _handlers below
+
+    def _onResult(self, job, msg):
+        job._putResult(job.convert(msg) if job.convert else msg)
+
+    def _onSSKKeypair(self, job, msg):
+        keys = (msg['RequestURI'], msg['InsertURI'])
+        job._putResult(job.convert(keys) if job.convert else keys)
+
+    def _onDataFound(self, job, msg):
+        mimetype = msg.get('Metadata.ContentType', None)
+        job.mimetype = mimetype
+        if job.kw.get('ReturnType') == 'disk':
+            job._putResult((mimetype, job.kw['Filename'], msg))
+        elif job.kw.get('ReturnType') == 'none':
+            job._putResult((mimetype, 1, msg))
+        else:
+            job._pending(msg)
+
+    def _onAllData(self, job, msg):
+        job._putResult((job.mimetype, msg['Data'], msg))
+
+    def _onGetFailed(self, job, msg):
+        redirected = (msg.get('ShortCodeDescription', None) in
+                      ("New URI", "Too many path components")
+                      or msg.get('Code', None) in (27, 11))
+        if job.followRedirect and redirected and 'RedirectURI' in msg:
+            job.kw['URI'] = msg['RedirectURI']
+            self._log(DETAIL, "Redirect to %s" % msg['RedirectURI'])
+            self._loop.create_task(self._send(job.cmd, **job.kw))
+            return
+        job._putResult(FCPGetFailed(msg))
+
+    def _onPutSuccessful(self, job, msg):
+        job._putResult(msg['URI'])
+
+    def _onPutFailed(self, job, msg):
+        job._putResult(FCPPutFailed(msg))
+
+    def _onListItem(self, job, msg):
+        if job.cmd in ("ListPeers", "ListPeerNotes"):
+            job.msgs.append(msg)
+            job._pending(msg)
+        else:
+            job._putResult(msg)
+
+    def _onListEnd(self, job, msg):
+        job.msgs.append(msg)
+        job._putResult(job.msgs)
+
+    def _onProtocolError(self, job, msg):
+        job._putResult(FCPProtocolError(msg))
+
+    def _onIdentifierCollision(self, job, msg):
+        job._putResult(FCPException(msg))
+
+    _handlers = {
+        'SSKKeypair': _onSSKKeypair,
+        'DataFound': _onDataFound,
+        'AllData': _onAllData,
+        'GetFailed': _onGetFailed,
+        'PutSuccessful': _onPutSuccessful,
+        'PutFailed': _onPutFailed,
+        'Peer': _onListItem,
+        'PeerNote': _onListItem,
+        'EndListPeers': _onListEnd,
+        'EndListPeerNotes': _onListEnd,
+        'FCPPluginReply': _onListEnd,
+        'PluginInfo': _onListEnd,
+        'TestDDAReply': _onResult,
+        'TestDDAComplete': _onResult,
+        'NodeData': _onResult,
+        'ConfigData': _onResult,
+        'ProtocolError': _onProtocolError,
+        'IdentifierCollision': _onIdentifierCollision,
+        }
+
+    # misc
+
+    def _getUniqueId(self):
+        return _node.FCPNode._getUniqueId(self)
+
+    def _log(self, level, msg):
+        """
+        Logs a message. If level > verbosity, don't output it
+        """
+        if level > self.verbosity or self.logfile is None:
+            return
+        if not msg.endswith("\n"):
+            msg += "\n"
+        self.logfile.write(msg)
+        self.logfile.flush()
@@ -0,0 +1,334 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+"""
+Spreads the requests of one client over several freenet nodes.
+
+FCPCluster keeps an FCPNode connection to each node and offers the
+FCPNode API on top of them, so that bulk gets and inserts can use the
+capacity of all the nodes:
+
+    cluster = FCPCluster(["127.0.0.1:9481", "127.0.0.1:9482",
+                          "otherhost:9481"])
+    for uri, result in cluster.getmany(uris):
+        ...
+
+Requests are routed by their key:
+    - gets, and inserts under a given key, go to the node which owns the
+      key on a consistent hash ring. Fetching a CHK again therefore asks
+      the node which has it cached, and all inserts for an SSK or USK go
+      through the same node, in order. Adding or losing a node only
+      moves the keys of that node
+    - inserts of new CHKs, and commands which do not name a key, go to
+      the node with the fewest of our requests running
+
+A node whose connection failed is skipped for retryInterval seconds,
+and its keys are handled by the next node on the ring meanwhile.
+Synchronous requests which fail because their node went away are tried
+on the next node.
+
+Methods which FCPCluster does not route itself, such as listpeers(),
+are passed to the first node which is up.
+"""
+
+import bisect
+import collections
+import hashlib
+import threading
+import time
+
+from .node import FCPNode, FCPNodeFailure, ConnectionRefused
+from .node import maxInflightBytes, ERROR
+
+
+#: how long a node whose connection failed is left out, in seconds
+retryInterval = 30.0
+
+#: points per node on the hash ring, which evens out the key ranges
+ringReplicas = 64
+
+
+class FCPCluster:
+    """
+    Several FCPNode connections, used like one FCPNode
+    """
+
+    def __init__(self, nodes, **kw):
+        """
+        Connects to all the nodes
+
+        Arguments:
+            - nodes - a list of nodes, each given as 'host:port', a tuple
+              (host, port), or an FCPNode which is already connected
+
+        Keywords are passed to each FCPNode created, see FCPNode. The
+        cluster turns on reconnect unless told otherwise.
+
+        Nodes which cannot be reached are left out, and logged. Raises
+        ConnectionRefused if none can be reached.
+        """
+        kw.setdefault('reconnect', True)
+        self.retryInterval = kw.pop('retryInterval', retryInterval)
+
+        self.nodes = []
+        errors = []
+        for spec in nodes:
+            if isinstance(spec, FCPNode):
+                self.nodes.append(spec)
+                continue
+            if isinstance(spec, str):
+                host, _, port = spec.rpartition(':')
+            else:
+                host, port = spec
+            try:
+                self.nodes.append(FCPNode(host=host, port=int(port), **kw))
+            except Exception as e:
+                errors.append("%s:%s - %s" % (host, port, e))
+        if not self.nodes:
+            raise ConnectionRefused("No node of the cluster is reachable: %s"
+                                    % "; ".join(errors))
+        for error in errors:
+            self._log(ERROR, "FCPCluster: left out %s" % error)
+
+        self._lock = threading.Lock()
+        # node -> monotonic time until which it is left out
+        self._downUntil = {}
+        # node -> our requests running on it
+        self._inflight = collections.Counter()
+
+        self._ring = sorted(
+            (_hash("%s:%s#%d" % (node.host, node.port, i)), index)
+            for index, node in enumerate(self.nodes)
+            for i in range(ringReplicas))
+        self._points = [point for point, index in self._ring]
+
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.shutdown()
+
+
+    def __getattr__(self, name):
+        # the rest of the FCPNode API goes to any node
+        if name.startswith('_') or name == 'nodes':
+            raise AttributeError(name)
+        return getattr(self._candidates(None)[0], name)
+
+
+    # high level client methods
+
+    def get(self, uri, **kw):
+        """
+        Gets a key from the node which owns it, see FCPNode.get()
+        """
+        return self._dispatch(self._candidates(uri), 'get', uri, **kw)
+
+
+    def put(self, uri="CHK@", **kw):
+        """
+        Inserts a key, see FCPNode.put()
+
+        A new CHK goes to the least busy node, other keys to the node
+        which owns them.
+        """
+        return self._dispatch(self._candidates(uri, insert=True), 'put',
+                              uri, **kw)
+
+
+    def putdir(self, uri, **kw):
+        """
+        Inserts a freesite through the node which owns its key, see
+        FCPNode.putdir()
+        """
+        return self._dispatch(self._candidates(uri, insert=True), 'putdir',
+                              uri, **kw)
+
+
+    def genchk(self, **kw):
+        """
+        Calculates a CHK on the least busy node, see FCPNode.genchk()
+        """
+        return self._dispatch(self._candidates(None), 'genchk', **kw)
+
+
+    def genkey(self, **kw):
+        """
+        Creates a keypair on the least busy node, see FCPNode.genkey()
+        """
+        return self._dispatch(self._candidates(None), 'genkey', **kw)
+
+
+    def getmany(self, uris, concurrency=None, **kw):
+        """
+        Gets many keys from all the nodes, see FCPNode.getmany()
+
+        concurrency defaults to 10 for each node which is up.
+        """
+        if concurrency is None:
+            concurrency = 10 * len(self.upNodes())
+        return FCPNode.getmany(self, uris, concurrency, **kw)
+
+
+    def putmany(self, items, concurrency=None, max_inflight_bytes=None, **kw):
+        """
+        Inserts many keys through all the nodes, see FCPNode.putmany()
+
+        concurrency defaults to 10, and max_inflight_bytes to
+        maxInflightBytes, for each node which is up.
+        """
+        up = len(self.upNodes())
+        if concurrency is None:
+            concurrency = 10 * up
+        if max_inflight_bytes is None:
+            max_inflight_bytes = maxInflightBytes * up
+        return FCPNode.putmany(self, items, concurrency, max_inflight_bytes,
+                               **kw)
+
+
+    def upNodes(self):
+        """
+        Returns the nodes which are currently used
+        """
+        now = time.monotonic()
+        with self._lock:
+            return [node for node in self.nodes
+                    if node.nodeIsAlive and self._downUntil.get(node, 0) <= now]
+
+
+    def nodeFor(self, uri, insert=False):
+        """
+        Returns the node a request for uri goes to
+        """
+        return self._candidates(uri, insert)[0]
+
+
+    def shutdown(self):
+        """
+        Closes the connections to all the nodes
+        """
+        for node in self.nodes:
+            node.shutdown()
+
+
+    # the bulk methods of FCPNode, run on the cluster
+    _runMany = FCPNode._runMany
+    _putPath = FCPNode._putPath
+
+
+    # routing
+
+    def _candidates(self, uri, insert=False):
+        """
+        Returns the nodes to try for uri, best first, those which are
+        down last
+        """
+        key = routingKey(uri) if uri is not None else None
+        if insert and uri is not None and key == '':
+            # a new CHK, which no node has yet
+            key = None
+
+        if key is None:
+            with self._lock:
+                order = sorted(self.nodes, key=self._inflight.__getitem__)
+        else:
+            # walk the ring from the key
+            start = bisect.bisect(self._points, _hash(key))
+            order = []
+            for i in range(len(self._ring)):
+                node = self.nodes[self._ring[(start + i) % len(self._ring)][1]]
+                if node not in order:
+                    order.append(node)
+                    if len(order) == len(self.nodes):
+                        break
+
+        up = set(self.upNodes())
+        return [n for n in order if n in up] + [n for n in order if n not in up]
+
+
+    def _dispatch(self, candidates, method, *args, **kw):
+        """
+        Calls a method on the first node which takes it, counting the
+        request as running on that node until it completes
+        """
+        lastError = None
+        # an open file goes to the next node from where it started
+        data = kw.get('data', None)
+        start = data.tell() if hasattr(data, 'seek') else None
+        for node in candidates:
+            with self._lock:
+                self._inflight[node] += 1
+            try:
+                result = getattr(node, method)(*args, **kw)
+            except (FCPNodeFailure, ConnectionError) as e:
+                self._done(node)
+                self._markDown(node, e)
+                lastError = e
+                if start is not None:
+                    data.seek(start)
+                continue
+            except:
+                self._done(node)
+                raise
+            if kw.get('async', False) and hasattr(result, 'add_done_callback'):
+                result.add_done_callback(lambda job, node=node: self._done(node))
+            else:
+                self._done(node)
+            return result
+        raise lastError
+
+
+    def _done(self, node):
+        with self._lock:
+            self._inflight[node] -= 1
+
+
+    def _markDown(self, node, exc):
+        """
+        Leaves out a node whose connection failed for a while
+        """
+        self._log(ERROR, "FCPCluster: %s:%s failed, leaving it out for %ss: %s" % (
+            node.host, node.port, self.retryInterval, exc))
+        with self._lock:
+            self._downUntil[node] = time.monotonic() + self.retryInterval
+
+
+    def _log(self, level, msg):
+        self.nodes[0]._log(level, msg)
+
+
+
+def routingKey(uri):
+    """
+    Returns the part of a uri which decides the node it goes to: the key
+    of a CHK, SSK or USK without the path, or a whole KSK. A new CHK
+    gives ''.
+
+    >>> routingKey('freenet:CHK@abc,def,AAMC--8/index.html')
+    'CHK@abc,def,AAMC--8'
+    >>> routingKey('USK@pub,key,AQACAAE/site/4/') == routingKey('SSK@pub,key,AQACAAE/site-5')
+    True
+    >>> routingKey('CHK@'), routingKey('CHK@/name.txt')
+    ('', '')
+    >>> routingKey('KSK@gpl.txt')
+    'KSK@gpl.txt'
+    """
+    if uri.startswith('freenet:'):
+        uri = uri[len('freenet:'):]
+    keytype, sep, rest = uri.partition('@')
+    keytype = keytype.upper()
+    if keytype == 'KSK' or not sep:
+        return uri
+    key = rest.split('/', 1)[0]
+    if not key:
+        return ''
+    # the editions of a USK and an SSK site share the key
+    if keytype == 'USK':
+        keytype = 'SSK'
+    return keytype + '@' + key
+
+
+def _hash(text):
+    return int.from_bytes(
+        hashlib.sha1(text.encode('utf-8')).digest()[:8], 'big')
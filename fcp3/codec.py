@@ -0,0 +1,621 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+"""
+Encoder and incremental decoder for the FCP v2 wire format.
+
+The decoder is fed raw bytes as they arrive from the node and hands
+back complete messages in the form FCPNode has always used: a mapping
+with the header word under the key 'header', one entry per
+'key=value' line, and the payload of messages which end in a data
+block under the key 'Data'.
+
+The messages are FCPMessage objects, which behave like dicts but keep
+the 'key=value' lines as received, and only decode them when they are
+looked at. Which fields are numbers or booleans is known per message
+type from fieldTypes and messageFieldTypes, so a URI or a description
+is never run through int().
+
+It reads from a socket only when asked to via recvFrom(), and then
+in large chunks into a buffer it reuses, so it can be fed by hand and
+benchmarked without a live node. Once a data block has started,
+recvFrom() receives straight into a buffer of exactly DataLength
+bytes, or for streamed payloads into the reused buffer, so large
+payloads are neither reallocated nor copied twice.
+
+encodeMessage() does the reverse for messages sent to the node. Both
+FCPNode and AsyncFCPNode use this module.
+"""
+
+import collections.abc
+import sys
+import time
+
+
+#: default number of bytes to pull from a socket per recv
+defaultRecvSize = 65536
+
+
+class FCPDecodeError(ValueError):
+    """
+    the byte stream from the node is not valid FCP
+    """
+
+
+#: types of the fields which mean the same in every message; int fields
+#: are converted to ints, bool fields are 'true' or 'false' and only
+#: become bools through FCPMessage.getTyped()
+fieldTypes = {
+    # numbers
+    'DataLength': int, 'Code': int, 'PriorityClass': int,
+    'MaxRetries': int, 'Verbosity': int, 'Total': int, 'Required': int,
+    'Failed': int, 'FatallyFailed': int, 'Succeeded': int, 'Edition': int,
+    'Build': int, 'ExtBuild': int, 'ExtRevision': int,
+    'CompletionTime': int, 'StartupTime': int, 'LastProgress': int,
+    'ExpectedDataLength': int,
+    # flags
+    'Global': bool, 'Fatal': bool, 'FinalizedTotal': bool, 'Started': bool,
+    'Testnet': bool, 'RealTime': bool, 'DontCompress': bool,
+    'BinaryBlob': bool, 'IgnoreDS': bool, 'DSOnly': bool,
+    'ReadDirectoryAllowed': bool, 'WriteDirectoryAllowed': bool,
+    'Definitive': bool, 'NewKnownGood': bool, 'NewSlotToo': bool,
+    # text, even where it may look like a number
+    'Identifier': str, 'URI': str, 'RedirectURI': str, 'RequestURI': str,
+    'InsertURI': str, 'TargetURI': str, 'Metadata.ContentType': str,
+    'ShortCodeDescription': str, 'CodeDescription': str,
+    'ExtraDescription': str, 'ConnectionIdentifier': str, 'Directory': str,
+    'Filename': str, 'TargetFilename': str, 'ReadFilename': str,
+    'WriteFilename': str, 'ContentToWrite': str, 'ClientName': str,
+    'Persistence': str, 'PersistenceType': str, 'ReturnType': str,
+    'UploadFrom': str, 'Version': str, 'FCPVersion': str, 'Node': str,
+    'CompressionCodecs': str, 'PluginName': str, 'Codecs': str,
+    'identity': str, 'Hashes.SHA256': str,
+    }
+
+#: field types which only hold for some message types
+messageFieldTypes = {
+    'CompatibilityMode': {'Min': int, 'Max': int},
+    'EnterFiniteCooldown': {'Wakeup': int},
+    'PersistentGet': {'MaxRetries': int},
+    'SubscribedUSKUpdate': {'Edition': int},
+    }
+
+
+def _fieldTypesFor(header, _cache={}):
+    """
+    Returns the field types of a message type
+    """
+    types = _cache.get(header, None)
+    if types is None:
+        types = dict(fieldTypes)
+        types.update(messageFieldTypes.get(header, {}))
+        _cache[header] = types
+    return types
+
+
+_numberStart = frozenset("0123456789+-")
+
+
+class FCPMessage(collections.abc.MutableMapping):
+    """
+    A message from the node, which acts like the dict it used to be
+    
+    The fields stay the bytes they arrived as until they are used.
+    Looking up a single field only searches those bytes; anything else,
+    such as iterating or assigning, decodes them all once.
+    
+    Fields the schema calls int become ints. Fields it does not know
+    become ints if they look like one, as they always have.
+    
+    >>> msg = FCPMessage('SimpleProgress', b"\\nIdentifier=007\\nTotal=12\\nFinalizedTotal=true\\n")
+    >>> msg['header'], msg['Identifier'], msg['Total'], msg['FinalizedTotal']
+    ('SimpleProgress', '007', 12, 'true')
+    >>> msg.getTyped('FinalizedTotal')
+    True
+    >>> msg['Data'] = b"x"
+    >>> msg == {'header': 'SimpleProgress', 'Identifier': '007', 'Total': 12,
+    ...         'FinalizedTotal': 'true', 'Data': b"x"}
+    True
+    """
+    
+    __slots__ = ('header', '_raw', '_fields')
+    
+    # whether values are converted at all
+    _convert = True
+    
+    def __init__(self, header, raw=b"\n"):
+        """
+        Arguments:
+            - header - the message type, such as 'DataFound'
+            - raw - the message's 'key=value' lines, each preceded by a
+              newline character
+        """
+        self.header = header
+        self._raw = raw
+        self._fields = None
+    
+    def __getitem__(self, key):
+        if key == 'header':
+            return self.header
+        if self._fields is not None:
+            return self._fields[key]
+    
+        # find the field's line, the last one if it occurs twice
+        raw = self._raw
+        tag = b"\n" + key.encode('utf-8') + b"="
+        start = raw.rfind(tag)
+        if start < 0:
+            raise KeyError(key)
+        start += len(tag)
+        return self._convertValue(
+            key, raw[start:raw.index(b"\n", start)].decode('utf-8'))
+    
+    def __setitem__(self, key, value):
+        if key == 'header':
+            self.header = value
+        else:
+            self._decoded()[key] = value
+    
+    def __delitem__(self, key):
+        del self._decoded()[key]
+    
+    def __contains__(self, key):
+        if key == 'header':
+            return True
+        if self._fields is not None:
+            return key in self._fields
+        return (b"\n" + key.encode('utf-8') + b"=") in self._raw
+    
+    def __iter__(self):
+        yield 'header'
+        yield from self._decoded()
+    
+    def __len__(self):
+        return len(self._decoded()) + 1
+    
+    def __repr__(self):
+        return repr(dict(self.items()))
+    
+    def __sizeof__(self):
+        # what the message holds on to, without decoding it
+        size = object.__sizeof__(self) + sys.getsizeof(self.header)
+        if self._raw is not None:
+            size += sys.getsizeof(self._raw)
+        if self._fields is not None:
+            size += sys.getsizeof(self._fields) + sum(
+                sys.getsizeof(k) + sys.getsizeof(v)
+                for k, v in self._fields.items())
+        return size
+    
+    def getTyped(self, key, default=None):
+        """
+        Returns a field converted to its type in the schema, so flags
+        become bools, or default if the message does not have it
+        """
+        value = self.get(key, default)
+        if value is not default and isinstance(value, str) \
+        and _fieldTypesFor(self.header).get(key, None) is bool:
+            return value == 'true'
+        return value
+    
+    def _decoded(self):
+        """
+        Returns the dict of all fields, decoding them on first use
+        """
+        fields = self._fields
+        if fields is None:
+            fields = {}
+            convert = self._convertValue
+            for line in self._raw.decode('utf-8').split("\n"):
+                if line:
+                    k, sep, v = line.partition("=")
+                    fields[k] = convert(k, v)
+            self._fields = fields
+            self._raw = None
+        return fields
+    
+    def _convertValue(self, key, value):
+        """
+        Converts a received value according to the schema
+        """
+        if not self._convert:
+            return value
+        kind = _fieldTypesFor(self.header).get(key, None)
+        if kind is None:
+            # unknown field: the old rule, but don't try text
+            if value[:1] not in _numberStart:
+                return value
+        elif kind is not int:
+            return value
+        try:
+            return int(value)
+        except ValueError:
+            return value
+
+
+class RawFCPMessage(FCPMessage):
+    """
+    An FCPMessage whose values are all left as the strings received
+    """
+    
+    __slots__ = ()
+    
+    _convert = False
+
+
+def encodeMessage(msgType, fields, dataLength=None):
+    """
+    Encodes a message to the node, apart from its data
+
+    Arguments:
+        - msgType - the message header, such as 'ClientHello'
+        - fields - a dict of the message's fields
+    Keywords:
+        - dataLength - if not None, the message is followed by a data
+          block of this many bytes, which the caller sends after the
+          returned bytes
+
+    >>> encodeMessage("ClientHello", {'Name': 'me', 'ExpectedVersion': 2.0})
+    b'ClientHello\\nName=me\\nExpectedVersion=2.0\\nEndMessage\\n'
+    >>> encodeMessage("ClientPut", {'URI': 'CHK@'}, dataLength=3)
+    b'ClientPut\\nURI=CHK@\\nDataLength=3\\nData\\n'
+    """
+    lines = [msgType]
+    for k, v in fields.items():
+        lines.append("%s=%s" % (k, v))
+    if dataLength is None:
+        lines.append("EndMessage\n")
+    else:
+        lines.append("DataLength=%d" % dataLength)
+        lines.append("Data\n")
+    return "\n".join(lines).encode('utf-8')
+
+
+class FCPMessageDecoder:
+    """
+    Splits a stream of bytes into FCP messages
+
+    >>> d = FCPMessageDecoder()
+    >>> d.feed(b"NodeHello\\nFCPVersion=2.0\\nBuild=1")
+    []
+    >>> d.feed(b"484\\nEndMessage\\n") == [
+    ...     {'header': 'NodeHello', 'FCPVersion': '2.0', 'Build': 1484}]
+    True
+
+    Data payloads may be split across any number of feeds:
+
+    >>> raw = b"AllData\\nIdentifier=x\\nDataLength=5\\nData\\nhello"
+    >>> [d.feed(raw[i:i+1]) for i in range(len(raw))][-1]
+    [{'header': 'AllData', 'Identifier': 'x', 'DataLength': 5, 'Data': b'hello'}]
+
+    And several messages may arrive in one chunk:
+
+    >>> msgs = d.feed(b"SSKKeypair\\nEnd\\n\\nPeer\\nEndMessage\\n")
+    >>> [m['header'] for m in msgs]
+    ['SSKKeypair', 'Peer']
+    """
+
+    def __init__(self, recvSize=defaultRecvSize, streamFor=None, streamFlush=0,
+                 convertInts=True):
+        """
+        Create a decoder
+
+        Keywords:
+            - recvSize - how many bytes to ask for per recv in recvFrom(),
+              which is also the largest chunk written to a stream
+            - streamFor - if given, a callable which gets passed each
+              message which is about to receive a data block. If it
+              returns a writable file object, or a tuple of such an
+              object and a streamFlush value for this message, the data
+              is written there as it arrives and the message's 'Data' is
+              None. Otherwise the data is collected under 'Data'.
+              The chunks passed to write() are only valid during the
+              call.
+            - streamFlush - flush streams after every this many bytes;
+              0 means flush only once, after the whole data block
+            - convertInts - whether values which look like integers are
+              turned into ints, default True. Pass False to get every
+              value exactly as sent, for example to forward it.
+        """
+        self.recvSize = recvSize
+        self.streamFor = streamFor
+        self.streamFlush = streamFlush
+        self.convertInts = convertInts
+
+        # bytes received from the socket, reused across recvs
+        self._recvBuf = bytearray(recvSize)
+
+        # bytes not yet consumed by the parser, and the parse position
+        self._buf = bytearray()
+        self._pos = 0
+
+        # the message currently being assembled: its header, and its
+        # fields as received
+        self._msg = None
+        self._fieldBuf = bytearray()
+        self._messageClass = FCPMessage if convertInts else RawFCPMessage
+
+        # state of the data block of the current message
+        self._data = None
+        self._dataLen = 0
+        self._dataGot = 0
+        self._stream = None
+        self._flushEvery = 0
+        self._unflushed = 0
+
+    def feed(self, data):
+        """
+        Feed raw bytes from the node into the decoder
+
+        Returns a list of all messages completed by these bytes, which
+        may be empty.
+        """
+        self._buf += data
+        return self._parse()
+
+    def recvFrom(self, sock):
+        """
+        Does one recv from the given socket and decodes what it got
+
+        Returns a list of all messages completed by the received bytes,
+        which may be empty. Raises EOFError if the node closed the
+        connection.
+        """
+        if self._dataLen and self._pos == len(self._buf):
+            return self._recvData(sock)
+        n = sock.recv_into(self._recvBuf, self.recvSize)
+        if not n:
+            raise EOFError("FCP socket closed by node")
+        with memoryview(self._recvBuf) as view:
+            with view[:n] as chunk:
+                return self.feed(chunk)
+
+    def _recvData(self, sock):
+        """
+        Receives the rest of a data block without going through the
+        line buffer, never reading past its end
+        """
+        want = self._dataLen - self._dataGot
+        if self._stream is None:
+            # straight into the preallocated payload
+            with memoryview(self._data) as view:
+                with view[self._dataGot:self._dataLen] as target:
+                    n = sock.recv_into(target, want)
+        else:
+            n = sock.recv_into(self._recvBuf, min(want, self.recvSize))
+            if n:
+                with memoryview(self._recvBuf) as view:
+                    with view[:n] as chunk:
+                        self._writeStream(chunk)
+        if not n:
+            raise EOFError("FCP socket closed by node")
+        self._dataGot += n
+        if self._dataGot == self._dataLen:
+            return [self._finishMsg()]
+        return []
+
+    def isIdle(self):
+        """
+        Returns True if the decoder is not in the middle of a message
+        """
+        return self._msg is None and self._pos == len(self._buf)
+
+    def _parse(self):
+        """
+        Consumes as much of the buffer as possible
+        """
+        buf = self._buf
+        pos = self._pos
+        end = len(buf)
+        complete = []
+
+        while pos < end:
+            # inside a data block: take it straight from the buffer
+            if self._dataLen:
+                take = min(end - pos, self._dataLen - self._dataGot)
+                self._takeData(buf, pos, take)
+                pos += take
+                if self._dataGot == self._dataLen:
+                    complete.append(self._finishMsg())
+                continue
+
+            nl = buf.find(b"\n", pos)
+            if nl < 0:
+                break
+
+            # a message which is all in the buffer is taken in one go
+            if self._msg is None:
+                after = self._parseWhole(buf, pos, nl, complete)
+                if after is not None:
+                    pos = after
+                    continue
+
+            line = bytes(buf[pos:nl]).strip()
+            pos = nl + 1
+
+            msg = self._parseLine(line)
+            if msg is not None:
+                complete.append(msg)
+
+        # drop the consumed bytes
+        if pos == end:
+            buf.clear()
+            self._pos = 0
+        elif pos > 0:
+            del buf[:pos]
+            self._pos = 0
+        else:
+            self._pos = pos
+
+        return complete
+
+    def _parseWhole(self, buf, pos, nl, complete):
+        """
+        Takes the message starting at pos, whose header line ends at nl,
+        if its fields are all in the buffer and plain
+
+        Returns the position after the message, or None to leave it to
+        _parseLine().
+        """
+        # find the line ending the fields
+        term = nl
+        while True:
+            term = buf.find(b"\nEnd", term + 1)
+            if term < 0 or buf[term+4:term+5] == b"\n" \
+            or buf[term+4:term+12] == b"Message\n":
+                break
+        if term < 0:
+            data = buf.find(b"\nData\n", nl)
+        else:
+            data = buf.find(b"\nData\n", nl, term)
+        if data >= 0:
+            term = data
+        elif term < 0:
+            return None
+
+        # one '=' per line, and nothing for strip() to do
+        fields = bytes(buf[nl:term+1])
+        if fields.count(b"\n") != fields.count(b"=") + 1 or b"\r" in fields:
+            return None
+        header = bytes(buf[pos:nl]).strip()
+        if not header:
+            return None
+
+        self._msg = self._messageClass(header.decode('utf-8'), fields)
+        if term == data:
+            msg = self._startData()
+            after = term + 6
+        else:
+            msg = self._finishMsg()
+            after = buf.index(b"\n", term + 1) + 1
+        if msg is not None:
+            complete.append(msg)
+        return after
+
+    def _parseLine(self, line):
+        """
+        Handles one line of a message. Returns the message if the line
+        completed it, otherwise None.
+        """
+        msg = self._msg
+
+        # the header, skipping blank lines between messages
+        if msg is None:
+            if line:
+                self._msg = line.decode('utf-8')
+                self._fieldBuf = bytearray(b"\n")
+            return None
+
+        if line == b'EndMessage' or line == b'End':
+            self._msg = self._messageClass(msg, bytes(self._fieldBuf))
+            return self._finishMsg()
+
+        if line == b'Data':
+            self._msg = self._messageClass(msg, bytes(self._fieldBuf))
+            return self._startData()
+
+        # it's a normal 'key=val' pair, which is decoded when it is used
+        if b"=" not in line:
+            raise FCPDecodeError("Invalid line in %s message: %r" % (
+                msg, line))
+        self._fieldBuf += line
+        self._fieldBuf += b"\n"
+        return None
+
+    def _startData(self):
+        """
+        Prepares for the data block which follows a 'Data' line
+        """
+        msg = self._msg
+        try:
+            length = int(msg['DataLength'])
+        except (KeyError, ValueError):
+            raise FCPDecodeError("%s message has Data but no valid DataLength" %
+                                 msg['header'])
+
+        self._stream = None
+        self._flushEvery = self.streamFlush
+        self._unflushed = 0
+        if self.streamFor is not None:
+            self._stream = self.streamFor(msg)
+            if isinstance(self._stream, tuple):
+                self._stream, self._flushEvery = self._stream
+        if self._stream is None:
+            self._data = bytearray(length)
+
+        if not length:
+            return self._finishMsg()
+        self._dataLen = length
+        self._dataGot = 0
+        return None
+
+    def _takeData(self, buf, pos, n):
+        """
+        Moves n bytes of the data block from the buffer to its target
+        """
+        if self._stream is not None:
+            self._writeStream(buf[pos:pos+n])
+        else:
+            self._data[self._dataGot:self._dataGot+n] = buf[pos:pos+n]
+        self._dataGot += n
+
+    def _writeStream(self, chunk):
+        """
+        Writes a chunk of the data block to the stream
+        """
+        self._stream.write(chunk)
+        self._unflushed += len(chunk)
+        if self._flushEvery and self._unflushed >= self._flushEvery:
+            self._stream.flush()
+            self._unflushed = 0
+
+    def _finishMsg(self):
+        """
+        Returns the current message, resetting for the next one
+        """
+        msg = self._msg
+        if self._stream is not None and hasattr(self._stream, "flush"):
+            self._stream.flush()
+        if self._dataLen or self._data is not None or self._stream is not None:
+            # filled in place, handed out as bytes like it always was
+            msg['Data'] = None if self._data is None else bytes(self._data)
+        self._msg = None
+        self._data = None
+        self._dataLen = 0
+        self._dataGot = 0
+        self._stream = None
+        return msg
+
+
+def benchmarkDecoder(raw, chunkSize=defaultRecvSize, repeat=10):
+    """
+    Measures how fast the decoder splits a byte string into messages
+
+    Arguments:
+        - raw - the bytes to decode, for example a capture of an FCP
+          session
+    Keywords:
+        - chunkSize - how many bytes to feed at a time
+        - repeat - how often to decode the whole string
+
+    Returns (messages per second, bytes per second).
+
+    >>> raw = b"SimpleProgress\\nIdentifier=x\\nTotal=10\\nEndMessage\\n" * 100
+    >>> msgsPerSec, bytesPerSec = benchmarkDecoder(raw, repeat=1)
+    >>> msgsPerSec > 0 and bytesPerSec > 0
+    True
+    """
+    nmsgs = 0
+    start = time.perf_counter()
+    for i in range(repeat):
+        decoder = FCPMessageDecoder()
+        with memoryview(raw) as view:
+            for pos in range(0, len(raw), chunkSize):
+                nmsgs += len(decoder.feed(view[pos:pos+chunkSize]))
+    elapsed = max(time.perf_counter() - start, 1e-9)
+    return nmsgs / elapsed, len(raw) * repeat / elapsed
+
+
+if __name__ == "__main__":
+    from doctest import testmod
+    testmod()
@@ -396,7 +396,7 @@ def main():
     # try to create an FCP node, needed for name lookups
     try:
         n = node.FCPNode(host=fcpHost, port=fcpPort, verbosity=verbosity,
-                         logfile=sys.stderr)
+                         logfile=sys.stderr, reconnect=True)
         log = n._log
     except:
         if verbose:
@@ -46,6 +46,7 @@ import fcp3 as fcp
 
 from fcp3.xmlobject import XMLFile
 from fcp3.node import guessMimetype, base64encode, base64decode, uriIsPrivate
+from fcp3.node import AdaptiveLimiter
 
 #@-node:imports
 #@+node:globals
@@ -1129,7 +1130,7 @@ class FreenetBaseFS:
                 mimetype=rec.mimetype)
         
         # now insert all these files
-        maxJobs = 5
+        limiter = self.insertLimiter
         jobsWaiting = fileRecs[:]
         jobsRunning = []
         jobsDone = []
@@ -1177,51 +1178,68 @@ class FreenetBaseFS:
         #print "manifestUri=%s" % manifestUri
         #time.sleep(6)
     
-        # the big insert/wait loop
-        while jobsWaiting or jobsRunning:
-            nWaiting = len(jobsWaiting)
-            nRunning = len(jobsRunning)
-            self.log("commit: %s waiting, %s running" % (nWaiting,nRunning))
-    
-            # launch jobs, if available, and if spare slots
-            while len(jobsRunning) < maxJobs and jobsWaiting:
-    
-                rec = jobsWaiting.pop(0)
-    
-                # if record has data, insert it, otherwise take as done            
-                if rec.hasdata:
-                    uri = rec.uri
-                    if not uri:
-                        uri = "CHK@somefile" + os.path.splitext(rec.path)[1]
-                    job = node.put(uri, data=rec.data, **{"async": True})
-                    rec.job = job
-                    jobsRunning.append(rec)
-                else:
-                    # record should already have the hash, uri, mimetype
-                    jobsDone.append(rec)
+        # the big insert/wait loop; the limiter is shared with the
+        # other commits, so it gets back what this one holds even
+        # if a put or a job fails
+        token = None
+        try:
+            while jobsWaiting or jobsRunning:
+                nWaiting = len(jobsWaiting)
+                nRunning = len(jobsRunning)
+                self.log("commit: %s waiting, %s running" % (nWaiting,nRunning))
+    
+                # launch jobs, if available, and if spare slots
+                while jobsWaiting:
+                    token = limiter.acquire(blocking=False)
+                    if token is None:
+                        break
+    
+                    rec = jobsWaiting.pop(0)
+    
+                    # if record has data, insert it, otherwise take as done            
+                    if rec.hasdata:
+                        uri = rec.uri
+                        if not uri:
+                            uri = "CHK@somefile" + os.path.splitext(rec.path)[1]
+                        job = node.put(uri, data=rec.data, **{"async": True})
+                        rec.job = job
+                        rec.token = token
+                        jobsRunning.append(rec)
+                    else:
+                        # record should already have the hash, uri, mimetype
+                        limiter.release(token)
+                        jobsDone.append(rec)
+                    token = None
     
-            # check running jobs
-            for rec in jobsRunning:
-                if rec == manifestJob:
-                    job = rec
-                else:
-                    job = rec.job
+                # check running jobs
+                for rec in list(jobsRunning):
+                    if rec == manifestJob:
+                        job = rec
+                    else:
+                        job = rec.job
     
-                if job.isComplete():
-                    jobsRunning.remove(rec)
+                    if job.isComplete():
+                        jobsRunning.remove(rec)
+                        limiter.release(rec.token, job.result)
     
-                    uri = job.wait()
+                        uri = job.wait()
     
-                    if job != manifestJob:
-                        rec.uri = uri
-                        rec.job = None
-                        jobsDone.append(rec)
+                        if job != manifestJob:
+                            rec.uri = uri
+                            rec.job = None
+                            jobsDone.append(rec)
     
-            # breathe!!
-            if jobsRunning:
-                time.sleep(5)
-            else:
-                time.sleep(1)
+                # breathe!!
+                if jobsRunning:
+                    time.sleep(5)
+                else:
+                    time.sleep(1)
+        finally:
+            if token is not None:
+                limiter.release(token)
+            for rec in jobsRunning:
+                if getattr(rec, 'token', None) is not None:
+                    limiter.release(rec.token)
     
         manifestUri = manifestJob.wait()
         self.log("commitDisk: done, manifestUri=%s" % manifestUri)
@@ -1358,11 +1376,15 @@ class FreenetBaseFS:
         try:
             self.node = fcp.FCPNode(host=self.fcpHost,
                                     port=self.fcpPort,
-                                    verbosity=self.verbosity)
+                                    verbosity=self.verbosity,
+                                    reconnect=True)
         except:
             raise IOError(errno.EIO, "Failed to reach FCP service at %s:%s" % (
                             self.fcpHost, self.fcpPort))
     
+        # how many inserts to run at once, following the node's load
+        self.insertLimiter = AdaptiveLimiter(self.node, initial=5)
+    
         #self.log("pubkey=%s" % self.pubkey)
         #self.log("privkey=%s" % self.privkey)
         #self.log("cachedir=%s" % self.cachedir)
@@ -0,0 +1,696 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+"""
+A local FCP gateway, which lets many short-lived client processes share
+one connection to a freenet node.
+
+The gateway keeps a single FCPNode connection open, and listens on a
+Unix domain socket. Clients talk plain FCP to that socket: their
+ClientHello is answered from the NodeHello the gateway got when it
+connected, so the node sees one hello no matter how many clients come
+and go, and their requests are passed on to the node.
+
+Identifiers of connection-scoped requests are prefixed with a
+per-client tag on their way to the node, so that clients cannot collide
+with each other, and the tag is stripped from the replies before they
+are routed back to their owner. Persistent and global requests keep
+their identifiers, so that they can be found again later by any client.
+Messages the gateway cannot route, such as the global queue's, go to the
+clients which sent WatchGlobal or are listing persistent requests.
+
+When a client goes away, its unfinished connection-scoped gets and puts
+are removed from the node, just as if it had closed its own connection.
+
+Start it with 'fcpgateway', or in code:
+
+    gw = FCPGateway(host="127.0.0.1", port=9481)
+    gw.serveForever()
+
+FCPNode(gateway=True), which the command-line tools use, then talks to
+the node through the gateway whenever one is running.
+"""
+
+import argparse
+import collections
+import functools
+import os
+import selectors
+import signal
+import socket
+import sys
+import time
+
+from . import node
+from .node import FCPNode, gatewayPath, checkPrivate
+from .node import ERROR, INFO, DETAIL, DEBUG
+from .codec import FCPMessageDecoder, FCPDecodeError, encodeMessage
+
+
+#: how long a client may leave messages queued for it unread, in seconds,
+#: before it is dropped
+clientTimeout = 30.0
+
+# the chunk of zeros which fills up the data of a client that went away
+_zeros = bytes(65536)
+
+#: commands which start a request that runs until a final reply
+requestCommands = ('ClientGet', 'ClientPut', 'ClientPutDiskDir',
+                   'ClientPutComplexDir')
+
+#: replies which finish such a request
+finalReplies = ('PutSuccessful', 'PutFailed', 'GetFailed', 'AllData',
+                'PersistentRequestRemoved', 'IdentifierCollision')
+
+
+class GatewayClient:
+    """
+    One client process connected to the gateway
+    """
+
+    def __init__(self, sock, prefix):
+        self.sock = sock
+        self.prefix = prefix
+        self.decoder = FCPMessageDecoder(convertInts=False)
+
+        # the keys under which replies are routed to us
+        self.routes = set()
+
+        # our connection-scoped gets and puts which have not finished,
+        # by the identifier the node knows them by
+        self.active = {}
+
+        self.watchGlobal = False
+
+        # the data block we are passing on to the node, see NodeStream
+        self.stream = None
+
+        # what is waiting to be sent to us, since when nothing of it
+        # could be sent, and the events our socket is selected for
+        self.outbox = collections.deque()
+        self.stalledSince = None
+        self.events = selectors.EVENT_READ
+
+    def __repr__(self):
+        return "<GatewayClient %s>" % self.prefix
+
+
+class NodeStream:
+    """
+    Passes the data block of a client's message on to the node as it
+    arrives, so that it is never held in memory as a whole
+    """
+
+    def __init__(self, sock, length, id, isGlobal):
+        self.sock = sock
+        self.left = length
+        self.id = id
+        self.isGlobal = isGlobal
+
+    def write(self, chunk):
+        self.sock.sendall(chunk)
+        self.left -= len(chunk)
+
+
+class FCPGateway(FCPNode):
+    """
+    An FCPNode which shares its node connection with clients on a
+    Unix domain socket
+
+    Everything runs in the manager thread, which the client sockets
+    are added to, so the node connection still has a single writer.
+    While a client's data block passes through to the node, the other
+    clients are not read, and anything else for the node waits until
+    the block is complete.
+    Messages to clients are queued per client and sent as far as the
+    client takes them, so a client which does not read holds up nobody
+    else.
+    """
+
+    # pass numbers on exactly as they arrive
+    _convertInts = False
+
+    def __init__(self, **kw):
+        """
+        Connect to the node and start listening for clients
+
+        Keywords are those of FCPNode, plus:
+            - path - the socket to listen on, defaults to
+              gatewayPath(host, port), where FCPNode(gateway=True) looks
+
+        Raises an Exception if another gateway is already listening on
+        that socket, and GatewayNotPrivate if the default socket's
+        directory is open to other users.
+        """
+        kw.setdefault('name', "fcp3-gateway")
+        kw.pop('gateway', None)
+
+        self.clients = {}
+        self._routes = {}
+        self._listers = collections.deque()
+        self._watchers = 0
+        self._nextClient = 0
+        self.listener = None
+        # the data block going to the node, and what waits for its end
+        self._nodeStream = None
+        self._backlog = collections.deque()
+
+        FCPNode.__init__(self, **kw)
+
+        self.path = kw.get('path', None) or gatewayPath(self.host, self.port)
+        try:
+            if not kw.get('path', None):
+                # where nobody else can put a socket of their own
+                checkPrivate(os.path.dirname(self.path), create=True)
+            self.listener = self._listen(self.path)
+        except:
+            FCPNode.shutdown(self)
+            raise
+        self._selector.register(self.listener, selectors.EVENT_READ,
+                                self._on_accept)
+        self._wakeup()
+        self._log(INFO, "gateway for %s:%s listening on %s" % (
+            self.host, self.port, self.path))
+
+    def serveForever(self):
+        """
+        Serves clients until shutdown() is called or the node goes away
+        """
+        # the manager thread holds this lock while it runs
+        self.shutdownLock.acquire()
+        self.shutdownLock.release()
+        self.shutdown()
+
+    def shutdown(self):
+        """
+        Disconnects all clients, stops listening and closes the node
+        connection
+        """
+        FCPNode.shutdown(self)
+
+        for client in list(self.clients.values()):
+            client.sock.close()
+        self.clients.clear()
+        self._routes.clear()
+
+        if self.listener is not None:
+            self.listener.close()
+            self.listener = None
+            try:
+                os.unlink(self.path)
+            except OSError:
+                pass
+
+    # methods for manager thread
+
+    def _listen(self, path):
+        """
+        Binds the listening socket, taking over a stale socket file
+        """
+        if os.path.exists(path):
+            probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                probe.connect(path)
+            except OSError:
+                # left behind by a gateway which died
+                os.unlink(path)
+            else:
+                raise Exception("A gateway is already listening on %s" % path)
+            finally:
+                probe.close()
+
+        listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        # clients can make the node read and write our files, so the
+        # socket is ours alone from the moment it exists
+        umask = os.umask(0o177)
+        try:
+            listener.bind(path)
+        except:
+            listener.close()
+            raise
+        finally:
+            os.umask(umask)
+        listener.listen(64)
+        listener.setblocking(False)
+        return listener
+
+    def _on_accept(self, listener):
+        """
+        Takes on a newly connected client
+        """
+        try:
+            sock, addr = listener.accept()
+        except (BlockingIOError, InterruptedError):
+            return
+        sock.setblocking(False)
+
+        self._nextClient += 1
+        client = GatewayClient(sock, "gw%d-" % self._nextClient)
+        client.decoder.streamFor = functools.partial(self._streamToNode, client)
+        self.clients[sock] = client
+        self._selector.register(sock, client.events, self._on_clientEvent)
+        self._log(DETAIL, "gateway: %s connected" % client)
+
+    def _on_clientEvent(self, sock):
+        """
+        Sends a client what is queued for it, then reads what it sent
+        and passes it on
+        """
+        client = self.clients.get(sock, None)
+        if client is None:
+            return
+        if client.outbox:
+            self._flushClient(client)
+            if sock not in self.clients:
+                return
+        if not client.events & selectors.EVENT_READ:
+            # another client's data block is going to the node
+            return
+        try:
+            msgs = client.decoder.recvFrom(sock)
+        except (BlockingIOError, InterruptedError):
+            # only writable
+            return
+        except (EOFError, OSError, FCPDecodeError) as e:
+            self._log(DETAIL, "gateway: %s gone: %s" % (client, e))
+            self._dropClient(client)
+            return
+
+        for msg in msgs:
+            if client.sock not in self.clients:
+                # dropped while we handled an earlier message
+                return
+            if 'Data' in msg and msg['Data'] is None:
+                # passed on while it arrived, see _streamToNode
+                self._endStream(client)
+                continue
+            fields = self._fromClient(client, msg)
+            if fields is not None:
+                hdr = fields.pop('header')
+                if 'Data' in fields:
+                    # sent along with the data
+                    fields.pop('DataLength', None)
+                self._txMsg(hdr, **fields)
+
+    def _streamToNode(self, client, msg):
+        """
+        Called by the decoder of a client when the data block of msg
+        starts: sends msg on to the node, and returns the NodeStream
+        through which its data follows
+        """
+        fields = self._fromClient(client, msg)
+        if fields is None:
+            # answered here, its data is collected and dropped
+            return None
+        hdr = fields.pop('header')
+        length = int(fields.pop('DataLength'))
+        raw = encodeMessage(hdr, fields, dataLength=length)
+        if self.verbosity >= DETAIL:
+            for line in raw.decode('utf-8').splitlines():
+                self._log(DETAIL, "CLIENT: %s" % line)
+            self._log(DETAIL, "CLIENT: ...%d bytes of data..." % length)
+        self.socket.sendall(raw)
+        client.stream = self._nodeStream = NodeStream(
+            self.socket, length, fields.get('Identifier', None),
+            str(fields.get('Global', 'false')).lower() == 'true')
+        for other in list(self.clients.values()):
+            self._setEvents(other)
+        return client.stream
+
+    def _endStream(self, client):
+        """
+        Called when the data block of a client is complete: sends what
+        waited for it, and reads the other clients again
+        """
+        client.stream = self._nodeStream = None
+        while self._backlog:
+            msgType, kw = self._backlog.popleft()
+            FCPNode._txMsg(self, msgType, **kw)
+        for other in list(self.clients.values()):
+            self._setEvents(other)
+
+    def _txMsg(self, msgType, **kw):
+        """
+        Sends a message to the node, or keeps it until the data block
+        going to the node is complete
+        """
+        if self._nodeStream is not None:
+            self._backlog.append((msgType, kw))
+            return
+        FCPNode._txMsg(self, msgType, **kw)
+
+    def _fromClient(self, client, msg):
+        """
+        Does the routing for a message from a client, and answers what
+        the gateway answers itself
+
+        Returns the fields to send on to the node, with the header
+        under 'header', or None if there is nothing to send.
+        """
+        hdr = msg['header']
+        msg = dict(msg)
+
+        if self.verbosity >= DEBUG:
+            self._log(DEBUG, "gateway: %s sent %s %s" % (
+                client, hdr, msg.get('Identifier')))
+
+        if hdr == 'ClientHello':
+            self._sendToClient(client, self.nodeHello)
+            return None
+
+        if hdr == 'WatchGlobal':
+            # enable the global queue while anybody wants it
+            want = str(msg.get('Enabled', 'true')).lower() == 'true'
+            if want == client.watchGlobal:
+                return None
+            client.watchGlobal = want
+            self._watchers += 1 if want else -1
+            if self._watchers == (1 if want else 0):
+                # restored by FCPNode._reconnect()
+                self._watchingGlobal = want
+                self._txMsg(hdr, Enabled=want and "true" or "false")
+            return None
+
+        if hdr == 'ListPersistentRequests':
+            self._listers.append(client)
+
+        id = msg.get('Identifier', None)
+        if id is not None:
+            if self._isClientScoped(msg):
+                id = msg['Identifier'] = client.prefix + id
+            self._route(client, id)
+            if hdr in requestCommands and id.startswith(client.prefix):
+                client.active[id] = msg.get('ReturnType', None)
+
+        if 'Directory' in msg and hdr.startswith('TestDDA'):
+            self._route(client, ('Directory', msg['Directory']))
+
+        return msg
+
+    def _on_rxMsg(self, msg):
+        """
+        Routes a message from the node to the client it is meant for
+        """
+        hdr = msg['header']
+        id = msg.get('Identifier', None)
+
+        if hdr == 'CloseConnectionDuplicateClientName':
+            self._log(ERROR, "gateway: another client called %s connected "
+                             "to the node" % self.name)
+            return
+
+        if id is not None and id in self.jobs:
+            # one of our own
+            FCPNode._on_rxMsg(self, msg)
+            return
+
+        client = None
+        if id is not None:
+            client = self._routes.get(id, None)
+        if client is None and 'Directory' in msg:
+            client = self._routes.get(('Directory', msg['Directory']), None)
+
+        if client is not None:
+            if id is not None and id.startswith(client.prefix):
+                if hdr in finalReplies \
+                or (hdr == 'DataFound' and client.active.get(id) != 'direct'):
+                    client.active.pop(id, None)
+                msg = dict(msg, Identifier=id[len(client.prefix):])
+            self._sendToClient(client, msg)
+            return
+
+        if hdr == 'EndListPersistentRequests':
+            if self._listers:
+                lister = self._listers.popleft()
+                if lister is None:
+                    # the listing we asked for when we reconnected
+                    FCPNode._on_rxMsg(self, msg)
+                else:
+                    self._sendToClient(lister, msg)
+            return
+
+        # nobody in particular, so everybody who listens
+        listeners = set(c for c in self._listers if c is not None)
+        listeners.update(c for c in self.clients.values() if c.watchGlobal)
+        if not listeners:
+            self._log(DETAIL, "gateway: dropping %s for %s" % (hdr, id))
+        for client in listeners:
+            self._sendToClient(client, msg)
+
+    def _sendToClient(self, client, msg):
+        """
+        Queues a message for a client, and sends as much of what is
+        queued as the client takes without waiting
+        """
+        fields = dict(msg)
+        hdr = fields.pop('header')
+        data = fields.pop('Data', None)
+        if data is not None:
+            data = memoryview(data).cast("B")
+            fields.pop('DataLength', None)
+            raw = encodeMessage(hdr, fields, len(data))
+        else:
+            raw = encodeMessage(hdr, fields)
+        client.outbox.append(memoryview(raw))
+        if data:
+            client.outbox.append(data)
+        self._flushClient(client)
+
+    def _flushClient(self, client):
+        """
+        Sends what is queued for a client until its socket is full, and
+        drops the client if it took nothing for clientTimeout seconds
+        """
+        outbox = client.outbox
+        while outbox:
+            try:
+                n = client.sock.send(outbox[0])
+            except (BlockingIOError, InterruptedError):
+                break
+            except OSError as e:
+                self._log(DETAIL, "gateway: cannot send to %s: %s" % (client, e))
+                self._dropClient(client)
+                return
+            if n == len(outbox[0]):
+                outbox.popleft()
+            else:
+                outbox[0] = outbox[0][n:]
+            client.stalledSince = None
+
+        if outbox:
+            now = time.monotonic()
+            if client.stalledSince is None:
+                client.stalledSince = now
+            elif now - client.stalledSince > clientTimeout:
+                self._log(DETAIL, "gateway: %s reads nothing, dropping it" % client)
+                self._dropClient(client)
+                return
+        self._setEvents(client)
+
+    def _setEvents(self, client):
+        """
+        Selects a client's socket for writing while it has messages
+        queued, and for reading unless another client's data block is
+        going to the node
+        """
+        events = selectors.EVENT_WRITE if client.outbox else 0
+        if self._nodeStream is None or client.stream is not None:
+            events |= selectors.EVENT_READ
+        if events == client.events:
+            return
+        if not client.events:
+            self._selector.register(client.sock, events, self._on_clientEvent)
+        elif not events:
+            self._selector.unregister(client.sock)
+        else:
+            self._selector.modify(client.sock, events, self._on_clientEvent)
+        client.events = events
+
+    def _drainClientReqs(self):
+        """
+        Sends the queued requests, and looks after clients which leave
+        their messages unread, once per turn of the manager loop
+        """
+        FCPNode._drainClientReqs(self)
+        for client in [c for c in self.clients.values() if c.outbox]:
+            self._flushClient(client)
+
+    def _route(self, client, key):
+        """
+        Sends replies for the given identifier or directory to client
+        """
+        old = self._routes.get(key, None)
+        if old is not None and old is not client:
+            old.routes.discard(key)
+        self._routes[key] = client
+        client.routes.add(key)
+
+    def _dropClient(self, client):
+        """
+        Forgets a client, and cancels its unfinished transient requests
+        """
+        if self.clients.pop(client.sock, None) is None:
+            return
+        try:
+            self._selector.unregister(client.sock)
+        except (KeyError, ValueError):
+            pass
+        client.sock.close()
+        client.outbox.clear()
+
+        if client.stream is not None:
+            self._abortStream(client)
+
+        for key in client.routes:
+            if self._routes.get(key, None) is client:
+                del self._routes[key]
+
+        if client in self._listers:
+            self._listers.remove(client)
+
+        if client.watchGlobal:
+            client.watchGlobal = False
+            self._watchers -= 1
+            if not self._watchers:
+                self._watchingGlobal = False
+                if self.nodeIsAlive:
+                    self._txMsg('WatchGlobal', Enabled="false")
+
+        # the node would have dropped them along with the client's own
+        # connection
+        if self.nodeIsAlive:
+            for id in client.active:
+                self._txMsg('RemoveRequest', Identifier=id, Global="false")
+
+        self._log(DETAIL, "gateway: %s disconnected" % client)
+
+    def _abortStream(self, client):
+        """
+        Finishes the data block of a client which went away in the
+        middle of it, so that the node connection stays in step, and
+        removes the request it belongs to
+        """
+        stream = client.stream
+        try:
+            if not self.nodeIsAlive:
+                raise OSError("not connected")
+            while stream.left > 0:
+                stream.write(_zeros[:min(stream.left, len(_zeros))])
+        except OSError as e:
+            # the manager loop finds out about the node on its next read
+            self._log(ERROR, "gateway: cannot send to node: %s" % e)
+            self._backlog.clear()
+            self._endStream(client)
+            return
+        self._endStream(client)
+        # connection-scoped requests are removed along with the others
+        if stream.id is not None and stream.id not in client.active:
+            self._txMsg('RemoveRequest', Identifier=stream.id,
+                        Global=stream.isGlobal and "true" or "false")
+
+    def _reconnect(self, exc):
+        """
+        Gets back to the node as FCPNode does, failing the clients'
+        requests which the node forgot along with the connection, and
+        asking again for the listings clients were waiting for
+        """
+        # nothing more goes to the old connection
+        self.nodeIsAlive = False
+        waiting = [c for c in self._listers if c is not None]
+        self._listers.clear()
+        for client in list(self.clients.values()):
+            for id in list(client.active):
+                if client.sock not in self.clients:
+                    break
+                if self._routes.get(id, None) is client:
+                    del self._routes[id]
+                client.routes.discard(id)
+                self._sendToClient(client, {
+                    'header': 'ProtocolError',
+                    'Identifier': id[len(client.prefix):],
+                    'Global': "false",
+                    'Code': "17",
+                    'CodeDescription': "Internal error",
+                    'ExtraDescription': "gateway lost its connection "
+                                        "to the node: %s" % exc,
+                    'Fatal': "false"})
+            client.active.clear()
+
+        # FCPNode._reconnect() asks for a listing of its own
+        self._listers.append(None)
+        if not FCPNode._reconnect(self, exc):
+            return False
+        for client in waiting:
+            if client.sock in self.clients:
+                self._listers.append(client)
+                self._txMsg('ListPersistentRequests')
+        return True
+
+    def _hello(self):
+        """
+        Does the handshake with the node, keeping its reply for clients
+        """
+        # a new connection is in step, whatever the old one was in
+        # the middle of
+        self._nodeStream = None
+        self._backlog.clear()
+        for client in list(self.clients.values()):
+            self._setEvents(client)
+        self.nodeHello = FCPNode._hello(self)
+        return self.nodeHello
+
+    def _isClientScoped(self, msg):
+        """
+        Whether a request lives and dies with the client's connection
+        """
+        return (str(msg.get('Persistence', 'connection')) == 'connection'
+                and str(msg.get('Global', 'false')).lower() != 'true')
+
+
+def main():
+    """
+    Front end for the fcpgateway utility
+    """
+    parser = argparse.ArgumentParser(
+        prog='fcpgateway',
+        description='''
+            Share one connection to a freenet node between many FCP
+            clients. The fcp command-line tools use the gateway when
+            it is running.
+        ''',
+    )
+    parser.add_argument(
+        '--fcpHost', '-H', default=node.defaultFCPHost,
+        help='Connect to FCP service at host <FCPHOST>.')
+    parser.add_argument(
+        '--fcpPort', '-P', default=node.defaultFCPPort, type=int,
+        help='Connect to FCP service at port <FCPPORT>.')
+    parser.add_argument(
+        '--socket', '-s', default=None,
+        help='Listen on this socket instead of the default for the node.')
+    parser.add_argument(
+        '--verbose', '-v', action='append_const', const=1, default=[],
+        help='Increase verbosity of the output')
+    args = parser.parse_args()
+
+    try:
+        gw = FCPGateway(host=args.fcpHost, port=args.fcpPort,
+                        path=args.socket,
+                        verbosity=ERROR + sum(args.verbose),
+                        logfile=sys.stderr)
+    except Exception as e:
+        sys.stderr.write("fcpgateway: %s\n" % e)
+        sys.exit(1)
+
+    # leave cleanly on kill, so the socket file is removed
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    try:
+        gw.serveForever()
+    except (KeyboardInterrupt, SystemExit):
+        pass
+    finally:
+        gw.shutdown()
+
+
+if __name__ == '__main__':
+    main()
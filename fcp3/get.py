@@ -115,7 +115,8 @@ def main(argv=sys.argv[1:]):
                          port=args.fcpPort,
                          Global=args.global_queue,
                          verbosity=verbosity,
-                         logfile=sys.stderr)
+                         logfile=sys.stderr,
+                         gateway=True)
     except:
         if verbose:
             traceback.print_exc(file=sys.stderr)
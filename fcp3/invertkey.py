@@ -53,7 +53,7 @@ def main():
     # try to create the node
     try:
         n = node.FCPNode(host=args.fcpHost, port=args.fcpPort, verbosity=verbosity,
-                         logfile=sys.stderr)
+                         logfile=sys.stderr, gateway=True)
     except:
         if verbose:
             traceback.print_exc(file=sys.stderr)
@@ -0,0 +1,307 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+"""
+The links between the files of a freesite.
+
+SiteState.markManifestFiles() puts the files a visitor needs first into
+the manifest. To find them, LinkGraph reads the HTML and CSS files of
+the site once, and records which files each of them refers to:
+    - embedded links, which the browser loads along with the page:
+      stylesheets, scripts, images, frames, and the url()s and @imports
+      of stylesheets
+    - navigation links, which the visitor follows: <a href>, <area href>
+      and the like
+
+depths() then walks the graph from the index. A file's depth is the
+number of navigation links needed to reach it, so the index and
+everything it embeds have depth 0, the pages it links to and their
+resources have depth 1, and so on.
+
+Parsing a file gives the same links for the same content, so they are
+kept by the hash of the content: in memory, and in the 'links' entry
+of the file's record, which the site saves with its state. So a new
+insert of a site, also in a new process, parses only the files which
+changed.
+
+    >>> graph = LinkGraph()
+    >>> pages = {
+    ...     'index.html': b'<link rel=stylesheet href="style.css"><a href="a/page.html#top">a</a>',
+    ...     'style.css': b'body { background: url("img/bg.png") }',
+    ...     'a/page.html': b'<img src="../img/photo.jpg"><a href="http://example.org/">x</a>',
+    ... }
+    >>> recs = [{'name': name, 'mimetype': 'text/html'} for name in pages]
+    >>> recs[1]['mimetype'] = 'text/css'
+    >>> recs += [{'name': 'img/bg.png'}, {'name': 'img/photo.jpg'}]
+    >>> graph.update(recs, lambda rec: pages[rec['name']])
+    >>> sorted(graph.depths('index.html').items())
+    [('a/page.html', 1), ('img/bg.png', 0), ('img/photo.jpg', 1), ('index.html', 0), ('style.css', 0)]
+    >>> recs[1]['links']['found']
+    [['img/bg.png', True]]
+"""
+
+import collections
+import hashlib
+import html.parser
+import posixpath
+import re
+import urllib.parse
+
+
+#: the mimetypes whose links are read, and how
+htmlMimetypes = frozenset(('text/html', 'application/xhtml+xml'))
+cssMimetypes = frozenset(('text/css',))
+
+# tag -> attributes which embed a file in the page
+_embedding = {
+    'img': ('src', 'srcset'),
+    'script': ('src',),
+    'iframe': ('src',),
+    'frame': ('src',),
+    'embed': ('src',),
+    'source': ('src', 'srcset'),
+    'audio': ('src',),
+    'video': ('src', 'poster'),
+    'track': ('src',),
+    'input': ('src',),
+    'object': ('data',),
+    'body': ('background',),
+    'table': ('background',),
+    'td': ('background',),
+}
+
+# tag -> attributes which link to another page
+_navigation = {
+    'a': ('href',),
+    'area': ('href',),
+}
+
+# the rel values of a <link> the browser loads with the page
+_embeddedRels = frozenset(('stylesheet', 'icon', 'shortcut', 'preload',
+                           'prefetch', 'modulepreload', 'apple-touch-icon'))
+
+_cssComment = re.compile(r"/\*.*?\*/", re.S)
+_cssLink = re.compile(
+    r"""url\(\s*(?:"([^"]*)"|'([^']*)'|([^)'"\s]*))\s*\)"""
+    r"""|@import\s+(?:"([^"]*)"|'([^']*)')""", re.I)
+_refresh = re.compile(r"url\s*=\s*['\"]?([^'\"\s;]+)", re.I)
+
+
+class LinkGraph:
+    """
+    The links between the files of a site, see the module docstring
+    """
+
+    def __init__(self):
+        # (kind, content hash) -> tuple of (link, embedded) as written
+        self._cache = {}
+        # name -> list of (name, embedded) within the site
+        self.links = {}
+
+
+    def update(self, recs, read, defaultName="index.html"):
+        """
+        Builds the graph for the files of a site
+
+        Arguments:
+            - recs - the file records, each with a 'name', and a
+              'mimetype' and a 'hash' of the content if known. The
+              links of a page are kept in its record under 'links'
+            - read - a function which returns the data of a record
+
+        Keywords:
+            - defaultName - the file a link to a directory goes to
+        """
+        recs = list(recs)
+        names = set(rec['name'] for rec in recs)
+        cache = {}
+        self.links = {}
+        for rec in recs:
+            kind = _kind(rec.get('mimetype', None), rec['name'])
+            if kind is None:
+                continue
+            key = rec.get('hash', None)
+            data = None
+            if not key:
+                data = read(rec)
+                key = hashlib.sha256(data).hexdigest()
+            stored = _storedLinks(rec, kind, key)
+            raw = self._cache.get((kind, key), stored)
+            if raw is None:
+                if data is None:
+                    data = read(rec)
+                raw = extractLinks(data, kind)
+            cache[(kind, key)] = raw
+            if stored != raw:
+                rec['links'] = {'hash': key, 'kind': kind,
+                                'found': [list(link) for link in raw]}
+
+            name = rec['name']
+            targets = []
+            for link, embedded in raw:
+                target = resolve(name, link, names, defaultName)
+                if target is not None and target != name:
+                    targets.append((target, embedded))
+            self.links[name] = targets
+        # forget the content which is gone
+        self._cache = cache
+
+
+    def depths(self, root):
+        """
+        Returns a dict of the depth of every file reachable from root
+
+        Following an embedded link costs nothing, a navigation link
+        costs one, so this is a breadth first walk with the embedded
+        links at the front of the queue.
+        """
+        depths = {root: 0}
+        queue = collections.deque([root])
+        while queue:
+            name = queue.popleft()
+            depth = depths[name]
+            for target, embedded in self.links.get(name, ()):
+                targetDepth = depth if embedded else depth + 1
+                if depths.get(target, targetDepth + 1) <= targetDepth:
+                    continue
+                depths[target] = targetDepth
+                if embedded:
+                    queue.appendleft(target)
+                else:
+                    queue.append(target)
+        return depths
+
+
+
+def extractLinks(data, kind):
+    """
+    Returns the links in the data of an 'html' or 'css' file, as a
+    tuple of (link, embedded)
+
+    >>> extractLinks(b'<p style="background: url(p.png)"><a href=x.html>x</a>', 'html')
+    (('p.png', True), ('x.html', False))
+    >>> extractLinks(b'@import "base.css"; /* url(old.png) */ h1 { background: url(h.png) }', 'css')
+    (('base.css', True), ('h.png', True))
+    """
+    text = data.decode("utf-8", errors="replace")
+    if kind == 'css':
+        return tuple((link, True) for link in _cssLinks(text))
+    parser = _LinkParser()
+    try:
+        parser.feed(text)
+        parser.close()
+    except Exception:
+        # keep what was found before the broken markup
+        pass
+    return tuple(parser.found)
+
+
+def resolve(base, link, names, defaultName="index.html"):
+    """
+    Returns the name of the file in names which a link in the file base
+    refers to, or None for a link outside the site
+
+    >>> names = {'index.html', 'a/b.html', 'a/index.html', 'c d.png'}
+    >>> resolve('a/b.html', '../c%20d.png?x=1', names)
+    'c d.png'
+    >>> resolve('a/b.html', './', names), resolve('a/b.html', '/USK@x/y/1/', names)
+    ('a/index.html', None)
+    """
+    parts = urllib.parse.urlsplit(link.strip())
+    if parts.scheme or parts.netloc:
+        return None
+    path = urllib.parse.unquote(parts.path)
+    if not path or path.startswith('/'):
+        # the page itself, or the root of the node
+        return None
+    name = posixpath.normpath(posixpath.join(posixpath.dirname(base), path))
+    if name == '..' or name.startswith('../'):
+        return None
+    if name in names:
+        return name
+    name = defaultName if name == '.' else posixpath.join(name, defaultName)
+    if name in names:
+        return name
+    return None
+
+
+def _storedLinks(rec, kind, key):
+    """
+    Returns the links kept in a record for the content with hash key,
+    or None
+    """
+    stored = rec.get('links', None)
+    if (not isinstance(stored, dict) or stored.get('hash', None) != key
+            or stored.get('kind', None) != kind):
+        return None
+    return tuple((link, bool(embedded)) for link, embedded in stored['found'])
+
+
+def _kind(mimetype, name):
+    """
+    Returns 'html' or 'css' for the files whose links are read
+    """
+    mimetype = (mimetype or '').split(';')[0].strip().lower()
+    lower = name.lower()
+    if mimetype in htmlMimetypes or lower.endswith(('.html', '.htm', '.xhtml')):
+        return 'html'
+    if mimetype in cssMimetypes or lower.endswith('.css'):
+        return 'css'
+    return None
+
+
+def _cssLinks(text):
+    for match in _cssLink.finditer(_cssComment.sub('', text)):
+        link = next((group for group in match.groups() if group), None)
+        if link and not link.startswith('data:'):
+            yield link
+
+
+
+class _LinkParser(html.parser.HTMLParser):
+    """
+    Collects the links of an HTML page into found
+    """
+
+    def __init__(self):
+        html.parser.HTMLParser.__init__(self, convert_charrefs=True)
+        self.found = []
+        self._inStyle = False
+
+
+    def handle_starttag(self, tag, attrs):
+        attrs = dict((key, value) for key, value in attrs if value)
+        for attr in _embedding.get(tag, ()):
+            if attr in attrs:
+                if attr == 'srcset':
+                    for candidate in attrs[attr].split(','):
+                        if candidate.split():
+                            self.found.append((candidate.split()[0], True))
+                else:
+                    self.found.append((attrs[attr], True))
+        for attr in _navigation.get(tag, ()):
+            if attr in attrs:
+                self.found.append((attrs[attr], False))
+        if tag == 'link' and 'href' in attrs:
+            rels = set(attrs.get('rel', '').lower().split())
+            self.found.append((attrs['href'], bool(rels & _embeddedRels)))
+        elif tag == 'meta' and attrs.get('http-equiv', '').lower() == 'refresh':
+            match = _refresh.search(attrs.get('content', ''))
+            if match:
+                self.found.append((match.group(1), False))
+        elif tag == 'style':
+            self._inStyle = True
+        if 'style' in attrs:
+            self.found.extend((link, True) for link in _cssLinks(attrs['style']))
+
+    handle_startendtag = handle_starttag
+
+
+    def handle_endtag(self, tag):
+        if tag == 'style':
+            self._inStyle = False
+
+
+    def handle_data(self, data):
+        if self._inStyle:
+            self.found.extend((link, True) for link in _cssLinks(data))
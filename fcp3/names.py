@@ -461,7 +461,8 @@ def main():
     try:
         n = node.FCPNode(host=fcpHost, port=fcpPort, verbosity=verbosity,
                          logfile=sys.stderr,
-                         namesitefile=cfgfile)
+                         namesitefile=cfgfile,
+                         gateway=True)
     except:
         if verbose:
             traceback.print_exc(file=sys.stderr)
@@ -19,14 +19,18 @@ For FCP documentation, see http://wiki.freenetproject.org/FCPv2
 
 import queue
 import base64
+import collections
+import concurrent.futures
+import functools
 import mimetypes
 import os
 import pprint
 import random
-import select
+import selectors
 import hashlib
 import socket
 import stat
+import struct
 import sys
 import tempfile # for doctests
 import _thread
@@ -37,8 +41,8 @@ import re
 import unicodedata
 
 from . import pseudopythonparser
-
-_pollInterval = 0.03
+from .codec import FCPMessageDecoder, FCPDecodeError, encodeMessage
+from .scheduler import RequestScheduler
 
 
 class ConnectionRefused(Exception):
@@ -108,6 +112,12 @@ class FCPNameLookupFailure(Exception):
     name services name lookup failed
     """
 
+
+class GatewayNotPrivate(ConnectionError):
+    """
+    a gateway socket, or its directory, could be used by other users
+    """
+
     
 # where we can find the freenet node FCP port
 defaultFCPHost = "127.0.0.1"
@@ -121,21 +131,24 @@ if "FCP_HOST" in os.environ:
 if "FCP_PORT" in os.environ:
     defaultFCPPort = int(os.environ["FCP_PORT"].strip())
 
+# directory holding the sockets of FCP gateways (see fcp3.gateway). It
+# must belong to the user and be closed to everybody else, so outside
+# of XDG_RUNTIME_DIR it is a directory of our own in the temp dir.
+defaultGatewayDir = os.environ.get(
+    "FCP_GATEWAY_DIR",
+    os.environ.get("XDG_RUNTIME_DIR",
+                   os.path.join(tempfile.gettempdir(), "fcp3-gateway-%s" % (
+                       getattr(os, "getuid", lambda: 0)(),))))
+
 # ditto for fproxy host/port
 if "FPROXY_HOST" in os.environ:
     defaultFProxyHost = os.environ["FPROXY_HOST"].strip()
 if "FPROXY_PORT" in os.environ:
     defaultFProxyPort = int(os.environ["FPROXY_PORT"].strip())
 
-# poll timeout period for manager thread
-pollTimeout = 0.1
-#pollTimeout = 3
-
-# list of keywords sent from node to client, which have
-# int values
-intKeys = [
-    'DataLength', 'Code',
-    ]
+# longest time the manager thread sleeps when nothing happens; it is
+# woken up right away by node messages, client requests and shutdown
+idleTimeout = 5.0
 
 # for the FCP 'ClientHello' handshake
 expectedVersion="2.0"
@@ -157,6 +170,35 @@ defaultVerbosity = ERROR
 
 ONE_YEAR = 86400 * 365
 
+# size of the chunks in which data payloads are read from file objects
+dataChunkSize = 256 * 1024
+
+# size of the chunks in which files are read for hashing; hashlib lets
+# other threads run while it hashes a chunk
+hashChunkSize = 1024 * 1024
+
+# default cap on the bytes of data the inserts run by putmany() and
+# putdir() may have in flight between them
+maxInflightBytes = 64 * 1024 * 1024
+
+# with FCPNode(reconnect=True), how long to wait between attempts to
+# get back to the node; the wait doubles up to reconnectMaxDelay
+reconnectDelay = 1.0
+reconnectMaxDelay = 60.0
+
+# failure codes which tell an AdaptiveLimiter that the node or the
+# network are overloaded: RouteNotFound and RejectedOverload, of gets
+# and of inserts
+overloadGetCodes = (14, 15)
+overloadPutCodes = (4, 5, 8)
+
+# and the GetNode volatile statistics which do, with the values above
+# which they do, in milliseconds
+overloadLoadFields = {
+    'volatile.bwlimitDelayTime': 2000,
+    'volatile.averagePingTime': 1500,
+    }
+
 fcpVersion = "0.3.4"
 
 
@@ -220,6 +262,11 @@ class FCPNode:
     nodeIsTestnet = None;
     compressionCodecs = [("GZIP", 0), ("BZIP2", 1), ("LZMA", 2)]; # safe defaults
 
+    # whether decoded node messages get ints for numeric values
+    _convertInts = True
+    
+    # our persistent jobs the node has yet to list after a reconnect
+    _unlisted = None
     
 
     def __init__(self, **kw):
@@ -241,10 +288,38 @@ class FCPNode:
               (silence)
             - socketTimeout - value to pass to socket object's settimeout() if
               available and the value is not None, defaults to None
+            - gateway - talk to the node through a running fcp3 gateway
+              (see fcp3.gateway) instead of opening a connection of our own.
+              True uses the gateway for host:port if one is listening and
+              connects directly otherwise; a pathname uses the gateway
+              listening on that socket, and fails if there is none.
+              Defaults to None, which always connects directly
+            - reconnect - if the connection to the node is lost, connect
+              again under the same name instead of failing every job.
+              Only connection-scoped jobs fail; persistent and global
+              jobs are picked up again from the node. Defaults to False
+            - reconnectDelay - seconds to wait before the second attempt
+              to reconnect, doubling with every failed attempt, defaults
+              to reconnectDelay
+            - reconnectMaxDelay - the longest wait between attempts,
+              defaults to reconnectMaxDelay
+            - priorityWeights - a dict of the share of sends each
+              PriorityClass gets while requests of several classes wait,
+              overriding scheduler.classWeights
+            - inflightLimits - a dict of the most requests of each
+              PriorityClass to have running on the node at once,
+              defaults to no limits
+            - maxCompletedJobs - how many completed jobs to keep in jobs,
+              where persistent, global and keep=True jobs stay after they
+              complete; the oldest are evicted first. Defaults to None,
+              which keeps them all
+            - completedJobTTL - evict completed jobs from jobs after this
+              many seconds, defaults to None, which keeps them
     
         Attributes of interest:
-            - jobs - a dict of currently running jobs (persistent and nonpersistent).
-              keys are job ids and values are JobTicket objects
+            - jobs - a JobRegistry of currently running jobs (persistent and
+              nonpersistent). keys are job ids and values are JobTicket
+              objects, or JobRecord objects for requests we did not start
     
         Notes:
             - when the connection is created, a 'hello' handshake takes place.
@@ -286,36 +361,55 @@ class FCPNode:
         self.logfunc = logfunc
         self.verbosity = kw.get('verbosity', defaultVerbosity)
     
-        # try to connect to node
-        self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        if(None != self.socketTimeout):
-            try:
-                self.socket.settimeout(self.socketTimeout)
-            except Exception as e:
-                # Socket timeout setting is not available until Python 2.3, so ignore exceptions
-                pass
-        try:
-            self.socket.connect((self.host, self.port))
-        except Exception as e:
-            raise type(e)(
-                "Failed to connect to %s:%s - %s" % (
-                    self.host, self.port, e)).with_traceback(
-                        sys.exc_info()[2])
-            
-        # now do the hello
-        self._hello()
+        # how messages from the node are handled, by header
+        self._initHandlers()
+    
+        # decoder for the byte stream from the node, and the messages
+        # it decoded which have not been handled yet
+        self._decoder = FCPMessageDecoder(streamFor=self._streamFor,
+                                          convertInts=self._convertInts)
+        self._rxQueue = collections.deque()
+    
+        # how to get back to the node if the connection drops
+        self.reconnect = kw.get('reconnect', False)
+        self.reconnectDelay = kw.get('reconnectDelay', reconnectDelay)
+        self.reconnectMaxDelay = kw.get('reconnectMaxDelay', reconnectMaxDelay)
+        self.reconnects = 0
+        self._reconnecting = False
+        self._watchingGlobal = False
+    
+        # connect, through the gateway if asked to, and do the hello
+        self._gatewayOpt = kw.get('gateway', None)
+        self._connect()
         self.nodeIsAlive = True
     
         # the pending job tickets
-        self.jobs = {} # keyed by request ID
+        self.jobs = JobRegistry( # keyed by request ID
+            maxCompleted=kw.get('maxCompletedJobs', None),
+            completedTTL=kw.get('completedJobTTL', None))
         self.keepJobs = [] # job ids that should never be removed from self.jobs
     
-        # queue for incoming client requests
-        self.clientReqQueue = queue.Queue()
+        # queue for incoming client requests, which sends interactive
+        # ones first and shares the rest between the priority classes
+        self.clientReqQueue = RequestScheduler(
+            weights=kw.get('priorityWeights', None),
+            limits=kw.get('inflightLimits', None),
+            wakeup=self._wakeup)
+    
+        # the manager thread sleeps on both the node socket and this
+        # socket pair, so that submitting a request wakes it at once
+        self._wakeReader, self._wakeWriter = socket.socketpair()
+        self._wakeReader.setblocking(False)
+        self._wakeWriter.setblocking(False)
+        self._selector = selectors.DefaultSelector()
+        self._selector.register(self.socket, selectors.EVENT_READ, "node")
+        self._selector.register(self._wakeReader, selectors.EVENT_READ, "wake")
     
         # launch receiver thread
         self.running = True
         self.shutdownLock = threading.Lock()
+        # held on behalf of the manager thread until it terminates
+        self.shutdownLock.acquire()
         _thread.start_new_thread(self._mgrThread, ())
     
         # and set up the name service
@@ -450,6 +544,8 @@ class FCPNode:
               resources by retrieving it
             - stream - if given, this is a writeable file object, to which the
               received data should be written a chunk at a time
+            - streamflush - with stream, flush it after every this many
+              bytes; default 0, which flushes once after all data is in
             - timeout - timeout for completion, in seconds, default one year
     
         Returns a 3-tuple, depending on keyword args:
@@ -507,6 +603,7 @@ class FCPNode:
         elif 'stream' in kw:
             opts['ReturnType'] = "direct"
             opts['stream'] = kw['stream']
+            opts['streamflush'] = kw.get('streamflush', 0)
         else:
             nodata = False
             opts['ReturnType'] = "direct"
@@ -560,6 +657,249 @@ class FCPNode:
         return self._submitCmd(id, "ClientGet", **opts)
     
 
+    def getmany(self, uris, concurrency=10, **kw):
+        """
+        Gets many keys, with a bounded number of requests in flight
+        
+        Arguments:
+            - uris - an iterable of uris. Any item may instead be a tuple
+              (uri, opts), where opts is a dict of get() keywords for just
+              that key, such as file or stream to write the key's data
+              straight to disk. It is only consumed as requests complete,
+              so it may be a generator of any length
+        
+        Keywords:
+            - concurrency - how many gets to have running at once,
+              default 10, or an AdaptiveLimiter to let the number follow
+              the node's load
+            - timeout - how many seconds each get may take, default one
+              year. Gets which take longer are cancelled and yield an
+              FCPNodeTimeout
+            - other keywords are passed to get() for every key, such as
+              nodata or dsonly to check which keys are retrievable
+        
+        Returns a generator which yields a tuple (uri, result) for each
+        key, in the order the gets complete. The result is what get()
+        would have returned, or the exception it would have raised.
+        
+        Closing the generator early cancels the gets still running.
+        
+        Example:
+            for uri, result in node.getmany(keys, concurrency=50, nodata=True):
+                if not isinstance(result, Exception):
+                    print(uri, "is retrievable")
+        """
+        kw.pop('async', None)
+        timeout = kw.pop('timeout', ONE_YEAR)
+    
+        def requests():
+            for item in uris:
+                if isinstance(item, tuple):
+                    uri, keyOpts = item
+                    opts = dict(kw)
+                    # where the data goes is up to the key
+                    if 'file' in keyOpts or 'stream' in keyOpts \
+                    or 'nodata' in keyOpts:
+                        for k in ('file', 'stream', 'nodata'):
+                            opts.pop(k, None)
+                    opts.update(keyOpts)
+                else:
+                    uri = item
+                    opts = dict(kw)
+                opts.pop('async', None)
+                keyTimeout = opts.pop('timeout', timeout)
+                opts['async'] = True
+                yield uri, functools.partial(self.get, uri, **opts), 0, keyTimeout
+    
+        return self._runMany(requests(), concurrency)
+    
+
+    def putmany(self, items, concurrency=10, max_inflight_bytes=maxInflightBytes, **kw):
+        """
+        Inserts many keys, bounding both the requests and the bytes in
+        flight
+        
+        Arguments:
+            - items - an iterable of tuples (uri, data) or (uri, data, opts).
+              data is either the pathname of a file to insert, which is
+              only opened when its insert starts and is then streamed to
+              the node, or anything put() takes as data: bytes, a file
+              object or an iterable of chunks. Text must be encoded first.
+              opts is a dict of put() keywords for just that key. The
+              items are only consumed as inserts complete, so they may
+              come from a generator of any length
+        
+        Keywords:
+            - concurrency - how many inserts to have running at once,
+              default 10, or an AdaptiveLimiter to let the number follow
+              the node's load
+            - max_inflight_bytes - how many bytes of data the running
+              inserts may have between them, default 64MiB. An insert
+              bigger than this still runs, but on its own
+            - timeout - how many seconds each insert may take, default
+              one year. Inserts which take longer are cancelled and yield
+              an FCPNodeTimeout
+            - other keywords are passed to put() for every key, such as
+              mimetype, priority or chkonly
+        
+        Returns a generator which yields a tuple (uri, result) for each
+        item, as the node reports the inserts done. The result is the URI
+        the data was inserted under, or the exception put() would have
+        raised.
+        
+        Closing the generator early cancels the inserts still running.
+        """
+        kw.pop('async', None)
+        timeout = kw.pop('timeout', ONE_YEAR)
+    
+        def requests():
+            for item in items:
+                if len(item) == 3:
+                    uri, data, keyOpts = item
+                    opts = dict(kw, **keyOpts)
+                else:
+                    uri, data = item
+                    opts = dict(kw)
+                opts.pop('async', None)
+                keyTimeout = opts.pop('timeout', timeout)
+                opts['async'] = True
+                try:
+                    if isinstance(data, (str, os.PathLike)):
+                        size = os.path.getsize(data)
+                        submit = functools.partial(self._putPath, uri, data, opts)
+                    else:
+                        size = opts.get('datalength', None)
+                        if size is None:
+                            size = getDataLength(data)
+                        submit = functools.partial(self.put, uri, data=data, **opts)
+                except (OSError, ValueError) as e:
+                    # reported like a failed insert
+                    size = 0
+                    submit = functools.partial(_raise, e)
+                yield uri, submit, size, keyTimeout
+    
+        return self._runMany(requests(), concurrency, max_inflight_bytes)
+    
+
+    def _putPath(self, uri, path, opts):
+        """
+        Starts inserting a file, which stays open until the insert is done
+        """
+        opts = dict(opts)
+        if opts.get('mimetype', None) is None and not os.path.splitext(uri)[1]:
+            # like put(file=path), go by the file's name
+            opts['mimetype'] = guessMimetype(os.path.basename(path))
+        f = open(path, "rb")
+        try:
+            job = self.put(uri, data=f, **opts)
+        except:
+            f.close()
+            raise
+        job.add_done_callback(lambda job: f.close())
+        return job
+    
+
+    def _runMany(self, requests, concurrency, maxBytes=None):
+        """
+        Runs requests, with at most concurrency of them and maxBytes of
+        their data in flight at a time
+        
+        Arguments:
+            - requests - an iterable of tuples (key, submit, size, timeout),
+              where submit() starts a request and returns its JobTicket
+            - concurrency - a number, or an AdaptiveLimiter to take the
+              room for each request from
+        
+        Yields (key, result or exception) for each request, as they
+        complete. The jobs may belong to other nodes than this one, as
+        for FCPCluster.
+        """
+        if isinstance(concurrency, AdaptiveLimiter):
+            limiter = concurrency
+        else:
+            limiter = None
+    
+        # jobs are put here by the manager thread as they complete
+        completed = queue.Queue()
+        # job -> (key, size, deadline, limiter token)
+        inflight = {}
+        inflightBytes = 0
+        pending = iter(requests)
+        nextReq = None
+    
+        try:
+            while True:
+                # keep the pipeline full
+                while limiter is not None or len(inflight) < concurrency:
+                    if nextReq is None:
+                        try:
+                            nextReq = next(pending)
+                        except StopIteration:
+                            break
+                    key, submit, size, timeout = nextReq
+                    if maxBytes is not None and inflight \
+                    and inflightBytes + size > maxBytes:
+                        break
+                    token = None
+                    if limiter is not None:
+                        # others may hold all the room; wait for it
+                        # unless we have requests of our own to wait for
+                        token = limiter.acquire(blocking=not inflight)
+                        if token is None:
+                            break
+                    nextReq = None
+                    try:
+                        job = submit()
+                    except Exception as e:
+                        if token is not None:
+                            limiter.release(token)
+                        yield key, e
+                        continue
+                    inflight[job] = (key, size, time.monotonic() + timeout, token)
+                    inflightBytes += size
+                    job.add_done_callback(completed.put)
+    
+                if not inflight:
+                    return
+    
+                wait = min(req[2] for req in inflight.values())
+                wait = min(max(wait - time.monotonic(), 0), threading.TIMEOUT_MAX)
+                if limiter is not None:
+                    # look again for room the limiter may have made
+                    wait = min(wait, 1.0)
+                try:
+                    job = completed.get(timeout=wait)
+                except queue.Empty:
+                    # cancel every request which is over its time
+                    now = time.monotonic()
+                    for job, (key, size, deadline, token) in list(inflight.items()):
+                        if deadline <= now:
+                            del inflight[job]
+                            inflightBytes -= size
+                            e = FCPNodeTimeout("%s %s timed out" % (job.cmd, key))
+                            if token is not None:
+                                limiter.release(token, e)
+                            job.node._abandonJob(job, e)
+                            yield key, e
+                    continue
+    
+                if job not in inflight:
+                    # timed out already
+                    continue
+                key, size, deadline, token = inflight.pop(job)
+                inflightBytes -= size
+                if token is not None:
+                    limiter.release(token, job.result)
+                yield key, job.result
+    
+        finally:
+            for job, (key, size, deadline, token) in inflight.items():
+                if token is not None:
+                    limiter.release(token)
+                job.node._abandonJob(job, FCPException(
+                    "%s %s cancelled" % (job.cmd, key)))
+    
+
     def put(self, uri="CHK@", **kw):
         """
         Inserts a key
@@ -569,7 +909,9 @@ class FCPNode:
         
         Keywords - you must specify one of the following to choose an insert mode:
             - file - path of file from which to read the key data
-            - data - the raw data of the key as string
+            - data - the raw data of the key, as bytes, string or
+              memoryview, or a file object or an iterable of byte chunks
+              from which the data is streamed to the node
             - dir - the directory to insert, for freesite insertion
             - redirect - the target URI to redirect to
 
@@ -585,6 +927,11 @@ class FCPNode:
             - chkonly - only generate CHK, don't insert - default false
             - nocompress - do not compress on insert - default false
     
+        Keywords for 'data' mode:
+            - datalength - the number of bytes to send; mandatory if data
+              is an iterable of chunks or an unseekable file object,
+              otherwise taken from the data
+    
         Keywords for 'file', 'data' and 'redirect' modes:
             - mimetype - the mime type, default application/octet-stream
     
@@ -724,6 +1071,12 @@ class FCPNode:
         elif "data" in kw:
             opts["UploadFrom"] = "direct"
             opts["Data"] = kw['data']
+            # find the length now, so that unsized data fails here
+            # rather than in the manager thread
+            if kw.get('datalength', None) is not None:
+                opts["DataLength"] = int(kw['datalength'])
+            elif not isinstance(kw['data'], (str, bytes)):
+                opts["DataLength"] = getDataLength(kw['data'])
             targetFilename = kw.get('name')
             if targetFilename:
                 opts["TargetFilename"] = targetFilename
@@ -776,6 +1129,11 @@ class FCPNode:
               each constituent file, then performs the ClientPutComplexDir
               as a manifest full of redirects. You *must* use this mode
               if inserting from across a LAN
+            - direct - default False - if True, and filebyfile is not set,
+              sends the files with the ClientPutComplexDir command
+              instead of letting the node read them from disk, which
+              also works across a LAN. The files are read from disk one
+              after the other while the command is sent
     
             - maxretries - maximum number of retries, default 3
             - priority - the PriorityClass for retrieval, default 2, may be between
@@ -796,6 +1154,9 @@ class FCPNode:
               all files of the site will be inserted simultaneously, which can give
               a nice speed-up for small to moderate sites, but cruel choking on
               large sites; use with care
+            - maxconcurrent - how many files to insert at once, which sets
+              filebyfile and allatonce, default 10. May be an AdaptiveLimiter,
+              which adjusts the number to the node's load
             - globalqueue - perform the inserts on the global queue, which will
               survive node reboots
     
@@ -822,6 +1183,7 @@ class FCPNode:
         Verbosity = kw.get('Verbosity', 0)
         
         filebyfile = kw.get('filebyfile', False)
+        direct = kw.get('direct', False)
         
         #if filebyfile:
         #    raise Hell
@@ -965,94 +1327,59 @@ class FCPNode:
                 #raise Exception("debugging")
             
 
-        # for file-by-file mode, queue up the inserts and await completion
-        jobs = []
-        #allAtOnce = False
+        # for file-by-file mode, run the inserts and await completion
+        inserted = []
         
         if filebyfile:
             
             log(INFO, "putdir: starting file-by-file inserts")
         
             lastProgressMsgTime = time.time()
-
-            # insert each file, one at a time
             nTotal = len(manifest)
         
-            # output status messages, and manage concurrent inserts
-            while True:
-                # get progress counts
-                nQueued = len(jobs)
-                nComplete = len(
-                                [j for j in jobs if j.isComplete()]
-                                )
-                nWaiting = nTotal - nQueued
-                nInserting = nQueued - nComplete
+            # the files are streamed from disk, since we might be inserting
+            # to a remote FCP service (which means we can't use 'file='
+            # (UploadFrom=pathname) keyword)
+            putOpts = dict(Verbosity=Verbosity,
+                           chkonly=chkonly,
+                           priority=priority,
+                           Global=globalMode,
+                           persistence=persistence,
+                           **{"async": True})
+            def requests():
+                for filerec in manifest:
+                    log(INFO, "Launching insert of %s" % filerec['relpath'])
+                    opts = dict(putOpts, mimetype=filerec['mimetype'])
+                    yield (filerec,
+                           functools.partial(self._putPath, "CHK@",
+                                             filerec['fullpath'], opts),
+                           os.path.getsize(filerec['fullpath']),
+                           ONE_YEAR)
+        
+            # one at a time, unless asked to go faster
+            if allAtOnce:
+                concurrency = maxConcurrent
+            else:
+                concurrency = 1
+        
+            for filerec, result in self._runMany(requests(), concurrency,
+                                                 maxInflightBytes):
+                inserted.append((filerec, result))
+                log(INFO, "Insert finished for %s" % filerec['relpath'])
         
                 # spit a progress message every 10 seconds
                 now = time.time()
                 if now - lastProgressMsgTime >= 10:
-                    lastProgressMsgTime = time.time()
-                    log(INFO,
-                        "putdir: waiting=%s inserting=%s done=%s total=%s" % (
-                            nWaiting, nInserting, nComplete, nTotal)
-                        )
-        
-                # can bail if all done
-                if nComplete == nTotal:
-                    log(INFO, "putdir: all inserts completed (or failed)")
-                    break
-        
-                # wait and go round again if concurrent inserts are maxed
-                if nInserting >= maxConcurrent:
-                    time.sleep(_pollInterval)
-                    continue
-        
-                # just go round again if manifest is empty (all remaining are in progress)
-                if len(manifest) == 0:
-                    time.sleep(_pollInterval)
-                    continue
-        
-                # got >0 waiting jobs and >0 spare slots, so we can submit a new one
-                filerec = manifest.pop(0)
-                relpath = filerec['relpath']
-                fullpath = filerec['fullpath']
-                mimetype = filerec['mimetype']
-        
-                #manifestDict[relpath] = filerec
-        
-                log(INFO, "Launching insert of %s" % relpath)
-        
-        
-                # gotta suck raw data, since we might be inserting to a remote FCP
-                # service (which means we can't use 'file=' (UploadFrom=pathmae) keyword)
-                raw = open(fullpath, "rb").read()
-        
-                print("globalMode=%s persistence=%s" % (globalMode, persistence))
-        
-                # fire up the insert job asynchronously
-                job = self.put("CHK@",
-                               data=raw,
-                               mimetype=mimetype,
-                               waituntilsent=1,
-                               Verbosity=Verbosity,
-                               chkonly=chkonly,
-                               priority=priority,
-                               Global=globalMode,
-                               persistence=persistence,
-                               **{"async": 1}
-                               )
-                jobs.append(job)
-                filerec['job'] = job
-                job.filerec = filerec
-        
-                # wait for that job to finish if we are in the slow 'one at a time' mode
-                if not allAtOnce:
-                    job.wait()
-                    log(INFO, "Insert finished for %s" % relpath)
+                    lastProgressMsgTime = now
+                    log(INFO, "putdir: done=%s total=%s" % (
+                        len(inserted), nTotal))
         
             # all done
             log(INFO, "All raw files now inserted (or failed)")
         
+        else:
+            inserted = [(filerec, None) for filerec in manifest]
+        
         
         # now can build up a command buffer to insert the manifest
         msgLines = ["ClientPutComplexDir",
@@ -1070,15 +1397,16 @@ class FCPNode:
         # add each file's entry to the command buffer
         n = 0
         default = None
-        for job in jobs:
-            filerec = job.filerec
+        # the files sent with the command
+        payloads = []
+        for filerec, result in inserted:
             relpath = filerec['relpath']
             fullpath = filerec['fullpath']
             mimetype = filerec['mimetype']
         
             # don't add if the file failed to insert
             if filebyfile:
-                if isinstance(filerec['job'].result, Exception):
+                if isinstance(result, Exception):
                     log(ERROR, "File %s failed to insert" % relpath)
                     continue
         
@@ -1087,23 +1415,28 @@ class FCPNode:
             msgLines.extend(["Files.%d.Name=%s" % (n, relpath),
                              ])
             if filebyfile:
-                #uri = filerec['uri'] or filerec['job'].result
-                uri = job.result
+                uri = result
                 if not uri:
                     raise Exception("Can't find a URI for file %s" % filerec['relpath'])
         
                 msgLines.extend(["Files.%d.UploadFrom=redirect" % n,
                                  "Files.%d.TargetURI=%s" % (n, uri),
                                 ])
+            elif direct:
+                length = os.path.getsize(fullpath)
+                msgLines.extend(["Files.%d.UploadFrom=direct" % n,
+                                 "Files.%d.DataLength=%d" % (n, length),
+                                 "Files.%d.Metadata.ContentType=%s" % (n, mimetype),
+                                ])
+                payloads.append((fullpath, length))
             else:
                 msgLines.extend(["Files.%d.UploadFrom=disk" % n,
                                  "Files.%d.Filename=%s" % (n, fullpath),
                                 ])
             n += 1
         
-        # finish the command buffer
-        msgLines.append("EndMessage")
-        manifestInsertCmdBuf = "\n".join(msgLines) + "\n"
+        # finish the command, whose payloads are read as it is sent
+        manifestInsertCmd = complexDirCommand(msgLines, payloads)
         
         # gotta log the command buffer here, since it's not sent via .put()
         for line in msgLines:
@@ -1116,7 +1449,7 @@ class FCPNode:
         else:
             finalResult = self._submitCmd(
                             id, "ClientPutComplexDir",
-                            rawcmd=manifestInsertCmdBuf,
+                            rawcmd=manifestInsertCmd,
                             Global=globalMode,
                             persistence=persistence,
                             waituntilsent=kw.get('waituntilsent', False),
@@ -1822,6 +2155,15 @@ class FCPNode:
                         Identifier=id, Global=True, waituntilsent=True, **{"async": True})
     
 
+    def queueStats(self):
+        """
+        Returns statistics of the requests waiting to be sent, by lane
+        
+        See RequestScheduler.stats() in fcp3.scheduler.
+        """
+        return self.clientReqQueue.stats()
+    
+
     def getSocketTimeout(self):
         """
         Gets the socketTimeout for future socket calls;
@@ -1891,17 +2233,22 @@ class FCPNode:
     
         self.running = False
     
-        # give the manager thread a chance to bail out
-        time.sleep(pollTimeout * 3)
+        # kick the manager thread out of its wait
+        self._wakeup()
     
         # wait for mgr thread to quit
         log(DETAIL, "shutdown: waiting for manager thread to terminate")
         self.shutdownLock.acquire()
         log(DETAIL, "shutdown: manager thread terminated")
     
+        self._selector.close()
+        self._wakeReader.close()
+        self._wakeWriter.close()
+    
         # shut down FCP connection
         if hasattr(self, 'socket'):
-            if not self.noCloseSocket:
+            # a gateway only lets go of our requests when we hang up
+            if not self.noCloseSocket or self.gateway:
                 self.socket.close()
                 del self.socket
     
@@ -1925,43 +2272,67 @@ class FCPNode:
         return self._submitCmd("__global", "Shutdown", **kw)
 
         
+    def _abandonJob(self, job, exc):
+        """
+        Fails a job which nobody waits for any more with the given
+        exception, and asks the node to drop the request
+        """
+        if job.isComplete():
+            return
+        if self.clientReqQueue.discard(job):
+            # never sent, so the node knows nothing of it
+            job._putResult(exc)
+            return
+        # late replies must still find the job, until the node confirms
+        # the removal with PersistentRequestRemoved
+        job.keep = True
+        job._putResult(exc)
+        self._submitCmd(job.id, "RemovePersistentRequest",
+                        Identifier=job.id,
+                        Global=job.isGlobal and "true" or "false")
+    
+
     # methods for manager thread
     def _mgrThread(self):
         """
         This thread is the nucleus of pyFreenet, and coordinates incoming
         client commands and incoming node responses
+        
+        It sleeps in a single select on the node socket and the wakeup
+        socket, so it reacts at once to whichever comes first.
         """
         log = self._log
     
-        self.shutdownLock.acquire()
-    
         log(DETAIL, "FCPNode: manager thread starting")
         try:
             while self.running:
+                try:
+                    # handle messages which were decoded but not yet
+                    # dispatched
+                    while self._rxQueue and self.running:
+                        self._on_rxMsg(self._rxMsg())
+    
+                    events = self._selector.select(idleTimeout)
+    
+                    for key, mask in events:
+                        if key.data == "wake":
+                            self._drainWakeups()
+                        elif key.data == "node":
+                            # read what the node sent, then dispatch it
+                            self._recvMsgs()
+                        else:
+                            # a socket some subclass registered, along
+                            # with the function which handles it
+                            key.data(key.fileobj)
     
-                log(NOISY, "_mgrThread: Top of manager thread")
+                    # try for incoming requests from clients
+                    self._drainClientReqs()
     
-                # try for incoming messages from node
-                log(NOISY, "_mgrThread: Testing for incoming message")
-                if self._msgIncoming():
-                    log(DEBUG, "_mgrThread: Retrieving incoming message")
-                    msg = self._rxMsg()
-                    log(DEBUG, "_mgrThread: Got incoming message, dispatching")
-                    self._on_rxMsg(msg)
-                    log(DEBUG, "_mgrThread: back from on_rxMsg")
-                else:
-                    log(NOISY, "_mgrThread: No incoming message from node")
-        
-                # try for incoming requests from clients
-                log(NOISY, "_mgrThread: Testing for client req")
-                try:
-                    req = self.clientReqQueue.get(True, pollTimeout)
-                    log(DEBUG, "_mgrThread: Got client req, dispatching")
-                    self._on_clientReq(req)
-                    log(DEBUG, "_mgrThread: Back from on_clientReq")
-                except queue.Empty:
-                    log(NOISY, "_mgrThread: No incoming client req")
-                    pass
+                except (FCPNodeFailure, ConnectionError) as e:
+                    if not (self.reconnect and self.running):
+                        raise
+                    if not self._reconnect(e):
+                        break
     
             self._log(DETAIL, "_mgrThread: Manager thread terminated normally")
     
@@ -1974,22 +2345,45 @@ class FCPNode:
                 job._putResult(e)
             
             # send the exception to all queued jobs
-            while True:
-                try:
-                    job = self.clientReqQueue.get(True, pollTimeout)
-                    job._putResult(e)
-                except queue.Empty:
-                    log(NOISY, "_mgrThread: No incoming client req")
-                    break
+            for job in self.clientReqQueue.drain():
+                job._putResult(e)
     
         self.shutdownLock.release()
     
 
-    def _msgIncoming(self):
+    def _wakeup(self):
+        """
+        Wakes up the manager thread
+        """
+        try:
+            self._wakeWriter.send(b"\0")
+        except (BlockingIOError, OSError):
+            # already plenty of wakeups pending, or shutting down
+            pass
+    
+
+    def _drainWakeups(self):
+        """
+        Discards pending wakeup bytes
+        """
+        try:
+            while self._wakeReader.recv(4096):
+                pass
+        except (BlockingIOError, OSError):
+            pass
+    
+
+    def _drainClientReqs(self):
         """
-        Returns True if a message is coming in from the node
+        Sends all queued client requests to the node
         """
-        return len(select.select([self.socket], [], [], pollTimeout)[0]) > 0
+        while True:
+            try:
+                req = self.clientReqQueue.get_nowait()
+            except queue.Empty:
+                return
+            self._log(DEBUG, "_mgrThread: Got client req, dispatching")
+            self._on_clientReq(req)
     
 
     def _submitCmd(self, id, cmd, **kw):
@@ -2015,6 +2409,9 @@ class FCPNode:
               to the node, default False
             - keep - whether to keep the job on our jobs list after it completes,
               default False
+            - interactive - whether to send the command ahead of queued
+              requests of all priority classes, defaults to True unless
+              async is set, since then nobody waits for it right away
         
         Returns:
             - if command is sent in sync mode, returns the result
@@ -2031,7 +2428,7 @@ class FCPNode:
         >>> # n._submitCmd(id=None, cmd='WatchGlobal', **{'Enabled': 'true'})
         
         """
-        if not self.nodeIsAlive:
+        if not self.nodeIsAlive and not self._reconnecting:
             raise FCPNodeFailure("%s:%s: node closed connection" % (cmd, id))
 
         # if identifier is not given explicitly in the options, we
@@ -2048,8 +2445,10 @@ class FCPNode:
         _async = kw.pop('async', False)
         followRedirect = kw.pop('followRedirect', True)
         stream = kw.pop('stream', None)
+        streamFlush = kw.pop('streamflush', 0)
         waituntilsent = kw.pop('waituntilsent', False)
         keepjob = kw.pop('keep', False)
+        interactive = kw.pop('interactive', not _async)
         timeout = kw.pop('timeout', ONE_YEAR)
         if( "kwdict" in kw):
             kwdict = kw[ "kwdict" ]
@@ -2059,11 +2458,12 @@ class FCPNode:
         job = JobTicket(
             self, id, cmd, kw,
             verbosity=self.verbosity, logger=self._log, keep=keepjob,
-            stream=stream)
+            stream=stream, streamflush=streamFlush)
     
         log(DEBUG, "_submitCmd: timeout=%s" % timeout)
         
         job.followRedirect = followRedirect
+        job.interactive = interactive
     
         if cmd == 'ClientGet' and 'URI' in kw:
             job.uri = kw['URI']
@@ -2072,6 +2472,7 @@ class FCPNode:
             job.mimetype = kw['Metadata.ContentType']
     
         self.clientReqQueue.put(job)
+        self._wakeup()
     
         # log(DEBUG, "_submitCmd: id='%s' cmd='%s' kw=%s" % (id, cmd, # truncate long commands
         #                                                    str([(k,str(kw.get(k, ""))[:128])
@@ -2100,18 +2501,27 @@ class FCPNode:
         cmd = job.cmd
         kw = job.kw
     
-        # register the req
-        if cmd != 'WatchGlobal':
+        if cmd == 'WatchGlobal':
+            # to be restored when we reconnect
+            self._watchingGlobal = str(kw.get('Enabled', 'true')).lower() == 'true'
+    
+        # register the req, unless it only acts on an existing one
+        if cmd not in ('WatchGlobal', 'RemovePersistentRequest'):
             self.jobs[id] = job
-            self._log(DEBUG, "_on_clientReq: cmd=%s id=%s lock=%s" % (
-                cmd, repr(id), job.lock))
+            self._log(DEBUG, "_on_clientReq: cmd=%s id=%s" % (
+                cmd, repr(id)))
         
         # now can send, since we're the only one who will
         self._txMsg(cmd, **kw)
     
+        # the payload is on its way, don't hold on to it until the job
+        # completes
+        kw.pop('Data', None)
+        kw.pop('rawcmd', None)
+    
         job.timeQueued = int(time.time())
     
-        job.reqSentLock.release()
+        job._markSent()
     
 
     def _on_rxMsg(self, msg):
@@ -2136,396 +2546,554 @@ class FCPNode:
         if not job:
             # we have a global job and/or persistent job from last connection
             log(DETAIL, "***** Got %s from unknown job id %s" % (hdr, repr(id)))
-            job = JobTicket(self, id, hdr, msg)
-            self.jobs[id] = job
+            job = self.jobs.placeholder(self, id, hdr, msg)
     
         # action from here depends on what kind of message we got
-    
-        # -----------------------------
-        # handle GenerateSSK responses
-    
-        if hdr == 'SSKKeypair':
-            # got requested keys back
-            keys = (msg['RequestURI'], msg['InsertURI'])
-            job.callback('successful', keys)
-            job._putResult(keys)
-    
-            # and remove job from queue
-            self.jobs.pop(id, None)
+        handler = self._rxHandlers.get(hdr, None)
+        if handler is None:
+            # wtf is happening here?!?
+            log(ERROR, "Unknown message type from node: %s" % hdr)
+            job.callback('failed', msg)
+            job._putResult(FCPException(msg))
             return
+        handler(job, msg)
     
-        # -----------------------------
-        # handle ClientGet responses
-    
-        if hdr == 'DataFound':
-            if( 'URI' in job.kw):
-                log(INFO, "Got DataFound for URI=%s" % job.kw['URI'])
+
+    def registerHandler(self, header, handler):
+        """
+        Sets the function which handles messages from the node with the
+        given header, for example replies to a plugin's own messages
+        
+        Arguments:
+            - header - the message header, such as 'FCPPluginReply'
+            - handler - a function taking the arguments (job, msg), where
+              job is the JobTicket of the message's Identifier and msg is
+              the message as a dict. It is called from the manager thread,
+              so it should not block. None restores the default handling.
+        
+        Returns the handler which was replaced, or None, so that a new
+        handler can pass messages on to it.
+        """
+        old = self._rxHandlers.get(header, None)
+        if handler is None:
+            default = self._handlers.get(header, None)
+            if default is None:
+                self._rxHandlers.pop(header, None)
             else:
-                log(ERROR, "Got DataFound without URI")
-            mimetype = msg['Metadata.ContentType']
-            if 'Filename' in job.kw:
-                # already stored to disk, done
-                #resp['file'] = file
-                result = (mimetype, job.kw['Filename'], msg)
-                job.callback('successful', result)
-                job._putResult(result)
-                return
+                self._rxHandlers[header] = default.__get__(self)
+        else:
+            self._rxHandlers[header] = handler
+        return old
     
-            elif job.kw['ReturnType'] == 'none':
-                result = (mimetype, 1, msg)
-                job.callback('successful', result)
-                job._putResult(result)
-                return
+
+    def _initHandlers(self):
+        """
+        Sets up the handlers for messages from the node
+        """
+        self._rxHandlers = dict((hdr, fn.__get__(self))
+                                for hdr, fn in self._handlers.items())
     
-            # otherwise, we're expecting an AllData and will react to it then
-            else:
-                # is this a persistent get?
-                if job.kw['ReturnType'] == 'direct' \
-                and job.kw.get('Persistence', None) != 'connection':
-                    # gotta poll for request status so we can get our data
-                    # FIXME: this is a hack, clean it up
-                    log(INFO, "Request was persistent")
-                    if not hasattr(job, "gotPersistentDataFound"):
-                        if job.isGlobal:
-                            isGlobal = "true"
-                        else:
-                            isGlobal = "false"
-                        job.gotPersistentDataFound = True
-                        log(INFO, "  --> sending GetRequestStatus")
-                        self._txMsg("GetRequestStatus",
-                                    Identifier=job.kw['Identifier'],
-                                    Persistence=msg.get("Persistence", "connection"),
-                                    Global=isGlobal,
-                                    )
-    
-                job.callback('pending', msg)
-                job.mimetype = mimetype
-                return
+
+    # message handlers, keyed by header in _handlers below
     
-        if hdr == 'CompatibilityMode':
-            # information, how to insert the file to make it an exact match.
-            # TODO: Use the information.
-            job.callback('pending', msg)
-            return
+    def _onPending(self, job, msg):
+        # progress messages
+        job.callback('pending', msg)
     
-        if hdr == 'ExpectedMIME':
-            # information, how to insert the file to make it an exact match.
-            # TODO: Use the information.
-            mimetype = msg['Metadata.ContentType']
-            job.mimetype = mimetype
-            job.callback('pending', msg)
-            return
-
-        if hdr == 'ExpectedDataLength':
-            # The expected filesize.
-            # TODO: Use the information.
-            size = msg['DataLength']
-            job.callback('pending', msg)
-            return
-
-        if hdr == 'AllData':
-            result = (job.mimetype, msg['Data'], msg)
-            job.callback('successful', result)
-            job._putResult(result)
-            return
 
-        if hdr == 'GetFailed':
-            # see if it's just a redirect problem
-            if job.followRedirect and (msg.get('ShortCodeDescription', None) == "New URI" or msg.get('Code', None) == 27):
-                uri = msg['RedirectURI']
-                job.kw['URI'] = uri
-                job.kw['id'] = self._getUniqueId();
-                self._txMsg(job.cmd, **job.kw)
-                log(DETAIL, "Redirect to %s" % uri)
-                return
-            # see if it's just a TOO_MANY_PATH_COMPONENTS redirect
-            if job.followRedirect and (msg.get('ShortCodeDescription', None) == "Too many path components" or msg.get('Code', None) == 11):
-                uri = msg['RedirectURI']
-                job.kw['URI'] = uri
-                job.kw['id'] = self._getUniqueId();
-                self._txMsg(job.cmd, **job.kw)
-                log(DETAIL, "Redirect to %s" % uri)
-                return
+    def _onListItem(self, job, msg):
+        if self._unlisted:
+            # still known to the node after we reconnected
+            self._unlisted.pop(job.id, None)
+        job.callback('pending', msg)
+        job._appendMsg(msg)
     
-            # return an exception
-            job.callback("failed", msg)
-            job._putResult(FCPGetFailed(msg))
-            return
+
+    def _onListEnd(self, job, msg):
+        job._appendMsg(msg)
+        job.callback('successful', job.msgs)
+        job._putResult(job.msgs)
     
-        # -----------------------------
-        # handle ClientPut responses
+
+    def _onEndListPersistent(self, job, msg):
+        self._onListEnd(job, msg)
     
-        if hdr == 'URIGenerated':
-            if 'URI' not in msg:
-                log(ERROR, "message {} without 'URI'. This is very likely a bug in Freenet. Check whether you have files in uploads or downloads without URI (clickable link).".format(hdr))
+        # our requests which the node did not list after we reconnected
+        # are gone, unless they never reached it
+        unlisted, self._unlisted = self._unlisted, None
+        for job in (unlisted or {}).values():
+            if job.isComplete():
+                continue
+            if not job._sent.is_set() and self._canResend(job):
+                self._on_clientReq(job)
             else:
-                job.uri = msg['URI']
-                newUri = msg['URI']
-            job.callback('pending', msg)
+                job._putResult(FCPNodeFailure(
+                    "%s: lost by the node while we were disconnected" % job.id))
     
-            return
+
+    def _onListFailed(self, job, msg):
+        job._appendMsg(msg)
+        job.callback('failed', job.msgs)
+        job._putResult(job.msgs)
     
-            # bail here if no data coming back
-            if job.kw.get('GetCHKOnly', False) == 'true':
-                # done - only wanted a CHK
-                job._putResult(newUri)
-                return
+
+    def _onReply(self, job, msg):
+        # return all the data recieved
+        job.callback('successful', msg)
+        job._putResult(msg)
     
-        if hdr == 'PutSuccessful':
-            if 'URI' not in msg:
-                log(ERROR, "message {} without 'URI'. This is very likely a bug in Freenet. Check whether you have files in uploads or downloads without URI (clickable link).".format(hdr))
-            else:
-                result = msg['URI']
-                job._putResult(result)
-                job.callback('successful', result)
-            # print "*** PUTSUCCESSFUL"
-            return
+        # remove job from queue
+        self.jobs.pop(job.id, None)
     
-        if hdr == 'PutFailed':
-            job.callback('failed', msg)
-            job._putResult(FCPPutFailed(msg))
-            return
-        
-        if hdr == 'PutFetchable':
-            if 'URI' not in msg:
-                log(ERROR, "message {} without 'URI'. This is very likely a bug in Freenet. Check whether you have files in uploads or downloads without URI (clickable link).".format(hdr))
-            else:
-                uri = msg['URI']
-                job.kw['URI'] = uri
-            job.callback('pending', msg)
-            return
+
+    def _onSSKKeypair(self, job, msg):
+        # got requested keys back
+        keys = (msg['RequestURI'], msg['InsertURI'])
+        job.callback('successful', keys)
+        job._putResult(keys)
     
-        # -----------------------------
-        # handle ConfigData
-        if hdr == 'ConfigData':
-            # return all the data recieved
-            job.callback('successful', msg)
-            job._putResult(msg)
+        # and remove job from queue
+        self.jobs.pop(job.id, None)
     
-            # remove job from queue
-            self.jobs.pop(id, None)
+
+    def _onDataFound(self, job, msg):
+        log = self._log
+        if( 'URI' in job.kw):
+            log(INFO, "Got DataFound for URI=%s" % job.kw['URI'])
+        else:
+            log(ERROR, "Got DataFound without URI")
+        mimetype = msg['Metadata.ContentType']
+        if 'Filename' in job.kw:
+            # already stored to disk, done
+            #resp['file'] = file
+            result = (mimetype, job.kw['Filename'], msg)
+            job.callback('successful', result)
+            job._putResult(result)
             return
     
-        # -----------------------------
-        # handle progress messages
-    
-        if hdr == 'StartedCompression':
-            job.callback('pending', msg)
+        elif job.kw['ReturnType'] == 'none':
+            result = (mimetype, 1, msg)
+            job.callback('successful', result)
+            job._putResult(result)
             return
     
-        if hdr == 'FinishedCompression':
-            job.callback('pending', msg)
-            return
+        # otherwise, we're expecting an AllData and will react to it then
+        # is this a persistent get?
+        if job.kw['ReturnType'] == 'direct' \
+        and job.kw.get('Persistence', None) != 'connection':
+            # gotta poll for request status so we can get our data
+            # FIXME: this is a hack, clean it up
+            log(INFO, "Request was persistent")
+            if not hasattr(job, "gotPersistentDataFound"):
+                if job.isGlobal:
+                    isGlobal = "true"
+                else:
+                    isGlobal = "false"
+                job.gotPersistentDataFound = True
+                log(INFO, "  --> sending GetRequestStatus")
+                self._txMsg("GetRequestStatus",
+                            Identifier=job.kw['Identifier'],
+                            Persistence=msg.get("Persistence", "connection"),
+                            Global=isGlobal,
+                            )
     
-        if hdr == 'SimpleProgress':
-            job.callback('pending', msg)
-            return
+        job.callback('pending', msg)
+        job.mimetype = mimetype
     
-        if hdr == 'SendingToNetwork':
-            job.callback('pending', msg)
-            return
+
+    def _onExpectedMIME(self, job, msg):
+        # information, how to insert the file to make it an exact match.
+        # TODO: Use the information.
+        job.mimetype = msg['Metadata.ContentType']
+        job.callback('pending', msg)
     
-        if hdr == 'EnterFiniteCooldown':
-            job.callback('pending', msg)
-            return
 
-        if hdr == 'ExpectedHashes':
-            # The hashes the file must have.
-            # TODO: Use the information.
-            sha256 = msg['Hashes.SHA256']
-            job.callback('pending', msg)
-            return
+    def _onAllData(self, job, msg):
+        result = (job.mimetype, msg['Data'], msg)
+        job.callback('successful', result)
+        job._putResult(result)
     
 
-        # -----------------------------
-        # handle LoadPlugin replies
-        
-        if hdr == 'PluginInfo':
-            job._appendMsg(msg)
-            job.callback('successful', job.msgs)
-            job._putResult(job.msgs)
-            return
-        
-        # -----------------------------
-        # handle FCPPluginMessage replies
-        
-        if hdr == 'FCPPluginReply':
-            job._appendMsg(msg)
-            job.callback('successful', job.msgs)
-            job._putResult(job.msgs)
-            return   
-        
-        # -----------------------------
-        # handle peer management messages
-        
-        if hdr == 'EndListPeers':
-            job._appendMsg(msg)
-            job.callback('successful', job.msgs)
-            job._putResult(job.msgs)
-            return   
-        
-        if hdr == 'Peer':
-            if(job.cmd == "ListPeers"):
-                job.callback('pending', msg)
-                job._appendMsg(msg)
-            else:
-                job.callback('successful', msg)
-                job._putResult(msg)
+    def _onGetFailed(self, job, msg):
+        # see if it's just a redirect problem, or a
+        # TOO_MANY_PATH_COMPONENTS redirect
+        if job.followRedirect and (
+                msg.get('ShortCodeDescription', None) in ("New URI", "Too many path components")
+                or msg.get('Code', None) in (27, 11)):
+            uri = msg['RedirectURI']
+            job.kw['URI'] = uri
+            job.kw['id'] = self._getUniqueId();
+            self._txMsg(job.cmd, **job.kw)
+            self._log(DETAIL, "Redirect to %s" % uri)
             return
-        
-        if hdr == 'PeerRemoved':
-            job._appendMsg(msg)
-            job.callback('successful', job.msgs)
-            job._putResult(job.msgs)
-            return   
-        
-        if hdr == 'UnknownNodeIdentifier':
-            job._appendMsg(msg)
-            job.callback('failed', job.msgs)
-            job._putResult(job.msgs)
-            return   
     
-        # -----------------------------
-        # handle peer note management messages
-        
-        if hdr == 'EndListPeerNotes':
-            job._appendMsg(msg)
-            job.callback('successful', job.msgs)
-            job._putResult(job.msgs)
+        # return an exception
+        job.callback("failed", msg)
+        job._putResult(FCPGetFailed(msg))
+    
 
+    def _onURIGenerated(self, job, msg):
+        if 'URI' not in msg:
+            self._log(ERROR, "message {} without 'URI'. This is very likely a bug in Freenet. Check whether you have files in uploads or downloads without URI (clickable link).".format(msg['header']))
+        else:
+            job.uri = msg['URI']
+        job.callback('pending', msg)
+    
 
-            return   
-        
-        if hdr == 'PeerNote':
-            if(job.cmd == "ListPeerNotes"):
-                job.callback('pending', msg)
-                job._appendMsg(msg)
-            else:
-                job.callback('successful', msg)
-                job._putResult(msg)
-            return
-        
-        if hdr == 'UnknownPeerNoteType':
-            job._appendMsg(msg)
-            job.callback('failed', job.msgs)
-            job._putResult(job.msgs)
-            return   
+    def _onPutSuccessful(self, job, msg):
+        if 'URI' not in msg:
+            self._log(ERROR, "message {} without 'URI'. This is very likely a bug in Freenet. Check whether you have files in uploads or downloads without URI (clickable link).".format(msg['header']))
+        else:
+            result = msg['URI']
+            job._putResult(result)
+            job.callback('successful', result)
+    
+
+    def _onPutFailed(self, job, msg):
+        job.callback('failed', msg)
+        job._putResult(FCPPutFailed(msg))
     
-        # -----------------------------
-        # handle persistent job messages
+
+    def _onPutFetchable(self, job, msg):
+        if 'URI' not in msg:
+            self._log(ERROR, "message {} without 'URI'. This is very likely a bug in Freenet. Check whether you have files in uploads or downloads without URI (clickable link).".format(msg['header']))
+        else:
+            job.kw['URI'] = msg['URI']
+        job.callback('pending', msg)
     
-        if hdr == 'PersistentGet':
+
+    def _onPeer(self, job, msg):
+        if(job.cmd == "ListPeers"):
             job.callback('pending', msg)
             job._appendMsg(msg)
-            return
+        else:
+            job.callback('successful', msg)
+            job._putResult(msg)
     
-        if hdr == 'PersistentPut':
+
+    def _onPeerNote(self, job, msg):
+        if(job.cmd == "ListPeerNotes"):
             job.callback('pending', msg)
             job._appendMsg(msg)
-            return
+        else:
+            job.callback('successful', msg)
+            job._putResult(msg)
     
-        if hdr == 'PersistentPutDir':
-            job.callback('pending', msg)
-            job._appendMsg(msg)
-            return
+
+    def _onPersistentRequestRemoved(self, job, msg):
+        self.jobs.pop(job.id, None)
     
-        if hdr == 'EndListPersistentRequests':
-            job._appendMsg(msg)
-            job.callback('successful', job.msgs)
-            job._putResult(job.msgs)
-            return
-        
-        if hdr == 'PersistentRequestRemoved':
-            if id in self.jobs:
-                del self.jobs[id]
-            return
-        
-        # ----------------------------- 
-        # handle USK Subscription , thanks to Enzo Matrix
 
+    def _onSubscribedUSK(self, job, msg):
         # Note from Enzo Matrix: I just needed the messages to get
         # passed through to the job, and have its callback function
         # called so I can do something when a USK gets updated. I
         # handle the checking whether the message was a
         # SubscribedUSKUpdate in the callback, which is defined in the
         # spider.
-        if hdr == 'SubscribedUSK': 
-            job.callback('successful', msg) 
-            return 
-
-        if hdr == 'SubscribedUSKUpdate': 
-            job.callback('successful', msg) 
-            return 
+        job.callback('successful', msg)
+    
 
-        if hdr == 'SubscribedUSKRoundFinished': 
-            job.callback('successful', msg) 
-            return
+    def _onProtocolError(self, job, msg):
+        job.callback('failed', msg)
+        job._putResult(FCPProtocolError(msg))
+    
 
-        if hdr == 'SubscribedUSKSendingToNetwork': 
-            job.callback('successful', msg) 
-            return
+    def _onIdentifierCollision(self, job, msg):
+        self._log(ERROR, "IdentifierCollision on id %s ???" % job.id)
+        job.callback('failed', msg)
+        job._putResult(Exception("Duplicate job identifier %s" % job.id))
+    
+
+    _handlers = {
+        # GenerateSSK responses
+        'SSKKeypair': _onSSKKeypair,
+    
+        # ClientGet responses
+        'DataFound': _onDataFound,
+        'AllData': _onAllData,
+        'GetFailed': _onGetFailed,
+        'ExpectedMIME': _onExpectedMIME,
+        'ExpectedDataLength': _onPending,
+    
+        # ClientPut responses
+        'URIGenerated': _onURIGenerated,
+        'PutSuccessful': _onPutSuccessful,
+        'PutFailed': _onPutFailed,
+        'PutFetchable': _onPutFetchable,
+    
+        # progress messages
+        'SimpleProgress': _onPending,
+        'StartedCompression': _onPending,
+        'FinishedCompression': _onPending,
+        'SendingToNetwork': _onPending,
+        'EnterFiniteCooldown': _onPending,
+        # information, how to insert the file to make it an exact
+        # match. TODO: Use the information.
+        'CompatibilityMode': _onPending,
+        'ExpectedHashes': _onPending,
+    
+        # LoadPlugin and FCPPluginMessage replies
+        'PluginInfo': _onListEnd,
+        'FCPPluginReply': _onListEnd,
+    
+        # peer and peer note management
+        'Peer': _onPeer,
+        'EndListPeers': _onListEnd,
+        'PeerRemoved': _onListEnd,
+        'UnknownNodeIdentifier': _onListFailed,
+        'PeerNote': _onPeerNote,
+        'EndListPeerNotes': _onListEnd,
+        'UnknownPeerNoteType': _onListFailed,
+    
+        # persistent jobs
+        'PersistentGet': _onListItem,
+        'PersistentPut': _onListItem,
+        'PersistentPutDir': _onListItem,
+        'EndListPersistentRequests': _onEndListPersistent,
+        'PersistentRequestRemoved': _onPersistentRequestRemoved,
+    
+        # USK subscriptions, thanks to Enzo Matrix
+        'SubscribedUSK': _onSubscribedUSK,
+        'SubscribedUSKUpdate': _onSubscribedUSK,
+        'SubscribedUSKRoundFinished': _onSubscribedUSK,
+        'SubscribedUSKSendingToNetwork': _onSubscribedUSK,
+    
+        # testDDA, GetNode and GetConfig
+        'TestDDAReply': _onReply,
+        'TestDDAComplete': _onReply,
+        'NodeData': _onReply,
+        'ConfigData': _onReply,
+    
+        # various errors
+        'ProtocolError': _onProtocolError,
+        'IdentifierCollision': _onIdentifierCollision,
+        }
+    
 
-        # -----------------------------
-        # handle testDDA messages
-        
-        if hdr == 'TestDDAReply':
-            # return all the data recieved
-            job.callback('successful', msg)
-            job._putResult(msg)
+    # low level noce comms methods
     
-            # remove job from queue
-            self.jobs.pop(id, None)
-            return
-        
-        if hdr == 'TestDDAComplete':
-            # return all the data recieved
-            job.callback('successful', msg)
-            job._putResult(msg)
+
+    def _connect(self):
+        """
+        Opens the connection to the node, or to the gateway if we were
+        asked to use one, and does the hello
+        """
+        # try the gateway first, if asked to
+        self.gateway = None
+        if self._gatewayOpt:
+            self.socket = self._connectGateway(self._gatewayOpt)
+        else:
+            self.socket = None
     
-            # remove job from queue
-            self.jobs.pop(id, None)
-            return
+        # otherwise, try to connect to node
+        if self.socket is None:
+            self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            try:
+                self.socket.connect((self.host, self.port))
+            except Exception as e:
+                self.socket.close()
+                raise type(e)(
+                    "Failed to connect to %s:%s - %s" % (
+                        self.host, self.port, e)).with_traceback(
+                            sys.exc_info()[2])
+        if self.socket.family != getattr(socket, 'AF_UNIX', None):
+            # we write whole messages, and the data of a streamed one
+            # must not wait for the ack of its header
+            self.socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        if(None != self.socketTimeout):
+            try:
+                self.socket.settimeout(self.socketTimeout)
+            except Exception as e:
+                # Socket timeout setting is not available until Python 2.3, so ignore exceptions
+                pass
+            
+        # now do the hello
+        self._hello()
     
-        # -----------------------------
-        # handle NodeData
-        if hdr == 'NodeData':
-            # return all the data recieved
-            job.callback('successful', msg)
-            job._putResult(msg)
+
+    def _reconnect(self, exc):
+        """
+        Gets back to the node after the connection was lost, retrying
+        with a growing delay
+        
+        Connection-scoped jobs fail, since the node forgot them along
+        with the connection. Persistent and global jobs are kept, and
+        brought up to date by the node's reply to ListPersistentRequests.
+        
+        Returns False if we were shut down before we got back.
+        """
+        log = self._log
+        log(ERROR, "lost connection to %s:%s: %s - reconnecting" % (
+            self.host, self.port, exc))
     
-            # remove job from queue
-            self.jobs.pop(id, None)
-            return
+        self._reconnecting = True
+        self.nodeIsAlive = False
+        try:
+            self._selector.unregister(self.socket)
+        except (KeyError, ValueError):
+            pass
+        self.socket.close()
+    
+        lost = FCPNodeFailure("%s:%s: connection to node lost: %s" % (
+            self.host, self.port, exc))
+        resend = []
+        unlisted = {}
+        for id, job in list(self.jobs.items()):
+            if job.isComplete():
+                continue
+            if isinstance(job, JobRecord):
+                # we hear about these again if the node still has them
+                if not (job.isPersistent or job.isGlobal):
+                    self.jobs.pop(id, None)
+            elif not self._isConnectionScoped(job):
+                # unless we are told about global requests, we cannot
+                # tell whether the node still has them
+                if not job.isGlobal or self._watchingGlobal:
+                    unlisted[id] = job
+            elif job.cmd == 'ListPersistentRequests':
+                # answered by the listing we ask for below
+                pass
+            elif not job._sent.is_set() and self._canResend(job):
+                # the node never got it
+                resend.append(job)
+            else:
+                job._putResult(lost)
+    
+        delay = self.reconnectDelay
+        while self.running:
+            # whatever was left of a message is lost with the connection
+            self._decoder = FCPMessageDecoder(streamFor=self._streamFor,
+                                              convertInts=self._convertInts)
+            self._rxQueue.clear()
+            try:
+                self._connect()
+                break
+            except (OSError, FCPNodeFailure, FCPDecodeError) as e:
+                log(ERROR, "cannot reconnect to %s:%s: %s - retrying in %ss" % (
+                    self.host, self.port, e, delay))
+            self._sleepUnlessShutdown(delay)
+            delay = min(delay * 2, self.reconnectMaxDelay)
+        else:
+            return False
     
-        # -----------------------------
-        # handle various errors
+        self._selector.register(self.socket, selectors.EVENT_READ, "node")
+        self.nodeIsAlive = True
+        self._reconnecting = False
+        self.reconnects += 1
+        # the node checks directory access anew for each connection
+        self.testedDDA = {}
+        log(INFO, "reconnected to %s:%s as %s" % (
+            self.host, self.port, self.name))
+    
+        if self._watchingGlobal:
+            self._txMsg("WatchGlobal", Enabled="true")
+        self._unlisted = unlisted
+        self._txMsg("ListPersistentRequests")
+        for job in resend:
+            self._on_clientReq(job)
+        return True
     
-        if hdr == 'ProtocolError':
-            job.callback('failed', msg)
-            job._putResult(FCPProtocolError(msg))
-            return
+
+    def _sleepUnlessShutdown(self, delay):
+        """
+        Waits for the given number of seconds, or until shutdown()
+        """
+        deadline = time.monotonic() + delay
+        with selectors.DefaultSelector() as sel:
+            sel.register(self._wakeReader, selectors.EVENT_READ)
+            while self.running:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return
+                # woken up by new requests too, which have to wait
+                if sel.select(remaining):
+                    self._drainWakeups()
     
-        if hdr == 'IdentifierCollision':
-            log(ERROR, "IdentifierCollision on id %s ???" % id)
-            job.callback('failed', msg)
-            job._putResult(Exception("Duplicate job identifier %s" % id))
-            return
 
-        # Ignore informational headers (since 1254)
-        if hdr == 'ExpectedHashes' or hdr == 'CompatibilityMode':
-            return
+    def _isConnectionScoped(self, job):
+        """
+        Whether a job lives and dies with our connection to the node
+        """
+        return not (job.isPersistent or job.isGlobal
+                    or job.kw.get('Persistence', 'connection') != 'connection')
+    
 
-        # -----------------------------
-        # wtf is happening here?!?
+    def _canResend(self, job):
+        """
+        Whether a request can be sent again, which a partly read stream
+        cannot
+        """
+        data = job.kw.get('Data', None)
+        return data is None or isinstance(data, (bytes, bytearray, memoryview, str))
     
-        log(ERROR, "Unknown message type from node: %s" % hdr)
-        job.callback('failed', msg)
-        job._putResult(FCPException(msg))
-        return
 
+    def _connectGateway(self, gateway):
+        """
+        Connects to the gateway socket for our host and port, or the given
+        socket path
+        
+        Returns the connected socket, or None if gateway is True and no
+        gateway is listening.
+        """
+        explicit = gateway is not True
+        if explicit:
+            path = gateway
+        else:
+            path = gatewayPath(self.host, self.port)
+            if not os.path.exists(path):
+                return None
+    
+        # the requests we send may hold private keys, so only talk to
+        # a gateway of our own user
+        try:
+            if not explicit:
+                checkPrivate(os.path.dirname(path))
+            checkPrivate(path)
+        except GatewayNotPrivate as e:
+            if explicit:
+                raise
+            self._log(ERROR, "not using gateway: %s" % e)
+            return None
+    
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            sock.connect(path)
+            self._checkPeer(sock, path)
+        except OSError as e:
+            sock.close()
+            if explicit:
+                if isinstance(e, GatewayNotPrivate):
+                    raise
+                raise type(e)(
+                    "Failed to connect to gateway %s - %s" % (
+                        path, e)).with_traceback(sys.exc_info()[2])
+            if isinstance(e, GatewayNotPrivate):
+                self._log(ERROR, "not using gateway: %s" % e)
+            else:
+                # stale socket of a gateway which is gone
+                self._log(DETAIL, "gateway %s not answering: %s" % (path, e))
+            return None
+    
+        self._log(DETAIL, "talking to %s:%s via gateway %s" % (
+            self.host, self.port, path))
+        self.gateway = path
+        return sock
     
 
-    # low level noce comms methods
+    def _checkPeer(self, sock, path):
+        """
+        Raises GatewayNotPrivate if the process listening on a Unix
+        socket runs as another user, where the platform tells
+        """
+        if not (hasattr(socket, "SO_PEERCRED") and hasattr(os, "getuid")):
+            return
+        creds = sock.getsockopt(socket.SOL_SOCKET, socket.SO_PEERCRED,
+                                struct.calcsize("3i"))
+        pid, uid, gid = struct.unpack("3i", creds)
+        if uid != os.getuid():
+            raise GatewayNotPrivate("gateway %s runs as uid %s, not as us" % (
+                path, uid))
     
 
     def _hello(self):
@@ -2627,7 +3195,8 @@ class FCPNode:
             - msgType - one of the FCP message headers, such as 'ClientHello'
             - args - zero or more (keyword, value) tuples
         Keywords:
-            - rawcmd - if given, this is the raw buffer to send
+            - rawcmd - if given, this is the raw buffer to send, or a
+              list of segments, see complexDirCommand()
             - other keywords depend on the value of msgType
         """
         log = self._log
@@ -2635,59 +3204,138 @@ class FCPNode:
         # just send the raw command, if given    
         rawcmd = kw.get('rawcmd', None)
         if rawcmd:
-            self.socket.sendall(rawcmd)
-            log(DETAIL, "CLIENT: %s" % rawcmd)
+            if isinstance(rawcmd, str):
+                rawcmd = rawcmd.encode('utf-8')
+            if isinstance(rawcmd, (bytes, bytearray, memoryview)):
+                self.socket.sendall(rawcmd)
+                log(DETAIL, "CLIENT: %s" % rawcmd)
+            else:
+                self._sendSegments(rawcmd)
             return
     
-        if "Data" in kw:
-            data = kw.pop("Data")
-            sendEndMessage = False
-        else:
-            data = None
-            sendEndMessage = True
-    
-        items = [msgType.encode('utf-8') + b"\n"]
-        log(DETAIL, "CLIENT: %s" % msgType)
+        data = kw.pop("Data", None)
+        dataLength = kw.pop("DataLength", None)
     
-        #print "CLIENT: %s" % msgType
-        for k, v in list(kw.items()):
-            #print "CLIENT: %s=%s" % (k,v)
-            line = k.encode('utf-8') + b"=" + str(v).encode('utf-8')
-            items.append(line + b"\n")
-            log(DETAIL, "CLIENT: %s" % line)
+        if isinstance(data, str):
+            data = data.encode('utf-8')
     
-        if data != None:
-            items.append(("DataLength=%d\n" % len(data)).encode('utf-8'))
-            log(DETAIL, "CLIENT: DataLength=%d" % len(data))
-            items.append(b"Data\n")
-            log(DETAIL, "CLIENT: ...data...")
-            items.append(data)
+        if data is None:
+            raw = encodeMessage(msgType, kw)
+        else:
+            if dataLength is None:
+                dataLength = getDataLength(data)
+            raw = encodeMessage(msgType, kw, dataLength=dataLength)
+    
+        if self.verbosity >= DETAIL:
+            for line in raw.decode('utf-8').splitlines():
+                log(DETAIL, "CLIENT: %s" % line)
+            if data is not None:
+                log(DETAIL, "CLIENT: ...data...")
+    
+        if data is None:
+            self.socket.sendall(raw)
+        elif isinstance(data, (bytes, bytearray, memoryview)):
+            self._sendBuffers(raw, data)
+        else:
+            # stream the payload after the header
+            self.socket.sendall(raw)
+            self._sendStream(data, dataLength)
     
-        #print "sendEndMessage=%s" % sendEndMessage
+
+    def _sendBuffers(self, *bufs):
+        """
+        Sends several buffers without joining them first
+        """
+        sock = self.socket
+        if not hasattr(sock, "sendmsg"):
+            for buf in bufs:
+                sock.sendall(buf)
+            return
+        views = [memoryview(buf).cast("B") for buf in bufs]
+        while views:
+            sent = sock.sendmsg(views)
+            # drop what went out, keep the rest for the next round
+            while views and sent >= len(views[0]):
+                sent -= len(views.pop(0))
+            if views and sent:
+                views[0] = views[0][sent:]
     
-        if sendEndMessage:
-            items.append(b"EndMessage\n")
-            log(DETAIL, "CLIENT: %s" % b"EndMessage")
-        
-        # ensure that every item is a byte
-        items = [(i if not isinstance(i, str) else i.encode("utf-8"))
-                 for i in items]
-        
-        try:
-            raw = b"".join(items)
-        except TypeError as e:
-            # at least one item is no bytearray
-            log(ERROR, str(e))
-            for item in items:
+
+    def _sendSegments(self, segments):
+        """
+        Sends a raw command given as segments: buffers, which are sent
+        as they are, and (source, length) payloads, which are streamed
+        """
+        log = self._log
+        for segment in segments:
+            if not isinstance(segment, tuple):
+                self.socket.sendall(segment)
+                log(DETAIL, "CLIENT: %s" % bytes(segment))
+                continue
+            source, length = segment
+            log(DETAIL, "CLIENT: ...%d bytes of data..." % length)
+            if isinstance(source, (bytes, bytearray, memoryview)):
+                if getDataLength(source) != length:
+                    self.nodeIsAlive = False
+                    raise FCPNodeFailure("payload of %d bytes announced as %d" % (
+                        getDataLength(source), length))
+                self.socket.sendall(source)
+            elif hasattr(source, "read"):
+                self._sendStream(source, length)
+            else:
                 try:
-                    print(item) # can print strings
-                    log(ERROR, item)
-                except TypeError:
-                    print(item.decode("utf-8")) # to still show those which should have worked
-                    log(ERROR, item.decode("utf-8"))
-            raise
+                    f = open(source, "rb")
+                except OSError as e:
+                    # the node waits for the payload, so this connection
+                    # is broken
+                    self.nodeIsAlive = False
+                    raise FCPNodeFailure("cannot read %s: %s" % (source, e))
+                with f:
+                    self._sendStream(f, length)
     
-        self.socket.sendall(raw)
+
+    def _sendStream(self, data, length):
+        """
+        Sends exactly length bytes from a file object or an iterable of
+        chunks, without holding more than one chunk in memory
+        """
+        sock = self.socket
+        sent = 0
+        if hasattr(data, "read"):
+            if length and _isRegularFile(data):
+                # the kernel copies straight from the file to the socket
+                sent = sock.sendfile(data, offset=data.tell(), count=length)
+            else:
+                buf = bytearray(min(dataChunkSize, max(length, 1)))
+                with memoryview(buf) as view:
+                    while sent < length:
+                        want = min(len(buf), length - sent)
+                        if hasattr(data, "readinto"):
+                            n = data.readinto(view[:want])
+                        else:
+                            chunk = data.read(want)
+                            n = len(chunk)
+                            view[:n] = chunk
+                        if not n:
+                            break
+                        sock.sendall(view[:n])
+                        sent += n
+        else:
+            for chunk in data:
+                if isinstance(chunk, str):
+                    chunk = chunk.encode('utf-8')
+                n = len(memoryview(chunk).cast("B"))
+                if sent + n > length:
+                    raise FCPNodeFailure(
+                        "data source gave more than the %d bytes announced" % length)
+                sock.sendall(chunk)
+                sent += n
+    
+        if sent != length:
+            # the node waits for the rest, so this connection is broken
+            self.nodeIsAlive = False
+            raise FCPNodeFailure(
+                "data source ended after %d of %d bytes" % (sent, length))
     
 
     def _rxMsg(self):
@@ -2698,99 +3346,52 @@ class FCPNode:
         """
         log = self._log
     
-        log(DETAIL, "NODE: ----------------------------")
-    
-        # shorthand, for reading n bytes
-        def read(n):
-            if n > 1:
-                log(DEBUG, "read: want %d bytes" % n)
-            chunks = bytearray()
-            remaining = n
-            while remaining > 0:
-                chunk = self.socket.recv(remaining)
-                chunklen = len(chunk)
-                if chunk:
-                    chunks += chunk
-                else:
-                    self.nodeIsAlive = False
-                    raise FCPNodeFailure("FCP socket closed by node")
-                remaining -= chunklen
-                if remaining > 0:
-                    if n > 1:
-                        log(DEBUG,
-                            "wanted %s, got %s still need %s bytes" % (n, chunklen, remaining)
-                            )
-                    pass
-            return chunks
+        # read from the socket until at least one whole message is in
+        while not self._rxQueue:
+            self._recvMsgs()
     
-        # read a line
-        def readln():
-            buf = bytearray()
-            while True:
-                c = read(1)
-                buf += c
-                if c == b'\n':
-                    break
-            log(DETAIL, "NODE: " + buf[:-1].decode('utf-8'))
-            return buf
-    
-        items = {}
+        msg = self._rxQueue.popleft()
     
-        # read the header line
-        # It is not binary; decode.
-        while True:
-            line = readln().decode('utf-8').strip()
-            if line:
-                items['header'] = line
-                break
-    
-        # read the body
-        while True:
-            line = readln().strip()
-            if line in [b'End', b'EndMessage']:
-                break
-    
-            if line == b'Data':
-                # read the following data
-                
-                # try to locate job
-                id = items['Identifier']
-                job = self.jobs[id]
-                if job.stream:
-                    # loop to transfer from socket to stream
-                    remaining = items['DataLength']
-                    stream = job.stream
-                    while remaining > 0:
-                        buf = self.socket.recv(remaining)
-                        stream.write(buf)
-                        stream.flush()
-                        remaining -= len(buf)
-                    items['Data'] = None
-                else:
-                    buf = read(items['DataLength'])
-                    items['Data'] = buf
-                log(DETAIL, "NODE: ...<%d bytes of data>" % len(buf))
-                break
-            else:
-                # it's a normal 'key=val' pair
-                # Pairs are not binary; decode as UTF-8.
-                try:
-                    line = line.decode('utf-8')
-                    k, v = line.split("=", 1)
-                except:
-                    log(ERROR, "_rxMsg: barfed splitting '%s'" % repr(line))
-                    raise
+        if self.verbosity >= DETAIL:
+            log(DETAIL, "NODE: ----------------------------")
+            log(DETAIL, "NODE: %s" % msg['header'])
+            for k, v in msg.items():
+                if k == 'header':
+                    continue
+                if k == 'Data':
+                    if v is not None:
+                        log(DETAIL, "NODE: ...<%d bytes of data>" % len(v))
+                    continue
+                log(DETAIL, "NODE: %s=%s" % (k, v))
     
-                # attempt int conversion
-                try:
-                    v = int(v)
-                except:
-                    pass
+        return msg
     
-                items[k] = v
+
+    def _recvMsgs(self):
+        """
+        Does one read from the node socket, and queues the messages
+        completed by it
+        """
+        try:
+            msgs = self._decoder.recvFrom(self.socket)
+        except EOFError:
+            self.nodeIsAlive = False
+            raise FCPNodeFailure("FCP socket closed by node")
+        except FCPDecodeError as e:
+            self._log(ERROR, "_recvMsgs: %s" % e)
+            raise
+        self._rxQueue.extend(msgs)
     
-        # all done
-        return items
+
+    def _streamFor(self, msg):
+        """
+        Returns the stream to which the data of the given message
+        should be written, or None if it should be kept in the message
+        """
+        job = getattr(self, 'jobs', {}).get(msg.get('Identifier'), None)
+        if job is None or job.stream is None:
+            return None
+        return job.stream, job.streamFlush
     
 
     def _log(self, level, msg):
@@ -2836,6 +3437,10 @@ class JobTicket:
         - kw - the keywords in the FCP header
         - msgs - any messages received from node in connection
           to this job
+    
+    Completion can also be awaited through a concurrent.futures.Future,
+    obtained from asFuture(), for example to wait on many jobs with
+    concurrent.futures.wait(..., return_when=FIRST_COMPLETED).
     """
 
     def __init__(self, node, id, cmd, kw, **opts):
@@ -2850,6 +3455,7 @@ class JobTicket:
         self._log = opts.get('logger', self.defaultLogger)
         self.keep = opts.get('keep', False)
         self.stream = opts.get('stream', None)
+        self.streamFlush = opts.get('streamflush', 0)
         self.followRedirect = opts.get('followRedirect', True)
     
         # find out if persistent
@@ -2876,21 +3482,30 @@ class JobTicket:
         self.timeQueued = int(time.time())
         self.timeSent = None
     
-        self.lock = threading.Lock()
-        #print "** JobTicket.__init__: lock=%s" % self.lock
-    
-        self.lock.acquire()
         self.result = None
     
-        self.reqSentLock = threading.Lock()
-        self.reqSentLock.acquire()
+        # set when the job completes, and when it was sent to the node
+        self._done = threading.Event()
+        self._sent = threading.Event()
+    
+        # guards the done callbacks and the future
+        self._doneLock = threading.Lock()
+        self._doneCallbacks = []
+        self._future = None
     
 
     def isComplete(self):
         """
         Returns True if the job has been completed
         """
-        return self.result != None
+        return self._done.is_set()
+    
+
+    def done(self):
+        """
+        Returns True if the job has been completed, like Future.done()
+        """
+        return self._done.is_set()
     
 
     def wait(self, timeout=None):
@@ -2903,55 +3518,23 @@ class JobTicket:
     
         # wait forever for job to complete, if no timeout given
         if timeout is None:
-            log(DEBUG, "wait:%s:%s: no timeout" % (self.cmd, self.id))
-            while not self.lock.acquire(False):
-                time.sleep(_pollInterval)
-            self.lock.release()
+            self._done.wait()
             return self.getResult()
     
-        # wait for timeout
-        then = int(time.time())
+        deadline = time.monotonic() + timeout
     
         # ensure command has been sent, wait if not
-        while not self.reqSentLock.acquire(False):
-    
-            # how long have we waited?
-            elapsed = int(time.time()) - then
-    
-            # got any time left?
-            if elapsed < timeout:
-                # yep, patience remains
-                time.sleep(_pollInterval)
-                log(DEBUG, "wait:%s:%s: job not dispatched, timeout in %ss" % \
-                     (self.cmd, self.id, timeout-elapsed))
-                continue
-    
-            # no - timed out waiting for job to be sent to node
+        if not self._sent.wait(min(timeout, threading.TIMEOUT_MAX)):
+            # timed out waiting for job to be sent to node
             log(DEBUG, "wait:%s:%s: timeout on send command" % (self.cmd, self.id))
             raise FCPSendTimeout(
                     header="Command '%s' took too long to be sent to node" % self.cmd
                     )
     
-        log(DEBUG, "wait:%s:%s: job now dispatched" % (self.cmd, self.id))
-    
         # wait now for node response
-        while not self.lock.acquire(False):
-            # how long have we waited?
-            elapsed = int(time.time()) - then
-    
-            # got any time left?
-            if elapsed < timeout:
-                # yep, patience remains
-                time.sleep(_pollInterval)
-    
-                #print "** lock=%s" % self.lock
-    
-                if timeout < ONE_YEAR:
-                    log(DEBUG, "wait:%s:%s: awaiting node response, timeout in %ss" % \
-                         (self.cmd, self.id, timeout-elapsed))
-                continue
-    
-            # no - timed out waiting for node to respond
+        remaining = max(0, deadline - time.monotonic())
+        if not self._done.wait(min(remaining, threading.TIMEOUT_MAX)):
+            # timed out waiting for node to respond
             log(DEBUG, "wait:%s:%s: timeout on node response" % (self.cmd, self.id))
             raise FCPNodeTimeout(
                     header="Command '%s' took too long for node response" % self.cmd
@@ -2959,18 +3542,51 @@ class JobTicket:
     
         log(DEBUG, "wait:%s:%s: job complete" % (self.cmd, self.id))
     
-        # if we get here, we got the lock, command completed
-        self.lock.release()
-    
         # and we have a result
         return self.getResult()
     
 
-    def waitTillReqSent(self):
+    def waitTillReqSent(self, timeout=None):
         """
         Waits till the request has been sent to node
+        
+        Returns False if the timeout expired first, otherwise True
+        """
+        if timeout is not None:
+            timeout = min(timeout, threading.TIMEOUT_MAX)
+        return self._sent.wait(timeout)
+    
+
+    def add_done_callback(self, fn):
+        """
+        Arranges for fn(job) to be called when the job completes, like
+        Future.add_done_callback()
+        
+        If the job is already complete, fn is called right away,
+        otherwise it is called from the manager thread, so it should
+        not block.
         """
-        self.reqSentLock.acquire()
+        with self._doneLock:
+            if not self._done.is_set():
+                self._doneCallbacks.append(fn)
+                return
+        self._runDoneCallback(fn)
+    
+
+    def asFuture(self):
+        """
+        Returns a concurrent.futures.Future which completes with this job
+        
+        Its result is the job result, or the exception the job failed
+        with. The same future is returned on every call.
+        """
+        with self._doneLock:
+            if self._future is None:
+                self._future = concurrent.futures.Future()
+                self._future.set_running_or_notify_cancel()
+                if self._done.is_set():
+                    self._resolveFuture()
+            return self._future
     
 
     def getResult(self):
@@ -3023,6 +3639,14 @@ class JobTicket:
         self.msgs.append(msg)
     
 
+    def _markSent(self):
+        """
+        Called by manager thread once the request went out to the node
+        """
+        self.timeSent = time.time()
+        self._sent.set()
+    
+
     def _putResult(self, result):
         """
         Called by manager thread to indicate job is complete,
@@ -3035,15 +3659,44 @@ class JobTicket:
                 del self.node.jobs[self.id]
             except:
                 pass
+        else:
+            self.node.jobs.jobCompleted(self)
     
-        #print "** job: lock=%s" % self.lock
+        with self._doneLock:
+            if self._done.is_set():
+                # later results (persistent jobs) just update self.result
+                return
+            # a job which failed before it was sent must not keep
+            # anyone waiting for the send
+            self._sent.set()
+            self._done.set()
+            callbacks, self._doneCallbacks = self._doneCallbacks, []
+            if self._future is not None:
+                self._resolveFuture()
     
-        try:
-            self.lock.release()
-        except:
-            pass
+        for fn in callbacks:
+            self._runDoneCallback(fn)
     
-        #print "** job: lock released"
+
+    def _resolveFuture(self):
+        """
+        Hands the result over to the future
+        """
+        if isinstance(self.result, Exception):
+            self._future.set_exception(self.result)
+        else:
+            self._future.set_result(self.result)
+    
+
+    def _runDoneCallback(self, fn):
+        """
+        Calls a done callback, logging instead of raising its errors
+        """
+        try:
+            fn(self)
+        except Exception:
+            self._log(ERROR, "done callback for job %s failed:\n%s" % (
+                self.id, traceback.format_exc()))
     
 
     def __repr__(self):
@@ -3063,7 +3716,416 @@ class JobTicket:
     
         sys.stdout.write(msg)
         sys.stdout.flush()
-    
+
+
+
+class JobRecord:
+    """
+    What we know about a request we did not start ourselves, such as
+    another client's request on the global queue, or a persistent
+    request left over from an earlier connection
+
+    It is a light stand-in for a JobTicket: it keeps the message it was
+    first seen with, only the latest of the messages listing it, and
+    its result, but cannot be waited on.
+
+    Attributes of interest are those of JobTicket: id, cmd, kw, msgs,
+    result, isPersistent and isGlobal.
+    """
+
+    __slots__ = ('node', 'id', 'cmd', 'kw', 'msgs', 'result', 'keep',
+                 'isPersistent', 'isGlobal', 'mimetype', 'uri',
+                 'gotPersistentDataFound', '_complete')
+
+    # we never send somebody else's request again
+    followRedirect = False
+    stream = None
+    streamFlush = 0
+
+    def __init__(self, node, id, cmd, kw):
+        self.node = node
+        self.id = id
+        self.cmd = cmd
+        self.kw = kw
+        self.msgs = []
+        self.result = None
+        self.keep = False
+        self.isPersistent = (
+            kw.get("Persistent", "connection") != "connection" or
+            kw.get("PersistenceType", "connection") != "connection")
+        self.isGlobal = kw.get('Global', 'false') == 'true'
+        self._complete = False
+
+
+    def isComplete(self):
+        """
+        Returns True if the node reported the request as finished
+        """
+        return self._complete
+
+    done = isComplete
+    getResult = JobTicket.getResult
+    cancel = JobTicket.cancel
+    __repr__ = JobTicket.__repr__
+
+    def callback(self, status, value):
+        """
+        Nobody here asked for the progress of this request
+        """
+
+
+    def _appendMsg(self, msg):
+        # the node lists the request again on every refresh
+        self.msgs = [msg]
+
+
+    def _markSent(self):
+        pass
+
+
+    def _putResult(self, result):
+        self.result = result
+        self._complete = True
+        if not (self.isPersistent or self.isGlobal):
+            self.node.jobs.pop(self.id, None)
+        else:
+            self.node.jobs.jobCompleted(self)
+
+
+
+class JobRegistry(dict):
+    """
+    The jobs of an FCPNode, keyed by request identifier
+
+    A dict of JobTicket objects for our own requests, and of JobRecord
+    placeholders for requests we only hear about. Persistent, global
+    and keep=True jobs stay after they complete, so that their results
+    can still be looked up; how many of them stay, and for how long,
+    can be limited.
+
+    >>> jobs = JobRegistry(maxCompleted=1)
+    >>> for id in ('a', 'b'):
+    ...     record = jobs.placeholder(None, id, 'PersistentPut',
+    ...                               {'Global': 'true'})
+    ...     record.result = 'CHK@' + id
+    ...     record._complete = True
+    ...     jobs.jobCompleted(record)
+    >>> sorted(jobs), jobs.evicted
+    (['b'], 1)
+    >>> jobs.footprint()['records']
+    1
+    """
+
+    def __init__(self, maxCompleted=None, completedTTL=None):
+        """
+        Keywords:
+            - maxCompleted - how many completed jobs to keep at most,
+              None for no limit
+            - completedTTL - how many seconds to keep completed jobs,
+              None for no limit
+        """
+        dict.__init__(self)
+        self.maxCompleted = maxCompleted
+        self.completedTTL = completedTTL
+
+        # the ids of the completed jobs we keep, oldest first, with
+        # the time they completed
+        self._completed = collections.OrderedDict()
+
+        #: how many completed jobs were evicted so far
+        self.evicted = 0
+
+
+    def placeholder(self, node, id, cmd, msg):
+        """
+        Registers and returns a JobRecord for a request we did not
+        start, first seen in the given message
+        """
+        record = JobRecord(node, id, cmd, msg)
+        self[id] = record
+        return record
+
+
+    def jobCompleted(self, job):
+        """
+        Called when a job which stays registered has completed, so
+        that it can be evicted later
+        """
+        if self.get(job.id, None) is not job:
+            return
+        self._completed.pop(job.id, None)
+        self._completed[job.id] = time.monotonic()
+        self.evict()
+
+
+    def evict(self):
+        """
+        Drops the completed jobs which are beyond the limits
+
+        Returns the number of jobs dropped.
+        """
+        completed = self._completed
+        if self.completedTTL is not None:
+            expired = time.monotonic() - self.completedTTL
+        else:
+            expired = None
+        dropped = 0
+        while completed:
+            id, when = next(iter(completed.items()))
+            if not ((self.maxCompleted is not None
+                     and len(completed) > self.maxCompleted)
+                    or (expired is not None and when < expired)):
+                break
+            del completed[id]
+            dict.pop(self, id, None)
+            dropped += 1
+        self.evicted += dropped
+        return dropped
+
+
+    def footprint(self):
+        """
+        Reports roughly how much memory the registered jobs take
+
+        Returns a dict with the number of 'tickets', 'records' and
+        'completed' jobs, and the approximate 'bytes' they hold,
+        counting their fields, messages and results, but not data
+        shared with other objects.
+        """
+        size = sys.getsizeof(self) + sys.getsizeof(self._completed)
+        tickets = records = 0
+        for id, job in list(self.items()):
+            size += sys.getsizeof(id) + sys.getsizeof(job)
+            if isinstance(job, JobRecord):
+                records += 1
+            else:
+                tickets += 1
+                size += sys.getsizeof(job.__dict__)
+            kw = job.kw
+            size += sys.getsizeof(kw)
+            if type(kw) is dict:
+                size += sum(sys.getsizeof(v) for v in kw.values())
+            size += sys.getsizeof(job.msgs)
+            size += sum(sys.getsizeof(msg) for msg in job.msgs if msg is not kw)
+            result = job.result
+            if isinstance(result, tuple):
+                size += sum(sys.getsizeof(v) for v in result)
+            elif result is not None and result is not job.msgs:
+                size += sys.getsizeof(result)
+        return {'tickets': tickets, 'records': records,
+                'completed': len(self._completed), 'bytes': size}
+
+
+    def __delitem__(self, id):
+        dict.__delitem__(self, id)
+        self._completed.pop(id, None)
+
+
+    def pop(self, id, *default):
+        self._completed.pop(id, None)
+        return dict.pop(self, id, *default)
+
+
+    def clear(self):
+        dict.clear(self)
+        self._completed.clear()
+
+
+
+class AdaptiveLimiter:
+    """
+    A limit on how many requests bulk operations keep in flight, which
+    adapts to how well the node copes
+
+    The limit grows by about one for every limit's worth of requests
+    which complete in good time (additive increase), and is cut in half
+    (multiplicative decrease), at most once per limit's worth of
+    requests, when the node shows that it is overloaded:
+        - a get or insert fails with one of the codes in
+          overloadGetCodes or overloadPutCodes
+        - a request times out
+        - requests take much longer than they used to: latencyFactor
+          times the lowest average latency seen
+        - the node's own load figures, which are polled every
+          loadInterval seconds with GetNode if the limiter has a node,
+          show a long bandwidth limiter delay or ping time
+
+    One limiter can be shared by several bulk operations, which then
+    share its limit between them: pass it as the concurrency of
+    getmany() or putmany(), or as maxconcurrent to putdir().
+
+    Requests are counted with acquire(), which returns a token, and
+    release(token, result) once they completed.
+
+    >>> limiter = AdaptiveLimiter(initial=4)
+    >>> tokens = [limiter.acquire() for i in range(4)]
+    >>> limiter.acquire(blocking=False) is None
+    True
+    >>> for token in tokens:
+    ...     limiter.release(token, 'CHK@...')
+    >>> limiter.release(limiter.acquire(), 'CHK@...')
+    >>> limiter.limit
+    5
+    >>> limiter.release(limiter.acquire(), FCPPutFailed(Code=4))
+    >>> limiter.limit
+    2
+    """
+
+    def __init__(self, node=None, initial=10, minLimit=1, maxLimit=256,
+                 latencyFactor=4.0, loadInterval=60.0):
+        """
+        Keywords:
+            - node - the FCPNode whose load to poll, default None for
+              no polling
+            - initial - the limit to start with, default 10
+            - minLimit, maxLimit - the range of the limit, default 1
+              to 256
+            - latencyFactor - how many times its usual latency a request
+              may take before the node counts as overloaded, default 4
+            - loadInterval - seconds between polls of the node's load,
+              default 60
+        """
+        self.node = node
+        self.minLimit = minLimit
+        self.maxLimit = maxLimit
+        self.latencyFactor = latencyFactor
+        self.loadInterval = loadInterval
+
+        self._limit = float(min(max(initial, minLimit), maxLimit))
+        self._cond = threading.Condition()
+
+        #: requests acquired and not released
+        self.inflight = 0
+
+        #: moving average of the latency of successful requests, and the
+        #: lowest it has been, in seconds
+        self.latency = None
+        self.baseLatency = None
+
+        #: how often the limit was cut
+        self.backoffs = 0
+
+        # requests completed since the limit was last cut, so that one
+        # burst of failures only cuts it once
+        self._sinceBackoff = self._limit
+
+        self._lastPoll = time.monotonic()
+        self._polling = False
+
+
+    @property
+    def limit(self):
+        """
+        The current limit on requests in flight
+        """
+        return int(self._limit)
+
+
+    def acquire(self, blocking=True, timeout=None):
+        """
+        Waits for room for one more request in flight
+
+        Returns a token to pass to release(), or None if blocking is
+        False and there is no room, or the timeout expired.
+        """
+        with self._cond:
+            if not blocking:
+                timeout = 0
+            if not self._cond.wait_for(lambda: self.inflight < self.limit,
+                                       timeout):
+                return None
+            self.inflight += 1
+            return time.monotonic()
+
+
+    def release(self, token, result=None):
+        """
+        Gives back the room of a request, and learns from its result if
+        one is given, which may be the exception the request failed with
+        """
+        with self._cond:
+            self.inflight -= 1
+            if result is not None:
+                self._record(result, time.monotonic() - token)
+            self._cond.notify_all()
+        if result is not None:
+            self.poll()
+
+
+    def observeLoad(self, nodeData):
+        """
+        Backs off if the node's volatile statistics, as returned by
+        FCPNode.refstats(WithVolatile=True), show it is overloaded
+        """
+        if not hasattr(nodeData, 'get'):
+            return
+        for field, threshold in overloadLoadFields.items():
+            try:
+                value = float(nodeData.get(field, 0))
+            except (TypeError, ValueError):
+                continue
+            if value > threshold:
+                with self._cond:
+                    self._backOff()
+                return
+
+
+    def poll(self):
+        """
+        Asks the node for its load, if the limiter has a node and it is
+        time to
+        """
+        node = self.node
+        if node is None or self._polling \
+        or time.monotonic() - self._lastPoll < self.loadInterval:
+            return
+        self._polling = True
+        self._lastPoll = time.monotonic()
+        try:
+            # with an identifier of its own, the reply cannot be mixed
+            # up with the replies for '__global'
+            job = node._submitCmd(node._getUniqueId(), "GetNode",
+                                  WithVolatile=True, **{"async": True})
+        except Exception:
+            self._polling = False
+            return
+        job.add_done_callback(self._onLoad)
+
+
+    def _onLoad(self, job):
+        self._polling = False
+        self.observeLoad(job.result)
+
+
+    def _record(self, result, latency):
+        self._sinceBackoff += 1
+        if isinstance(result, Exception):
+            if _isOverload(result):
+                self._backOff()
+            return
+
+        if self.latency is None:
+            self.latency = latency
+        else:
+            self.latency = 0.8 * self.latency + 0.2 * latency
+        if self.baseLatency is None or self.latency < self.baseLatency:
+            self.baseLatency = self.latency
+
+        if self.latency > self.baseLatency * self.latencyFactor:
+            self._backOff()
+            # what counts as usual adapts to a node which stays slow
+            self.baseLatency *= 1.5
+        else:
+            self._limit = min(self._limit + 1.0 / self._limit, self.maxLimit)
+
+
+    def _backOff(self):
+        if self._sinceBackoff < self._limit:
+            return
+        self._sinceBackoff = 0
+        self._limit = max(self._limit / 2, self.minLimit)
+        self.backoffs += 1
+
 
 
 
@@ -3157,18 +4219,193 @@ def readdir(dirpath, prefix='', gethashes=False):
     
     return entries
 
+def getDataLength(data):
+    """
+    Returns the number of bytes a data payload will send
+
+    Works for bytes-like objects and for file objects which are regular
+    files or seekable; for those it counts from the current position.
+    Raises ValueError for other data, such as iterables of chunks.
+
+    >>> getDataLength(b"abc")
+    3
+    >>> getDataLength(memoryview(b"abcd")[1:])
+    3
+    >>> import io
+    >>> f = io.BytesIO(b"12345")
+    >>> _ = f.seek(2)
+    >>> getDataLength(f)
+    3
+    """
+    if isinstance(data, str):
+        return len(data.encode('utf-8'))
+    if isinstance(data, (bytes, bytearray, memoryview)):
+        return memoryview(data).nbytes
+    if hasattr(data, "read"):
+        if _isRegularFile(data):
+            return max(0, os.fstat(data.fileno()).st_size - data.tell())
+        try:
+            if data.seekable():
+                pos = data.tell()
+                end = data.seek(0, os.SEEK_END)
+                data.seek(pos)
+                return end - pos
+        except (AttributeError, OSError):
+            pass
+    raise ValueError("Cannot determine the length of %r, "
+                     "please pass it as datalength" % (data,))
+
+def complexDirCommand(msgLines, payloads=()):
+    """
+    Returns a ClientPutComplexDir command as segments for the rawcmd
+    keyword of _submitCmd, so that its payloads are read only while it
+    is sent
+    
+    Arguments:
+        - msgLines - the lines of the message, without the final
+          'Data' or 'EndMessage'
+        - payloads - a (source, length) tuple for each file with
+          UploadFrom=direct, in the order of their Files.N entries. A
+          source is a path, which is opened when its turn comes, a
+          bytes-like object or a file object
+    
+    >>> cmd = complexDirCommand(["ClientPutComplexDir", "Files.0.Name=a",
+    ...                          "Files.0.UploadFrom=direct",
+    ...                          "Files.0.DataLength=3"], [(b"abc", 3)])
+    >>> cmd[0].split()[-2:], cmd[1:]
+    ([b'Files.0.DataLength=3', b'Data'], [(b'abc', 3)])
+    """
+    payloads = list(payloads)
+    msgLines = list(msgLines) + ["Data" if payloads else "EndMessage"]
+    header = ("\n".join(msgLines) + "\n").encode("utf-8")
+    return [header] + payloads
+
+def _raise(e):
+    """
+    Raises e, for passing as a callable
+    """
+    raise e
+
+
+def _isOverload(exc):
+    """
+    Whether a request failed because the node is overloaded
+    """
+    if isinstance(exc, (FCPSendTimeout, FCPNodeTimeout)):
+        return True
+    if isinstance(exc, FCPGetFailed):
+        codes = overloadGetCodes
+    elif isinstance(exc, FCPPutFailed):
+        codes = overloadPutCodes
+    else:
+        return False
+    try:
+        return int(exc.info.get('Code', 0)) in codes
+    except (AttributeError, TypeError, ValueError):
+        return False
+
+
+def _isRegularFile(f):
+    """
+    Returns True if the file object is backed by a regular file
+    """
+    try:
+        return stat.S_ISREG(os.fstat(f.fileno()).st_mode)
+    except (AttributeError, OSError, ValueError):
+        # no fileno, e.g. io.BytesIO
+        return False
+
+def gatewayPath(host=defaultFCPHost, port=defaultFCPPort):
+    """
+    Returns the pathname of the socket on which the fcp3 gateway for
+    the node at host:port listens
+    
+    >>> os.path.basename(gatewayPath("127.0.0.1", 9481)).endswith("-127.0.0.1-9481.sock")
+    True
+    """
+    uid = getattr(os, "getuid", lambda: 0)()
+    return os.path.join(defaultGatewayDir,
+                        "fcp3-gateway-%s-%s-%s.sock" % (uid, host, int(port)))
+
+
+def checkPrivate(path, create=False):
+    """
+    Makes sure that path, a directory or a socket, belongs to us and
+    is not open to other users, so that nobody else can listen in on
+    the requests sent through a gateway socket in it
+    
+    With create, a missing directory is created with mode 0700.
+    Raises GatewayNotPrivate if path is somebody else's, or open to
+    the group or other users.
+    
+    >>> d = tempfile.mkdtemp()
+    >>> checkPrivate(os.path.join(d, "gw"), create=True)
+    >>> os.chmod(d, 0o755)
+    >>> checkPrivate(d) # doctest: +ELLIPSIS
+    Traceback (most recent call last):
+        ...
+    fcp3.node.GatewayNotPrivate: ... is open to other users
+    """
+    if create:
+        try:
+            os.mkdir(path, 0o700)
+        except FileExistsError:
+            pass
+    st = os.lstat(path)
+    if not (stat.S_ISDIR(st.st_mode) or stat.S_ISSOCK(st.st_mode)):
+        raise GatewayNotPrivate("%s is neither a directory nor a socket" % path)
+    if hasattr(os, "getuid") and st.st_uid != os.getuid():
+        raise GatewayNotPrivate("%s belongs to uid %s, not to us" % (
+            path, st.st_uid))
+    if stat.S_ISDIR(st.st_mode) and st.st_mode & 0o077:
+        raise GatewayNotPrivate("%s is open to other users" % path)
+
+
+def digestFile(path, *hashes, chunkSize=hashChunkSize):
+    """
+    Feeds the contents of a file to several hash objects in one pass,
+    reading it in chunks into one buffer, so that memory use does not
+    grow with the size of the file
+
+    Arguments:
+        - path - the file to read
+        - hashes - hashlib objects, which may already have been fed a
+          prefix, as for sha256dda()
+
+    Returns the hashes, for the caller to take the digests.
+
+    >>> oslevelid, filepath = tempfile.mkstemp()
+    >>> with open(filepath, "wb") as f:
+    ...     n = f.write(b"test" * 1000)
+    >>> sha1, dda = digestFile(filepath, hashlib.sha1(), hashlib.sha256(b"1-2-"), chunkSize=100)
+    >>> sha1.hexdigest() == hashlib.sha1(b"test" * 1000).hexdigest()
+    True
+    >>> dda.digest() == hashlib.sha256(b"1-2-" + b"test" * 1000).digest()
+    True
+    """
+    buf = bytearray(chunkSize)
+    view = memoryview(buf)
+    with open(path, "rb", buffering=0) as f:
+        while True:
+            n = f.readinto(buf)
+            if not n:
+                break
+            chunk = view[:n]
+            for h in hashes:
+                h.update(chunk)
+    return hashes
+
 def hashFile(path):
     """
     returns an SHA(1) hash of a file's contents
 
     >>> oslevelid, filepath = tempfile.mkstemp(text=True)
     >>> with open(filepath, "w") as f:
-    ...     f.write("test")
-    >>> hashFile(filepath) == hashlib.sha1("test").hexdigest()
+    ...     n = f.write("test")
+    >>> hashFile(filepath) == hashlib.sha1(b"test").hexdigest()
     True
     """
-    raw = open(path, "rb").read()
-    return hashlib.sha1(raw).hexdigest()
+    return digestFile(path, hashlib.sha1())[0].hexdigest()
 
 def sha256dda(nodehelloid, identifier, path=None):
     """
@@ -3176,12 +4413,12 @@ def sha256dda(nodehelloid, identifier, path=None):
 
     >>> oslevelid, filepath = tempfile.mkstemp(text=True)
     >>> with open(filepath, "wb") as f:
-    ...     f.write("test")
-    >>> print sha256dda("1","2",filepath) == hashlib.sha256("1-2-" + "test").digest()
+    ...     n = f.write(b"test")
+    >>> sha256dda("1","2",filepath) == hashlib.sha256(b"1-2-" + b"test").digest()
     True
     """
-    tohash = b"-".join([nodehelloid.encode('utf-8'), identifier.encode('utf-8'), open(path, "rb").read()])
-    return hashlib.sha256(tohash).digest()
+    prefix = b"-".join([nodehelloid.encode('utf-8'), identifier.encode('utf-8'), b""])
+    return digestFile(path, hashlib.sha256(prefix))[0].digest()
 
 def guessMimetype(filename):
     """
@@ -3329,6 +4566,40 @@ def base64decode(enc):
 
 
 
+def benchmarkDispatch(msgs, repeat=1000, node=None):
+    """
+    Measures how fast FCPNode dispatches messages from the node to
+    their handlers
+    
+    Arguments:
+        - msgs - a list of messages, as dicts with a 'header' key
+    Keywords:
+        - repeat - how often to dispatch the whole list
+        - node - the FCPNode whose handlers to use; by default one without
+          a connection is made, so no node is needed
+    
+    Returns messages per second.
+    
+    >>> progress = {'header': 'SimpleProgress', 'Identifier': 'x', 'Total': 10}
+    >>> benchmarkDispatch([progress], repeat=10) > 0
+    True
+    """
+    if node is None:
+        node = FCPNode.__new__(FCPNode)
+        node.running = False
+        node.verbosity = SILENT
+        node.logfile = None
+        node.logfunc = None
+        node.jobs = JobRegistry()
+        node._initHandlers()
+    start = time.perf_counter()
+    for i in range(repeat):
+        for msg in msgs:
+            node._on_rxMsg(msg)
+    elapsed = max(time.perf_counter() - start, 1e-9)
+    return len(msgs) * repeat / elapsed
+
+
 def _base30hex(integer):
     """Turn an integer into a simple lowercase base30hex encoding."""
     base30 = "0123456789abcdefghijklmnopqrst"
@@ -7,13 +7,27 @@ Safe method for reading files in the pseudo python syntax used for storing pyFre
 This CANNOT read all kinds of python files. It is purely a specialized
 reader for a very restricted subset of python code.
 
-It uses json for reading more complex assignments.
+It uses json for reading more complex assignments. Values written as
+json, as freesitemgr writes them, are decoded straight from the text.
+Others are collected line by line until the brackets which open them
+are closed, and then parsed once. Either way reading a file takes time
+linear in its size.
 """
 
 # this requires at least python 2.6.
 import json
 import logging
 import re
+import time
+
+
+# the characters which open and close strings and nested values
+_tokens = re.compile(r'''[\\"'\[\]{}]''')
+
+# the start of an assignment of a list or a dict
+_complexStart = re.compile(r" = [\[{]")
+
+_decoder = json.JSONDecoder()
 
 
 # Firstoff we need a reader which can be given consecutive lines and parse these into a dictionary of variables.
@@ -40,20 +54,43 @@ class Parser:
         ...   ]
         ...   ''')['c'][0]['d']
         [1, 2, 3, None, False, True, 'e']
+        >>> p = Parser()
+        >>> p.parse('''files = [
+        ...   {
+        ...     "name": "a]b}.html",
+        ...     "note": "it's [",
+        ...     "quote": "say \\\\"}\\\\""
+        ...   }
+        ... ]
+        ... x = 2''')
+        {'files': [{'name': 'a]b}.html', 'note': "it's [", 'quote': 'say "}"'}], 'x': 2}
         """
         self.data = {}
         self.unparsed = []
         self.endunparsed = None
-        self.startunparsed = None
-        self.endnesting = 0
         self.unparsedvariable = None
+        # how deeply nested the unparsed value is at the end of its text
+        self.depth = 0
     
     def parse(self, text):
-        for line in text.splitlines():
-            self.readline(line)
+        pos = 0
+        end = len(text)
+        while pos < end:
+            nl = text.find("\n", pos)
+            if nl < 0:
+                nl = end
+            line = text[pos:nl].rstrip("\r")
+            after = None
+            if not self.unparsed:
+                after = self.decodevalue(text, pos, line)
+            if after is None:
+                self.readline(line)
+                after = nl + 1
+            pos = after
         # if unparsed code remains, that is likely an error in the code.
-        if self.unparsedstring.strip() or self.endunparsed:
-            raise ValueError("Invalid or too complex code: " + self.endunparsed + "\n" + self.unparsed)
+        if self.unparsed:
+            raise ValueError("Invalid or too complex code: %s is missing a %s\n%s" % (
+                self.unparsedvariable, self.endunparsed, self.unparsedstring))
         return self.data
     
     def jsonload(self, text):
@@ -122,53 +159,84 @@ class Parser:
         """Join and return self.unparsed as a string."""
         return "\n".join(self.unparsed)
     
+    def decodevalue(self, text, pos, line):
+        """Decode a list or dict assigned in the line at pos as json.
+        
+        Returns where the next line starts, or None if the line does not
+        assign a list or dict, or it is not plain json.
+        """
+        match = _complexStart.search(line)
+        if match is None:
+            return None
+        try:
+            value, stop = _decoder.raw_decode(text, pos + match.start() + 3)
+        except ValueError:
+            return None
+        nl = text.find("\n", stop)
+        if nl < 0:
+            nl = len(text)
+        if text[stop:nl].strip():
+            # more after the value
+            return None
+        self.data[line[:match.start()]] = value
+        return nl + 1
+    
     def checkandprocessunprocessed(self):
-        """Check if the rest of self.unprocessed finishes the line."""
-        if self.endunparsed in self.unparsedstring:
-            try:
-                self.data[self.unparsedvariable] = self.jsonload(self.unparsedstring)
-            except ValueError as e:
-                logging.error(
-                    "could not load unparsed string, likely nested datastructures (error: %s). Aggregating more",
-                    str(e))
-                return
-            else:
-                self.unparsed, self.unparsedvariable, self.endunparsed = [], "", ""
+        """Parse self.unparsed once the value it holds is closed."""
+        if self.depth > 0:
+            return
+        self.data[self.unparsedvariable] = self.jsonload(self.unparsedstring)
+        self.unparsed, self.unparsedvariable, self.endunparsed = [], "", ""
+    
+    def nesting(self, line):
+        """Track the nesting of brackets through one line of a value.
+        
+        Brackets in strings do not count. Strings never span lines.
+        
+        >>> p = Parser()
+        >>> p.nesting('''[{"a": "}]", 'b': "it's [", ''')
+        >>> p.depth
+        2
+        """
+        quote = None
+        escaped = -1
+        for match in _tokens.finditer(line):
+            pos = match.start()
+            if pos == escaped:
+                continue
+            c = match.group()
+            if quote:
+                if c == "\\":
+                    escaped = pos + 1
+                elif c == quote:
+                    quote = None
+            elif c == '"' or c == "'":
+                quote = c
+            elif c == "[" or c == "{":
+                self.depth += 1
+            elif c == "]" or c == "}":
+                self.depth -= 1
     
     def readline(self, line):
         """Read one line of text."""
-        # if we have unparsed code and this line does not end it, we just add the code to the unparsed code.
-        if self.unparsed and not self.endunparsed:
-            raise ValueError("We have unparsed data but we do not know how it ends. THIS IS A BUG.")
-        
-        if self.unparsed and self.endunparsed:
+        # if we have unparsed code, this line continues it
+        if self.unparsed:
             self.unparsed.append(line)
-        
-        if self.unparsed and self.endunparsed and not line.strip().endswith(self.endunparsed):
-            return # line is already processed as far as possible
-        if self.unparsed and self.endunparsed and line.strip().endswith(self.endunparsed):
-            # json uses null for None, true for True and false for False. 
-            # We have to replace those in the content and hope that nothing will break.
+            self.nesting(line)
             self.checkandprocessunprocessed()
             return
         
         # start reading complex datastructures
-        if " = [" in line:
-            start = line.index(" = [")
-            self.unparsedvariable = line[:start]
-            self.unparsed = [line[start+3:]]
-            self.endnesting += 1
-            self.endunparsed = "]"
-            self.checkandprocessunprocessed()
-            return
-        elif " = {" in line:
-            start = line.index(" = {")
-            self.unparsedvariable = line[:start]
-            self.unparsed = [line[start+3:]]
-            self.endnesting += 1
-            self.endunparsed = "}"
-            self.checkandprocessunprocessed()
-            return
+        for opening, closing in (("[", "]"), ("{", "}")):
+            if " = " + opening in line:
+                start = line.index(" = " + opening)
+                self.unparsedvariable = line[:start]
+                self.unparsed = [line[start+3:]]
+                self.endunparsed = closing
+                self.depth = 0
+                self.nesting(self.unparsed[0])
+                self.checkandprocessunprocessed()
+                return
         
         # handle the easy cases
         # ignore empty lines
@@ -216,6 +284,52 @@ class Parser:
         # if we did not return by now, the file is malformed (or too complex)
         raise ValueError("Invalid or too complex code: " + line)
 
+def benchmark(counts=(10000, 100000, 1000000)):
+    """
+    Measures how long parsing freesitemgr state files with many file
+    records takes
+
+    The files are written the way SiteState.save() writes them.
+
+    Returns a list of (records, bytes, seconds).
+
+    >>> [n for n, size, seconds in benchmark([10])]
+    [10]
+    """
+    results = []
+    js = json.JSONEncoder(indent=2)
+    for count in counts:
+        # the stat comes last, as scan() adds it to older records
+        files = [{'name': "dir%d/file%d.html" % (i % 100, i),
+                  'path': "/home/user/site/dir%d/file%d.html" % (i % 100, i),
+                  'hash': "%040x" % i,
+                  'mimetype': "text/html",
+                  'sizebytes': i * 7,
+                  'state': "idle",
+                  'target': "separate",
+                  'uri': "CHK@%043d,%043d,AAMC--8/file%d.html" % (i, i, i),
+                  'id': "freesitemgr|site|dir%d/file%d.html" % (i % 100, i),
+                  'stat': [i * 7, 1500000000000000000 + i, 1000 + i],
+                  } for i in range(count)]
+        text = "\n".join([
+            "# freesitemgr state file for freesite 'site'",
+            "name = " + js.encode("site"),
+            "updateInProgress = False",
+            "# Detailed site contents",
+            "files = " + js.encode(files),
+            ""])
+        del files
+        start = time.perf_counter()
+        Parser().parse(text)
+        results.append((count, len(text), time.perf_counter() - start))
+    return results
+
+
 if __name__ == "__main__":
-    from doctest import testmod
-    testmod()
+    import sys
+    if sys.argv[1:] == ["--benchmark"]:
+        for count, size, seconds in benchmark():
+            print("%8d records, %5d MiB: %.2fs" % (count, size >> 20, seconds))
+    else:
+        from doctest import testmod
+        testmod()
@@ -220,7 +220,7 @@ def main():
     # try to create the node
     try:
         n = node.FCPNode(host=fcpHost, port=fcpPort, verbosity=verbosity,
-                        logfile=sys.stderr)
+                        logfile=sys.stderr, gateway=True)
     except:
         if verbose:
             traceback.print_exc(file=sys.stderr)
@@ -259,7 +259,8 @@ def main():
             data = data.encode('utf-8')
         else:
             try:
-                data = open(infile, "rb").read()
+                # put() streams the file, so it is never fully in memory
+                data = open(infile, "rb")
             except:
                 n.shutdown()
                 usage("Failed to read input from file %s" % repr(infile))
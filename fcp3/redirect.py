@@ -124,7 +124,7 @@ def main():
     # try to create the node
     try:
         n = node.FCPNode(host=fcpHost, port=fcpPort, verbosity=verbosity,
-                         logfile=sys.stderr)
+                         logfile=sys.stderr, gateway=True)
     except:
         if verbose:
             traceback.print_exc(file=sys.stderr)
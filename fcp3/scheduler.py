@@ -0,0 +1,289 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+"""
+Client-side scheduling of the requests FCPNode sends to the node.
+
+FCPNode's manager thread sends requests one at a time over its single
+connection. In the order they were submitted, a burst of thousands of
+bulk inserts would hold up a get somebody is waiting for until all of
+them were on the wire. RequestScheduler decides the order instead.
+
+Requests wait in lanes:
+    - the interactive lane, which is always served first. It takes the
+      commands which are not gets or puts, such as TestDDARequest or
+      ListPeers, and the requests somebody waits for, which are those
+      submitted without async
+    - one lane per PriorityClass, 0 (maximum) to 6 (minimum)
+
+The class lanes share the connection by weight: while several of them
+have requests waiting, each gets a share of the sends proportional to
+its weight in classWeights, so bulk work at a low priority still moves,
+only more slowly. A class lane can also be limited to a number of
+requests in flight, that is sent but not yet completed.
+
+stats() reports the depth of each lane, its requests in flight and how
+long its requests waited to be sent.
+"""
+
+import collections
+import functools
+import queue
+import threading
+import time
+
+
+#: commands which start a get or an insert, and are scheduled by their
+#: PriorityClass
+requestCommands = ('ClientGet', 'ClientPut', 'ClientPutDiskDir',
+                   'ClientPutComplexDir')
+
+#: the share of the sends each PriorityClass gets while several have
+#: requests waiting
+classWeights = {0: 64, 1: 32, 2: 16, 3: 8, 4: 4, 5: 2, 6: 1}
+
+#: the class of requests which do not give a PriorityClass, as for the node
+defaultPriorityClass = 2
+
+#: the name of the lane served before all others
+INTERACTIVE = 'interactive'
+
+
+class RequestScheduler:
+    """
+    The queue of requests waiting to be sent to the node
+
+    It is used like the queue.Queue it replaces: client threads put()
+    JobTickets in, and the manager thread takes them out with
+    get_nowait() until it raises queue.Empty.
+
+    >>> class Job:
+    ...     def __init__(self, cmd, cls=None, interactive=False):
+    ...         self.cmd, self.interactive = cmd, interactive
+    ...         self.kw = {} if cls is None else {'PriorityClass': cls}
+    ...         self.callbacks = []
+    ...     def add_done_callback(self, fn):
+    ...         self.callbacks.append(fn)
+    >>> woken = []
+    >>> sched = RequestScheduler(limits={6: 2}, wakeup=lambda: woken.append(True))
+    >>> for i in range(4):
+    ...     sched.put(Job('ClientPut', 6))
+    >>> sched.put(Job('ClientPut', 1))
+    >>> sched.put(Job('ListPeers'))
+    >>> sent = sched.drain(limited=True)
+    >>> [(job.cmd, job.kw.get('PriorityClass')) for job in sent]
+    [('ListPeers', None), ('ClientPut', 1), ('ClientPut', 6), ('ClientPut', 6)]
+    >>> sched.stats()[6]['queued'], sched.stats()[6]['inflight']
+    (2, 2)
+
+    A request in flight which completes makes room for the next one of
+    its lane, and wakes up the manager thread to send it:
+
+    >>> sent[-1].callbacks[0](sent[-1])
+    >>> woken, [job.kw['PriorityClass'] for job in sched.drain(limited=True)]
+    ([True], [6])
+    """
+
+    def __init__(self, weights=None, limits=None, wakeup=None):
+        """
+        Keywords:
+            - weights - a dict of weights by PriorityClass, overriding
+              those in classWeights
+            - limits - a dict of the most requests each PriorityClass
+              may have in flight, where a missing class is not limited
+            - wakeup - called when a request in flight completes, so
+              that whoever takes the jobs out sends the next one of
+              its lane
+        """
+        self.weights = dict(classWeights)
+        self.weights.update(weights or {})
+        self.limits = dict(limits or {})
+        self.wakeup = wakeup
+
+        self._lock = threading.Lock()
+
+        # (time queued, job) waiting in each lane
+        self._lanes = {}
+
+        # stride scheduling: the virtual time at which each class lane
+        # is due next, advancing by 1/weight per send
+        self._due = {}
+        self._now = 0.0
+
+        self._inflight = collections.Counter()
+
+        # per lane: requests sent, their total and longest wait
+        self._sent = collections.Counter()
+        self._waited = collections.Counter()
+        self._maxWait = {}
+
+
+    def laneFor(self, job):
+        """
+        Returns the lane a job waits in: INTERACTIVE or its PriorityClass
+        """
+        if job.cmd not in requestCommands or getattr(job, 'interactive', False):
+            return INTERACTIVE
+        try:
+            cls = int(job.kw.get('PriorityClass', defaultPriorityClass))
+        except (TypeError, ValueError):
+            cls = defaultPriorityClass
+        return min(max(cls, 0), 6)
+
+
+    def put(self, job):
+        """
+        Queues a job to be sent
+        """
+        lane = self.laneFor(job)
+        with self._lock:
+            waiting = self._lanes.get(lane, None)
+            if waiting is None:
+                waiting = self._lanes[lane] = collections.deque()
+            if not waiting and lane != INTERACTIVE:
+                # a lane which was idle does not save up sends
+                self._due[lane] = max(self._due.get(lane, 0.0), self._now)
+            waiting.append((time.monotonic(), job))
+
+
+    def get_nowait(self):
+        """
+        Returns the job to send next
+
+        Raises queue.Empty if no job is waiting, or all waiting jobs
+        are held back by their in-flight limit.
+        """
+        with self._lock:
+            lane = self._nextLane()
+            if lane is None:
+                raise queue.Empty
+            job = self._take(lane)
+        self._track(lane, job)
+        return job
+
+
+    def drain(self, limited=False):
+        """
+        Takes out all the jobs the in-flight limits let through, or if
+        limited is False, all waiting jobs, in the order they are due
+        """
+        taken = []
+        with self._lock:
+            while True:
+                lane = self._nextLane(limited)
+                if lane is None:
+                    break
+                taken.append((lane, self._take(lane)))
+        for lane, job in taken:
+            self._track(lane, job)
+        return [job for lane, job in taken]
+
+
+    def discard(self, job):
+        """
+        Takes a job out of the queue before it was sent
+
+        Returns False if it was not waiting.
+        """
+        with self._lock:
+            waiting = self._lanes.get(self.laneFor(job), ())
+            for entry in waiting:
+                if entry[1] is job:
+                    waiting.remove(entry)
+                    return True
+        return False
+
+
+    def qsize(self):
+        """
+        Returns the number of jobs waiting
+        """
+        with self._lock:
+            return sum(len(waiting) for waiting in self._lanes.values())
+
+
+    def empty(self):
+        return not self.qsize()
+
+
+    def stats(self):
+        """
+        Returns a dict of statistics by lane
+
+        Each is a dict of:
+            - queued - the number of jobs waiting
+            - oldest - how many seconds the oldest of them has waited
+            - inflight - the number of jobs sent and not yet completed,
+              which is always 0 for the interactive lane
+            - limit - the most jobs allowed in flight, or None
+            - sent - the number of jobs sent so far
+            - meanWait, maxWait - how many seconds they waited to be sent
+        """
+        now = time.monotonic()
+        stats = {}
+        with self._lock:
+            for lane in set(self._lanes) | set(self._sent):
+                waiting = self._lanes.get(lane, ())
+                sent = self._sent[lane]
+                stats[lane] = {
+                    'queued': len(waiting),
+                    'oldest': now - waiting[0][0] if waiting else 0.0,
+                    'inflight': self._inflight[lane],
+                    'limit': self.limits.get(lane, None),
+                    'sent': sent,
+                    'meanWait': self._waited[lane] / sent if sent else 0.0,
+                    'maxWait': self._maxWait.get(lane, 0.0),
+                    }
+        return stats
+
+
+    def _nextLane(self, limited=True):
+        """
+        Picks the lane to take the next job from, None if there is none
+        """
+        if self._lanes.get(INTERACTIVE, None):
+            return INTERACTIVE
+        best = None
+        for lane, waiting in self._lanes.items():
+            if not waiting or lane == INTERACTIVE:
+                continue
+            limit = self.limits.get(lane, None)
+            if limited and limit is not None and self._inflight[lane] >= limit:
+                continue
+            if best is None or (self._due[lane], lane) < (self._due[best], best):
+                best = lane
+        return best
+
+
+    def _take(self, lane):
+        """
+        Takes the next job out of a lane, and accounts for it
+        """
+        queued, job = self._lanes[lane].popleft()
+        wait = time.monotonic() - queued
+        self._sent[lane] += 1
+        self._waited[lane] += wait
+        self._maxWait[lane] = max(self._maxWait.get(lane, 0.0), wait)
+
+        if lane != INTERACTIVE:
+            self._now = self._due[lane]
+            self._due[lane] += 1.0 / self.weights.get(lane, 1)
+            self._inflight[lane] += 1
+        return job
+
+
+    def _track(self, lane, job):
+        """
+        Counts a job taken from a class lane as in flight until it
+        completes
+        """
+        if lane != INTERACTIVE:
+            # outside the lock, as a completed job calls back at once
+            job.add_done_callback(functools.partial(self._finished, lane))
+
+
+    def _finished(self, lane, job):
+        with self._lock:
+            self._inflight[lane] -= 1
+        if self.wakeup is not None:
+            self.wakeup()
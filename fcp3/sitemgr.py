@@ -24,11 +24,14 @@ new persistent SiteMgr class
 
 #@+others
 #@+node:imports
-import sys, os, os.path, io, threading, traceback, pprint, time, stat, json
+import sys, os, os.path, threading, traceback, pprint, time, stat, json
+import collections, collections.abc, concurrent.futures
 
 import fcp3 as fcp
 from fcp3 import CRITICAL, ERROR, INFO, DETAIL, DEBUG, NOISY
 from fcp3.node import hashFile
+from fcp3.linkgraph import LinkGraph
+from fcp3.sitestore import SiteStore, storePath, removeStore, stateBackends
 
 #@-node:imports
 #@+node:globals
@@ -38,6 +41,16 @@ maxretries = -1
 
 defaultMaxConcurrent = 10
 
+# how many CHK calculations to keep running on the chkCalcNode
+defaultChkPipelineDepth = 10
+
+# how many files scan hashes at once
+defaultHashWorkers = 4
+
+# longest time to hold back an insert while the node has not answered
+# the earlier ones, in seconds
+maxInsertPacingWait = 300
+
 testMode = False
 #testMode = True
 
@@ -68,6 +81,17 @@ class SiteMgr:
         
         Keywords:
             - basedir - directory where site records are stored, default ~/.freesitemgr
+            - chkCalcNode - node to calculate CHKs on, default the node we
+              insert through. A list of 'host:port' spreads them over
+              several nodes
+            - chkPipelineDepth - how many CHK calculations to keep
+              running at once, default 10
+            - hashWorkers - how many files to hash at once when looking
+              for changes, default 4
+            - stateBackend - 'sqlite' to keep the file records of the
+              sites in an SQLite database, which saves faster for large
+              sites, or 'file' to keep them in the state file. By default
+              each site keeps what it has
         """
         self.kw = kw
         self.basedir = kw.get('basedir', defaultBaseDir)
@@ -86,6 +110,10 @@ class SiteMgr:
         self.priority = kw.get('priority', defaultPriority)
     
         self.chkCalcNode = kw.get('chkCalcNode', None)
+        self.chkPipelineDepth = kw.get('chkPipelineDepth',
+                                       defaultChkPipelineDepth)
+        self.hashWorkers = kw.get('hashWorkers', defaultHashWorkers)
+        self.stateBackend = kw.get('stateBackend', None)
         self.maxManifestSizeBytes = kw.get("maxManifestSizeBytes", 
                                            defaultMaxManifestSizeBytes)
         self.maxNumberSeparateFiles = kw.get("maxNumberSeparateFiles", 
@@ -129,6 +157,8 @@ class SiteMgr:
                         port=self.fcpPort,
                         verbosity=self.verbosity,
                         name="freesitemgr",
+                        # outlive node restarts during long inserts
+                        reconnect=True,
                         )
         if self.logfile:
             nodeopts['logfile'] = self.logfile
@@ -138,14 +168,25 @@ class SiteMgr:
             self.node = fcp.FCPNode(**nodeopts)
             if not self.chkCalcNode:
                 self.chkCalcNode = self.node
+            elif isinstance(self.chkCalcNode, (list, tuple)):
+                # several nodes to calculate CHKs on, as 'host:port'
+                self.chkCalcNode = fcp.FCPCluster(
+                    self.chkCalcNode, verbosity=self.verbosity,
+                    name="freesitemgr-chk")
     
             self.node.listenGlobal()
+    
+            # how many inserts the sites hand to the node before it has
+            # answered them, following the node's load
+            self.limiter = fcp.node.AdaptiveLimiter(
+                self.node, initial=self.maxConcurrent)
             
             # borrow the node's logger
             self.log = self.node._log
         except Exception as e:
             # limited functionality - no node
             self.node = None
+            self.limiter = None
             self.log = self.fallbackLogger
             self.log(ERROR, "Could not create an FCPNode, functionality will be limited. Reason: %s" % str(e))
     
@@ -168,6 +209,9 @@ class SiteMgr:
                 maxconcurrent=self.maxConcurrent,
                 Verbosity=self.Verbosity,
                 chkCalcNode=self.chkCalcNode,
+                chkPipelineDepth=self.chkPipelineDepth,
+                hashWorkers=self.hashWorkers,
+                stateBackend=self.stateBackend,
                 )
             self.sites.append(site)
     
@@ -239,6 +283,7 @@ class SiteMgr:
                          index=self.index,
                          sitemap=self.sitemap,
                          mtype=self.mtype,
+                         stateBackend=self.stateBackend,
                          **kw)
         self.sites.append(site)
     
@@ -282,11 +327,15 @@ class SiteMgr:
     #@+node:removeSite
     def removeSite(self, name):
         """
-        Removes given site
+        Removes given site, with its SiteStore if it has one
         """
         site = self.getSite(name)
         self.sites.remove(site)
         os.unlink(site.path)
+        if site.store is not None:
+            site.store.close()
+            site.store = None
+        removeStore(storePath(site.basedir, site.name))
     
     #@-node:removeSite
     #@+node:cancelUpdate
@@ -302,8 +351,14 @@ class SiteMgr:
     def insert(self, *sites, **kw):
         """
         Inserts either named site, or all sites if no name given
+        
+        Keywords:
+            - cron - print a dated header for each site
+            - verify - hash all files again, rather than only those
+              whose size or modification time changed
         """
         cron = kw.get('cron', False)
+        verify = kw.get('verify', False)
         if not cron:
             self.securityCheck()
     
@@ -316,7 +371,7 @@ class SiteMgr:
             if cron:
                 print("---------------------------------------------------------------------")
                 print("freesitemgr: updating site '%s' on %s" % (site.name, time.asctime()))
-            site.insert()
+            site.insert(verify=verify)
     
     #@-node:insert
     #@+node:cleanup
@@ -398,6 +453,234 @@ class SiteMgr:
     #@-others
 
 #@-node:class SiteMgr
+#@+node:class FileRecord
+class FileRecord(collections.abc.MutableMapping):
+    """
+    The record of a file of a site
+    
+    It is used as a dict, but keeps the usual keys in slots, and the
+    strings which many records share, such as the state and mimetype,
+    only once, so that sites of many files fit in memory. Keys which a
+    record does not have raise KeyError, as for a dict.
+    
+    A record in a FileRecords tells it when it changes.
+    
+    >>> rec = FileRecord(name='a.html', state='changed', extra=1)
+    >>> rec['state'], 'uri' in rec, rec.get('uri', ''), rec['extra']
+    ('changed', False, '', 1)
+    >>> rec['uri'] = 'CHK@x'
+    >>> sorted(rec.asDict().items())
+    [('extra', 1), ('name', 'a.html'), ('state', 'changed'), ('uri', 'CHK@x')]
+    """
+    # the keys kept in slots, in the order they are saved
+    fields = ('name', 'path', 'mimetype', 'hash', 'sizebytes', 'stat',
+              'uri', 'id', 'state', 'target', 'chkname')
+    # the keys whose values many records share
+    interned = frozenset(('mimetype', 'state', 'target'))
+    _slotted = frozenset(fields)
+    _missing = object()
+
+    __slots__ = fields + ('extra', 'owner')
+
+    def __init__(self, *args, **kw):
+        self.extra = None
+        self.owner = None
+        for key, value in dict(*args, **kw).items():
+            self._set(key, value)
+
+    def __getitem__(self, key):
+        if key in FileRecord._slotted:
+            try:
+                return getattr(self, key)
+            except AttributeError:
+                raise KeyError(key)
+        if self.extra is None:
+            raise KeyError(key)
+        return self.extra[key]
+
+    def __setitem__(self, key, value):
+        if self.owner is not None:
+            self.owner._changing(self, key, value)
+        self._set(key, value)
+
+    def _set(self, key, value):
+        if key in FileRecord.interned and isinstance(value, str):
+            value = sys.intern(value)
+        if key in FileRecord._slotted:
+            setattr(self, key, value)
+        else:
+            if self.extra is None:
+                self.extra = {}
+            self.extra[key] = value
+
+    def __delitem__(self, key):
+        if key not in self:
+            raise KeyError(key)
+        if self.owner is not None:
+            self.owner._changing(self, key, None)
+        if key in FileRecord._slotted:
+            delattr(self, key)
+        else:
+            del self.extra[key]
+
+    def __contains__(self, key):
+        if key in FileRecord._slotted:
+            return hasattr(self, key)
+        return self.extra is not None and key in self.extra
+
+    def __iter__(self):
+        for key in FileRecord.fields:
+            if hasattr(self, key):
+                yield key
+        if self.extra:
+            yield from list(self.extra)
+
+    def __len__(self):
+        return sum(1 for key in self)
+
+    def __repr__(self):
+        return "FileRecord(%r)" % self.asDict()
+
+    def asDict(self):
+        """
+        Returns the record as a dict, for saving
+        """
+        missing = FileRecord._missing
+        d = {}
+        for key in FileRecord.fields:
+            value = getattr(self, key, missing)
+            if value is not missing:
+                d[key] = value
+        if self.extra:
+            d.update(self.extra)
+        return d
+
+#@-node:class FileRecord
+#@+node:class FileRecords
+class FileRecords:
+    """
+    The file records of a site, by name and by state
+    
+    It is iterated like the list of records it replaces, in the order
+    they were added or last sorted in. Looking up a record by name, and
+    finding the records in a state, take time proportional to what is
+    found rather than to the size of the site.
+    
+    >>> files = FileRecords([{'name': 'b', 'state': 'idle'},
+    ...                      {'name': 'a', 'state': 'changed'}])
+    >>> files.byName['b']['state'] = 'changed'
+    >>> [rec['name'] for rec in files.inState('changed', 'waiting')]
+    ['a', 'b']
+    >>> files.count('idle'), len(files)
+    (0, 2)
+    >>> [rec['name'] for rec in files.takeChanged()]
+    ['b']
+    """
+
+    def __init__(self, recs=()):
+        # name -> record
+        self.byName = {}
+        # state -> {name: record}
+        self._states = collections.defaultdict(dict)
+        # records changed, and names removed, since the last take
+        self._changed = {}
+        self._removed = set()
+        for rec in recs:
+            self.append(rec, changed=False)
+
+    def __iter__(self):
+        return iter(list(self.byName.values()))
+
+    def __len__(self):
+        return len(self.byName)
+
+    def __contains__(self, rec):
+        return self.byName.get(rec.get('name', None), None) is rec
+
+    def append(self, rec, changed=True):
+        """
+        Adds a record, turning a dict into a FileRecord
+        
+        Returns the record added.
+        """
+        if not isinstance(rec, FileRecord):
+            rec = FileRecord(rec)
+        name = rec['name']
+        if name in self.byName:
+            self.remove(self.byName[name])
+        rec.owner = self
+        self.byName[name] = rec
+        self._states[rec.get('state', None)][name] = rec
+        if changed:
+            self._changed[name] = rec
+        return rec
+
+    def remove(self, rec):
+        """
+        Takes a record out
+        """
+        name = rec['name']
+        if self.byName.get(name, None) is not rec:
+            raise ValueError("%s is not a record of this site" % name)
+        del self.byName[name]
+        del self._states[rec.get('state', None)][name]
+        self._changed.pop(name, None)
+        self._removed.add(name)
+        rec.owner = None
+
+    def sort(self, key):
+        """
+        Puts the records in the order of key
+        """
+        recs = sorted(self.byName.values(), key=key)
+        self.byName.clear()
+        self.byName.update((rec['name'], rec) for rec in recs)
+
+    def inState(self, *states):
+        """
+        Returns the records in any of the states, sorted by name
+        """
+        found = []
+        for state in states:
+            found.extend(self._states.get(state, {}).values())
+        found.sort(key=lambda rec: rec['name'])
+        return found
+
+    def count(self, state):
+        """
+        Returns how many records are in a state
+        """
+        return len(self._states.get(state, ()))
+
+    def takeChanged(self):
+        """
+        Returns the records changed since the last call
+        """
+        changed = list(self._changed.values())
+        self._changed = {}
+        return changed
+
+    def takeRemoved(self):
+        """
+        Returns the names of the records removed since the last call
+        """
+        removed = self._removed
+        self._removed = set()
+        return removed
+
+    def _changing(self, rec, key, value):
+        # called by a record before it changes
+        name = rec['name']
+        if key == 'state':
+            old = rec.get('state', None)
+            if old != value:
+                del self._states[old][name]
+                self._states[value][name] = rec
+        elif key == 'name':
+            raise ValueError("cannot rename %s in a site" % name)
+        self._changed[name] = rec
+
+#@-node:class FileRecords
 #@+node:class SiteState
 class SiteState:
     """
@@ -436,6 +719,7 @@ class SiteState:
     
         self.sitemgr = kw['sitemgr']
         self.node = self.sitemgr.node
+        self.limiter = getattr(self.sitemgr, 'limiter', None)
         # TODO: at some point this should be configurable per site
         self.maxManifestSizeBytes = self.sitemgr.maxManifestSizeBytes
     
@@ -450,13 +734,19 @@ class SiteState:
         self.uriPub = kw.get('uriPub', '')
         self.uriPriv = kw.get('uriPriv', '')
         self.updateInProgress = True
-        self.files = []
+        self.files = FileRecords()
+        self.filesDict = self.files.byName
         self.maxConcurrent = kw.get('maxconcurrent', defaultMaxConcurrent)
         self.priority = kw.get('priority', defaultPriority)
         self.basedir = kw.get('basedir', defaultBaseDir)
         self.path = os.path.join(self.basedir, self.name)
         self.Verbosity = kw.get('Verbosity', 0)
         self.chkCalcNode = kw.get('chkCalcNode', self.node)
+        # the links between the files, for markManifestFiles
+        self.linkGraph = LinkGraph()
+        self.chkPipelineDepth = kw.get('chkPipelineDepth',
+                                       defaultChkPipelineDepth)
+        self.hashWorkers = kw.get('hashWorkers', defaultHashWorkers)
 
         self.index = kw.get('index', 'index.html')
         self.sitemap = kw.get('sitemap', 'sitemap.html')
@@ -466,8 +756,23 @@ class SiteState:
     
         self.fileLock = threading.Lock()
     
+        # where the file records are kept, see save()
+        self.stateBackend = 'file'
+        self.store = None
+        # whether the store has to be written anew, rather than updated
+        self._storeStale = True
+    
         # get existing record, or create new one
         self.load()
+    
+        # move the file records if asked to; the save does it
+        backend = kw.get('stateBackend', None)
+        if backend and backend != self.stateBackend:
+            if backend not in stateBackends:
+                raise ValueError("Unknown state backend %s, use one of %s" % (
+                    backend, ", ".join(stateBackends)))
+            self.stateBackend = backend
+            self._storeStale = True
         self.save()
     
         # barf if directory is invalid
@@ -509,6 +814,21 @@ class SiteState:
             for k,v in list(d.items()):
                 setattr(self, k, v)
     
+            if self.stateBackend == 'sqlite':
+                # the file records, and the latest variables, are in the store
+                path = storePath(self.basedir, self.name)
+                if not os.path.isfile(path):
+                    raise Exception("Site %s keeps its files in %s, which is missing" % (
+                        self.name, path))
+                self.store = SiteStore(path)
+                variables, self.files = self.store.load()
+                for k,v in list(variables.items()):
+                    setattr(self, k, v)
+                self._storeStale = False
+    
+            # note changes to the records from here on
+            self.files = FileRecords(self.files)
+    
             # a hack here - replace keys if missing
             if not self.uriPriv:
                 self.uriPub, self.uriPriv = self.node.genkey()
@@ -552,9 +872,7 @@ class SiteState:
             #print "load: files=%s" % self.files
     
             # now gotta create lookup table, by name
-            self.filesDict = {}
-            for rec in self.files:
-                self.filesDict[rec['name']] = rec
+            self.filesDict = self.files.byName
     
         finally:
             self.fileLock.release()
@@ -575,7 +893,8 @@ class SiteState:
         self.uriPriv = fixUri(self.uriPriv, self.name)
         self.uriPub = fixUri(self.uriPub, self.name)
     
-        self.files = []
+        self.files = FileRecords()
+        self.filesDict = self.files.byName
     
         # now can save
         self.save()
@@ -585,6 +904,10 @@ class SiteState:
     def save(self):
         """
         Saves the node state
+        
+        With the sqlite backend, the file records go to a SiteStore, which
+        writes only those changed since the last save, and the state file
+        keeps the rest.
         """
         self.log(DETAIL, "save: saving site config to %s" % self.path)
     
@@ -595,77 +918,140 @@ class SiteState:
     
             self.log(DEBUG, "save: got lock")
     
-            confDir = os.path.split(self.path)[0]
-    
-            tmpFile = os.path.join(self.basedir, ".tmp-%s" % self.name)
-            f = open(tmpFile, "w")
-            self.log(DETAIL, "save: writing to temp file %s" % tmpFile)
+            physicalfiles = None
+            if self.stateBackend == 'sqlite':
+                self._saveStore()
+            else:
+                # we should not save generated files.
+                physicalfiles = [rec for rec in self.files 
+                                if 'path' in rec]
+            self._writeStateFile(self.path, physicalfiles)
+        finally:
+            self.fileLock.release()
     
-            pp = pprint.PrettyPrinter(width=72, indent=2, stream=f)
-            js = json.JSONEncoder(indent=2)
-            
-            w = f.write
-    
-            def writeVars(comment="", tail="", **kw):
-                """
-                Pretty-print a 'name=value' line, with optional tail string
-                """
-                if comment:
-                    w("# " + comment + "\n")
-                for name, value in list(kw.items()):
-                    w(name + " = ")
-                    # json fails at True, False, None
-                    if value is True or value is False or value is None:
-                        pp.pprint(value)
-                    else:
-                        w(js.encode(value).lstrip())
-                        w("\n")
-                if comment:
-                    w("\n")
-                w(tail)
-                f.flush()
-    
-            w("# freesitemgr state file for freesite '%s'\n" % self.name)
-            w("# managed by freesitemgr - edit only with the utmost care\n")
-            w("\n")
-    
-            w("# general site config items\n")
-            w("\n")
-    
-            writeVars(name=self.name)
-            writeVars(dir=self.dir)
-            writeVars(uriPriv=self.uriPriv)
-            writeVars(uriPub=self.uriPub)
-            writeVars(updateInProgress=self.updateInProgress)
-            writeVars(insertingManifest=self.insertingManifest)
-            writeVars(insertingIndex=self.insertingIndex)
-            writeVars(index=self.index)
-            writeVars(sitemap=self.sitemap)
-            writeVars(mtype=self.mtype)
-            
-            w("\n")
-            # we should not save generated files.
-            physicalfiles = [rec for rec in self.files 
-                            if 'path' in rec]
-            writeVars("Detailed site contents", files=physicalfiles)
+    #@-node:save
+    #@+node:exportState
+    def exportState(self, path):
+        """
+        Writes the whole state of the site, with all file records, to a
+        state file at path, whichever backend the site uses
+        """
+        with self.fileLock:
+            self._writeStateFile(
+                path, [rec for rec in self.files if 'path' in rec])
     
-            f.close()
+    #@-node:exportState
+    #@+node:_stateVars
+    def _stateVars(self):
+        """
+        Returns the variables of the site, as saved
+        """
+        return dict(
+            name=self.name,
+            dir=self.dir,
+            uriPriv=self.uriPriv,
+            uriPub=self.uriPub,
+            updateInProgress=self.updateInProgress,
+            insertingManifest=self.insertingManifest,
+            insertingIndex=self.insertingIndex,
+            index=self.index,
+            sitemap=self.sitemap,
+            mtype=self.mtype,
+            )
     
+    #@-node:_stateVars
+    #@+node:_saveStore
+    def _saveStore(self):
+        """
+        Writes the records changed since the last save, and the
+        variables, to the SiteStore in one transaction
+        """
+        if self.store is None:
+            self.store = SiteStore(storePath(self.basedir, self.name))
+        # generated files are not saved
+        changed = self.files.takeChanged()
+        removed = self.files.takeRemoved()
+        replace = self._storeStale
+        if replace:
+            changed, removed = self.files, ()
+        changed = [rec.asDict() for rec in changed if 'path' in rec]
+        self.log(DETAIL, "save: %d changed and %d removed files to %s" % (
+            len(changed), len(removed), self.store.path))
+        self.store.save(self._stateVars(), changed, removed, replace=replace)
+        self._storeStale = False
+    
+    #@-node:_saveStore
+    #@+node:_writeStateFile
+    def _writeStateFile(self, path, physicalfiles):
+        """
+        Writes the state file, through a temporary file. physicalfiles
+        None means the file records are in the store.
+        """
+        confDir = os.path.split(path)[0]
+
+        tmpFile = os.path.join(self.basedir, ".tmp-%s" % self.name)
+        f = open(tmpFile, "w")
+        self.log(DETAIL, "save: writing to temp file %s" % tmpFile)
+
+        pp = pprint.PrettyPrinter(width=72, indent=2, stream=f)
+        js = json.JSONEncoder(indent=2)
+        
+        w = f.write
+
+        def writeVars(comment="", tail="", **kw):
+            """
+            Pretty-print a 'name=value' line, with optional tail string
+            """
+            if comment:
+                w("# " + comment + "\n")
+            for name, value in list(kw.items()):
+                w(name + " = ")
+                # json fails at True, False, None
+                if value is True or value is False or value is None:
+                    pp.pprint(value)
+                else:
+                    w(js.encode(value).lstrip())
+                    w("\n")
+            if comment:
+                w("\n")
+            w(tail)
+            f.flush()
+
+        w("# freesitemgr state file for freesite '%s'\n" % self.name)
+        w("# managed by freesitemgr - edit only with the utmost care\n")
+        w("\n")
+
+        w("# general site config items\n")
+        w("\n")
+
+        for name, value in self._stateVars().items():
+            writeVars(**{name: value})
+        
+        w("\n")
+        if physicalfiles is None:
+            writeVars("Detailed site contents are in %s"
+                      % storePath(self.basedir, self.name),
+                      stateBackend=self.stateBackend)
+        else:
+            writeVars("Detailed site contents",
+                      files=[rec.asDict() if isinstance(rec, FileRecord) else rec
+                             for rec in physicalfiles])
+
+        f.close()
+
+        try:
+            if os.path.exists(path):
+                os.unlink(path)
+            #print "tmpFile=%s path=%s" % (tmpFile, path)
+            self.log(DETAIL, "save: %s -> %s" % (tmpFile, path))
+            os.rename(tmpFile, path)
+        except KeyboardInterrupt:
             try:
-                if os.path.exists(self.path):
-                    os.unlink(self.path)
-                #print "tmpFile=%s path=%s" % (tmpFile, self.path)
-                self.log(DETAIL, "save: %s -> %s" % (tmpFile, self.path))
-                os.rename(tmpFile, self.path)
-            except KeyboardInterrupt:
-                try:
-                    f.close()
-                except:
-                    pass
-                if os.path.exists(tmpFile):
-                    os.unlink(tmpFile)
-        finally:
-            self.fileLock.release()
+                f.close()
+            except:
+                pass
+            if os.path.exists(tmpFile):
+                os.unlink(tmpFile)
     
     #@-node:save
     #@+node:getFile
@@ -673,10 +1059,7 @@ class SiteState:
         """
         returns the control record for file 'name'
         """
-        for f in self.files:
-            if f['name'] == name:
-                return f
-        return None
+        return self.filesDict.get(name, None)
     
     #@-node:getFile
     #@+node:cancelUpdate
@@ -691,19 +1074,21 @@ class SiteState:
         self.insertingIndex = False
         self.insertingManifest = False
     
-        for rec in self.files:
-            if rec['state'] == 'inserting':
-                rec['state'] = 'waiting'
+        for rec in self.files.inState('inserting'):
+            rec['state'] = 'waiting'
         self.save()
         
         self.log(INFO, "cancel:%s:update cancelled" % self.name)
     
     #@-node:cancelUpdate
     #@+node:insert
-    def insert(self):
+    def insert(self, verify=False):
         """
         Performs insertion of this site, or gets as far as
         we can, saving along the way so we can later resume
+        
+        With verify, all files are hashed to find the changed ones,
+        see scan()
         """
         log = self.log
 
@@ -737,7 +1122,7 @@ class SiteState:
                     "insert:%s: checking if a new insert is needed" % self.name)
     
         # compare our representation to what's on disk
-        self.scan()
+        self.scan(verify=verify)
         
         # bail if site is already up to date
         if not self.needToUpdate:
@@ -768,54 +1153,52 @@ class SiteState:
     
         # get records of files to insert    
         # TODO: Check whether the CHK top block is retrievable
-        filesToInsert = [r for r in self.files if (r['state'] in ('changed', 'waiting') 
-                                          and not r['target'] == 'manifest')]
+        filesToInsert = [r for r in self.files.inState('changed', 'waiting')
+                         if not r['target'] == 'manifest']
         
-        # compute CHKs for all these files, synchronously, and at the same time,
-        # submit the inserts, asynchronously
+        # compute CHKs for all these files, several at a time, and submit
+        # the inserts, asynchronously, in order as the CHKs come in. Files
+        # whose CHK an interrupted run already has go straight to insert.
         chkCounter = 0
-        for rec in filesToInsert:
-            if rec['state'] == 'waiting':
-                continue
-            log(INFO, "Pre-computing CHK for file %s" % rec['name'])
-            # get the data
-            if 'path' in rec:
-                raw = open(rec['path'],"rb").read()
-            elif rec['name'] in self.generatedTextData:
-                raw = self.generatedTextData[rec['name']].encode("utf-8")
-            else:
-                raise Exception("File %s, has neither path nor generated Text. rec: %s" % (
-                    rec['name'], rec))
-            # precompute the CHK
-            name = rec['name']
-            uri = self.chkCalcNode.genchk(
-                data=raw, 
-                mimetype=rec['mimetype'], 
-                TargetFilename=ChkTargetFilename(name))
+        for rec, uri in self._chkPipeline(filesToInsert, reuse=True):
             rec['uri'] = uri
             rec['state'] = 'waiting'
+            name = rec['name']
     
             # get a unique id for the queue
             id = self.allocId(name)
     
-            # and queue it up for insert, possibly on a different node
+            # rather than the whole site at once, hand the node only as
+            # many inserts as it keeps up with
+            token = None
+            if self.limiter is not None:
+                token = self.limiter.acquire(timeout=maxInsertPacingWait)
+    
+            # and queue it up for insert, possibly on a different node,
+            # streaming the file from disk as it is sent
             # TODO: First check whether the CHK top block is
             #       retrievable (=someone else inserted it).
-            self.node.put(
-                "CHK@",
-                id=id,
-                mimetype=rec['mimetype'],
-                priority=self.priority,
-                Verbosity=self.Verbosity,
-                data=raw,
-                TargetFilename=ChkTargetFilename(name),
-                chkonly=testMode,
-                persistence="forever",
-                Global=True,
-                waituntilsent=True,
-                maxretries=maxretries,
-                **{"async": True}
-                )
+            data = self._openData(rec)
+            try:
+                self.node.put(
+                    "CHK@",
+                    id=id,
+                    mimetype=rec['mimetype'],
+                    priority=self.priority,
+                    Verbosity=self.Verbosity,
+                    data=data,
+                    TargetFilename=ChkTargetFilename(name),
+                    chkonly=testMode,
+                    persistence="forever",
+                    Global=True,
+                    waituntilsent=True,
+                    maxretries=maxretries,
+                    callback=self._releaseOnReply(token),
+                    **{"async": True}
+                    )
+            finally:
+                if hasattr(data, 'close'):
+                    data.close()
             rec['state'] = 'inserting'
             rec['chkname'] = ChkTargetFilename(name)
     
@@ -839,7 +1222,7 @@ class SiteState:
         # FIXME: for some reason the node no longer gets the URI for these.
         self.node._submitCmd(
             self.manifestCmdId, "ClientPutComplexDir",
-            rawcmd=self.manifestCmdBuf,
+            rawcmd=self.manifestCmd,
             waituntilsent=True,
             keep=True,
             persistence="forever",
@@ -883,8 +1266,8 @@ class SiteState:
                 and self.sitemapRec 
                 and not self.sitemapRec.get("target", "separate") == "manifest"):
                 missing.append(self.sitemap)
-            for rec in self.files:
-                if rec['state'] == 'waiting' and rec['name'] not in jobs:
+            for rec in self.files.inState('waiting'):
+                if rec['name'] not in jobs:
                     missing.append(rec['name'])
     
             if not missing:
@@ -1007,19 +1390,14 @@ class SiteState:
                                     self.name, name))
         
         # now, make sure that all currently inserting files have a job on the queue
-        for rec in self.files:
-            if rec['state'] != 'inserting':
-                continue
+        for rec in self.files.inState('inserting'):
             if rec['name'] not in queuedJobs:
                 self.log(CRITICAL, "insert: node has forgotten job %s" % rec['name'])
                 rec['state'] = 'waiting'
                 self.needToUpdate = True
         
         # check for any uninserted files or manifests
-        stillInserting = False
-        for rec in self.files:
-            if rec['state'] != 'idle':
-                stillInserting = True
+        stillInserting = self.files.count('idle') != len(self.files)
         if needToInsertManifest:
             stillInserting = True
         
@@ -1032,14 +1410,18 @@ class SiteState:
         
     #@-node:managePendingInsert
     #@+node:scan
-    def scan(self):
+    def scan(self, verify=False):
         """
         Scans all files in the site's filesystem directory, marking
         the ones which need updating or new inserting
+        
+        Only files whose size, modification time or inode differ from
+        the last scan are hashed again, unless verify is True.
         """
         log = self.log
         
         structureChanged = False
+        statChanged = False
     
         self.log(INFO, "scan: analysing freesite '%s' for changes..." % self.name)
     
@@ -1055,8 +1437,9 @@ class SiteState:
         # convert records to the format we use
         physFiles = []
         physDict = {}
+        toHash = []
         for f in lst:
-            rec = {}
+            rec = FileRecord()
             try:
                 enc = "utf-8"
                 f['fullpath'].decode(enc)
@@ -1066,13 +1449,29 @@ class SiteState:
             rec['path'] = f['fullpath'].decode(enc)
             rec['name'] = f['relpath'].decode(enc)
             rec['mimetype'] = f['mimetype']
-            rec['hash'] = hashFile(rec['path'])
-            rec['sizebytes'] = getFileSize(rec['path'])
+            st = os.stat(rec['path'])
+            rec['sizebytes'] = st.st_size
+            rec['stat'] = [st.st_size, st.st_mtime_ns, st.st_ino]
             rec['uri'] = ''
             rec['id'] = ''
+            known = self.filesDict.get(rec['name'], None)
+            if (not verify and known is not None and known.get('hash', None)
+                and known.get('stat', None) == rec['stat']):
+                # untouched since we hashed it
+                rec['hash'] = known['hash']
+            else:
+                toHash.append(rec)
             physFiles.append(rec)
             physDict[rec['name']] = rec
     
+        # hash the others, several at a time
+        if toHash:
+            log(DETAIL, "scan: hashing %d files" % len(toHash))
+            with concurrent.futures.ThreadPoolExecutor(self.hashWorkers) as executor:
+                hashes = executor.map(hashFile, [rec['path'] for rec in toHash])
+                for rec, hash in zip(toHash, hashes):
+                    rec['hash'] = hash
+    
         # now, analyse both sets of records, and determine if update is needed
         
         # firstly, purge deleted files
@@ -1084,7 +1483,6 @@ class SiteState:
             if name not in physDict:
                 # file has disappeared, remove it and flag an update
                 log(DETAIL, "scan: file %s has been removed" % name)
-                del self.filesDict[name]
                 self.files.remove(rec)
                 structureChanged = True
             elif rec['state'] in ('changed', 'waiting'):
@@ -1102,9 +1500,8 @@ class SiteState:
                 # new file - add it and flag update
                 log(DETAIL, "scan: file %s has been added" % name)
                 rec['uri'] = ''
-                self.files.append(rec)
                 rec['state'] = 'changed'
-                self.filesDict[name] = rec
+                self.files.append(rec)
                 structureChanged = True
             else:
                 # known file - see if changed
@@ -1121,6 +1518,9 @@ class SiteState:
                 # the size get the physical size.
                 if 'sizebytes' not in knownrec:
                     knownrec['sizebytes'] = rec['sizebytes']
+                if knownrec.get('stat', None) != rec['stat']:
+                    knownrec['stat'] = rec['stat']
+                    statChanged = True
 
     
         # if structure has changed, gotta sort and save
@@ -1130,6 +1530,9 @@ class SiteState:
             self.save()
             self.log(INFO, "scan: site %s has changed" % self.name)
         else:
+            if statChanged:
+                # remember the new times, so we need not hash them again
+                self.save()
             self.log(INFO, "scan: site %s has not changed" % self.name)
     
     #@-node:scan
@@ -1284,20 +1687,15 @@ class SiteState:
                 "<pre>"
                 ])
 
-            for rec in self.files:
-                separate = 'target' in rec and rec['target'] == 'separate'
-                if separate:
-                    try:
-                        uri = rec['uri']
-                    except KeyError:
-                        if 'path' in rec:
-                            raw = open(rec['path'],"rb").read()
-                            uri = self.chkCalcNode.genchk(
-                                data=raw, 
-                                mimetype=rec['mimetype'],
-                                TargetFilename=ChkTargetFilename(rec['name']))
-                            rec['uri'] = uri
-                    lines.append(uri)
+            separate = [rec for rec in self.files
+                        if 'target' in rec and rec['target'] == 'separate']
+            missing = [rec for rec in separate
+                       if 'uri' not in rec and 'path' in rec]
+            for rec, uri in self._chkPipeline(missing):
+                rec['uri'] = uri
+            for rec in separate:
+                if 'uri' in rec:
+                    lines.append(rec['uri'])
             lines.append("</pre></body></html>\n")
             
             self.sitemapRec = {'name': self.sitemap, 'state': 'changed', 'mimetype': 'text/html'}
@@ -1333,7 +1731,7 @@ class SiteState:
             # we do not have a real sitemap file and need to generate it.
             createsitemap()
             # register the sitemap for upload.
-            self.files.append(self.sitemapRec)
+            self.sitemapRec = self.files.append(self.sitemapRec)
         
     
     #@-node:createIndexAndSitemapIfNeeded
@@ -1343,8 +1741,102 @@ class SiteState:
         Allocates a unique ID for a given file
         """
         return "freesitemgr|%s|%s" % (self.name, name)
-    
+
     #@-node:allocId
+    #@+node:_chkPipeline
+    def _chkPipeline(self, recs, reuse=False):
+        """
+        Calculates the CHKs of file records, keeping chkPipelineDepth
+        calculations running on the chkCalcNode
+        
+        Yields (rec, uri) in the order of recs. The files are streamed
+        to the node from disk, so none of them is held in memory. With
+        reuse, records in state 'waiting' keep the CHK an earlier,
+        interrupted run got for them.
+        """
+        depth = max(1, self.chkPipelineDepth)
+        
+        def calc(rec):
+            if reuse and rec['state'] == 'waiting' and rec.get('uri', None):
+                return rec['uri']
+            self.log(INFO, "Pre-computing CHK for file %s" % rec['name'])
+            data = self._openData(rec)
+            try:
+                return self.chkCalcNode.genchk(
+                    data=data,
+                    mimetype=rec['mimetype'],
+                    TargetFilename=ChkTargetFilename(rec['name']))
+            finally:
+                if hasattr(data, 'close'):
+                    data.close()
+        
+        pending = collections.deque()
+        recs = iter(recs)
+        with concurrent.futures.ThreadPoolExecutor(depth) as executor:
+            try:
+                while True:
+                    # keep the next few CHKs calculating
+                    while len(pending) < 2 * depth:
+                        rec = next(recs, None)
+                        if rec is None:
+                            break
+                        pending.append((rec, executor.submit(calc, rec)))
+                    if not pending:
+                        break
+                    rec, future = pending.popleft()
+                    yield rec, future.result()
+            finally:
+                for rec, future in pending:
+                    future.cancel()
+    
+    #@-node:_chkPipeline
+    #@+node:_readData
+    def _readData(self, rec):
+        """
+        Returns the data of a file record, from disk or generated
+        """
+        if 'path' in rec:
+            with open(rec['path'], "rb") as f:
+                return f.read()
+        elif rec['name'] in self.generatedTextData:
+            return self.generatedTextData[rec['name']].encode("utf-8")
+        raise Exception("File %s, has neither path nor generated Text. rec: %s" % (
+            rec['name'], rec))
+    
+    #@-node:_readData
+    #@+node:_openData
+    def _openData(self, rec):
+        """
+        Returns the data of a file record as an open file if it is on
+        disk, so that it can be sent without reading it into memory,
+        or as bytes if it is generated
+        """
+        if 'path' in rec:
+            return open(rec['path'], "rb")
+        return self._readData(rec)
+    
+    #@-node:_openData
+    #@+node:_releaseOnReply
+    def _releaseOnReply(self, token):
+        """
+        Returns a job callback which gives back the room an insert took
+        in the limiter, once the node has answered it
+        """
+        if token is None:
+            return None
+        released = []
+
+        def callback(status, value):
+            if released:
+                return
+            released.append(True)
+            if status == 'failed':
+                value = fcp.FCPPutFailed(value)
+            self.limiter.release(token, value or status)
+
+        return callback
+
+    #@-node:_releaseOnReply
     #@+node:markManifestFiles
     def markManifestFiles(self):
         """
@@ -1355,9 +1847,12 @@ class SiteState:
         Files are selected for the manifest until the manifest reaches 
         maxManifestSizeBytes based on the following rules:
         - index and activelink.png are always included
-        - the first to include are CSS files referenced in the index, smallest first
-        - then follow all other files referenced in the index, smallest first
-        - then follow html files not referenced in the index, smallest first
+        - then follow the files in the order of their link depth from the
+          index, see LinkGraph.depths(): first the files which load
+          with the index, then the pages it links to and what they
+          load, and so on. At each depth CSS files come first, then the
+          other files, smallest first
+        - then follow html files not reachable from the index, smallest first
         - then follow all other files, smallest first
         
         The manifest goes above the max size if that is necessary to avoid having more 
@@ -1395,46 +1890,28 @@ class SiteState:
             maxsize += redirectSize # no redirect needed for this file
         # sort the files by filesize
         recBySize = sorted(self.files, key=lambda rec: rec['sizebytes'])
-        # now we parse the index to see which files are directly
-        # referenced from the index page. These should have precedence
-        # over other files.
-        try:
-            indexText = self.generatedTextData[self.indexRec['name']]
-        except KeyError:
-            try:
-                indexText = io.open(self.indexRec['path'], "r", encoding="utf-8").read()
-            except UnicodeDecodeError:
-                # no unicode file? Let io.open guess.
-                try:
-                    indexText = io.open(self.indexRec['path'], "r").read()
-                except UnicodeDecodeError:
-                    # almost final chance: replace errors.
-                    try:
-                        indexText = io.open(self.indexRec['path'], "r", encoding="utf-8", errors="xmlcharrefreplace").read()
-                    except (TypeError, UnicodeDecodeError):
-                        # truly final chance: just throw out errors. TODO: Use chardet: https://pypi.python.org/pypi/chardet
-                        indexText = io.open(self.indexRec['path'], "r", encoding="utf-8", errors="ignore").read()
-        # now resort the recBySize to have the recs which are
-        # referenced in index first - with additional preference to CSS files.
-        # For files outside the index, prefer html files before others.
-        fileNamesInIndex = set([rec['name'] for rec in recBySize 
-                                if rec['name'] in indexText])
-        fileNamesInIndexCSS = set([rec['name'] for rec in recBySize 
-                                   if rec['name'] in fileNamesInIndex 
-                                   and rec['name'].lower().endswith('.css')])
+        # now we follow the links from the index to see which files a
+        # visitor needs first. These should have precedence over
+        # other files. Only changed html and css files are parsed, the
+        # links of the others are kept in their records.
+        linked = list(self.files)
+        if self.indexRec not in self.files:
+            # a generated index
+            linked.append(self.indexRec)
+        self.linkGraph.update(linked, self._readData, defaultName=self.index)
+        depths = self.linkGraph.depths(self.indexRec['name'])
+        unreachable = max(depths.values()) + 1
+        
+        def priority(rec):
+            name = rec['name'].lower()
+            if rec['name'] in depths:
+                return (depths[rec['name']], not name.endswith('.css'),
+                        rec['sizebytes'])
+            # For files outside the index, prefer html files before others.
+            return (unreachable, not name.endswith('.html'), rec['sizebytes'])
+        
         fileNamesInManifest = set()
-        recByIndexAndSize = []
-        recByIndexAndSize.extend(rec for rec in recBySize 
-                                 if rec['name'] in fileNamesInIndexCSS)
-        recByIndexAndSize.extend(rec for rec in recBySize 
-                                 if rec['name'] in fileNamesInIndex
-                                 and rec['name'] not in fileNamesInIndexCSS)
-        recByIndexAndSize.extend(rec for rec in recBySize 
-                                 if rec['name'] not in fileNamesInIndex
-                                 and rec['name'].lower().endswith(".html"))
-        recByIndexAndSize.extend(rec for rec in recBySize 
-                                 if rec['name'] not in fileNamesInIndex
-                                 and not rec['name'].lower().endswith(".html"))
+        recByIndexAndSize = sorted(self.files, key=priority)
         for rec in recByIndexAndSize:
             if rec is self.indexRec or rec is self.activelinkRec:
                 rec['target'] = 'manifest'
@@ -1465,8 +1942,9 @@ class SiteState:
     #@+node:makeManifest
     def makeManifest(self):
         """
-        Create a site manifest insertion command buffer from our
-        current inventory
+        Create a site manifest insertion command from our current
+        inventory, as segments whose file data is read from disk only
+        while the command is sent, see fcp.node.complexDirCommand()
         """
         # build up a command buffer to insert the manifest
         self.manifestCmdId = self.allocId("__manifest")
@@ -1488,7 +1966,8 @@ class SiteState:
         default = None
         # cache DDA requests to avoid stalling for ages on big sites
         hasDDAtested = {}
-        datatoappend = []
+        # (source, length) of the files sent with the command
+        payloads = []
 
         def fileMsgLines(n, rec):
             if rec.get('target', 'separate') == 'separate':
@@ -1525,11 +2004,13 @@ class SiteState:
             else:
                 if rec['name'] in self.generatedTextData:
                     data = self.generatedTextData[rec['name']].encode("utf-8")
+                    payloads.append((data, len(data)))
+                    rec['sizebytes'] = len(data)
                 else:
-                    data = open(rec['path'], "rb").read()
-                datatoappend.append(data)
-                # update the sizebytes from the data actually read here.
-                rec['sizebytes'] = len(data)
+                    # update the sizebytes from the file as it is now;
+                    # it is read when the command is sent.
+                    rec['sizebytes'] = os.path.getsize(rec['path'])
+                    payloads.append((rec['path'], rec['sizebytes']))
                 return [
                     "Files.%d.Name=%s" % (n, rec['name']),
                     "Files.%d.UploadFrom=direct" % n,
@@ -1575,16 +2056,9 @@ class SiteState:
             # don't forget to up the count
             n += 1
         
-        # finish the command buffer
-        if datatoappend:
-            msgLines.append("Data")
-        else:
-            msgLines.append("EndMessage")
-    
-        # and save
-        self.manifestCmdBuf = b"\n".join(i.encode("utf-8") for i in msgLines) + b"\n"
-        self.manifestCmdBuf += b"".join(datatoappend)
-        datalength = len(b"".join(datatoappend))
+        # finish the command, and save
+        self.manifestCmd = fcp.node.complexDirCommand(msgLines, payloads)
+        datalength = sum(length for source, length in payloads)
         # FIXME: Reports an erroneous Error when no physical index is present.
         reportedlength = sum(rec['sizebytes'] for rec in self.files
                              if rec.get('target', 'separate') == 'manifest'
@@ -0,0 +1,161 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+"""
+SQLite storage for the state of a freesite.
+
+SiteState keeps the state of a site in a pseudo-python file, which
+save() writes anew each time: every file record of the site, for every
+ten inserts or state change. For sites of many thousands of files most
+of the time of an insert then goes to writing the same records again.
+
+With stateBackend='sqlite', SiteState keeps the file records in a
+SiteStore instead. save() then writes only the records which changed
+since the last save, together with the site's own variables, in one
+transaction, so a crash leaves either the old or the new state. The
+pseudo-python file stays, without the file records, so that the site
+is still found and its settings can be read.
+
+The database is a file next to the state file, see storePath().
+"""
+
+import json
+import os
+import sqlite3
+import threading
+
+
+#: the backends SiteState can keep its file records in
+stateBackends = ('file', 'sqlite')
+
+
+def storePath(basedir, name):
+    """
+    Returns the path of the database for the site name, which starts
+    with a dot, so that SiteMgr does not take it for a site
+
+    >>> storePath('/tmp', 'mysite')
+    '/tmp/.mysite.db'
+    """
+    return os.path.join(basedir, ".%s.db" % name)
+
+
+def removeStore(path):
+    """
+    Removes the database at path, with the journal files SQLite keeps
+    next to it
+    """
+    for suffix in ("", "-wal", "-shm"):
+        try:
+            os.unlink(path + suffix)
+        except FileNotFoundError:
+            pass
+
+
+class SiteStore:
+    """
+    The file records and variables of one site, in an SQLite database
+
+    >>> store = SiteStore(":memory:")
+    >>> store.save({'uriPub': 'USK@x/site/0/'},
+    ...            [{'name': 'index.html', 'state': 'idle'},
+    ...             {'name': 'a.png', 'state': 'changed'}])
+    >>> store.save(changed=[{'name': 'a.png', 'state': 'inserting'}],
+    ...            removed=['index.html'])
+    >>> variables, records = store.load()
+    >>> variables, records
+    ({'uriPub': 'USK@x/site/0/'}, [{'name': 'a.png', 'state': 'inserting'}])
+    >>> [rec['name'] for rec in store.filesByState('inserting', 'waiting')]
+    ['a.png']
+    """
+
+    def __init__(self, path):
+        """
+        Opens the database at path, creating it if needed
+        """
+        self.path = path
+        self._lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        with self._lock, self.db:
+            if path != ":memory:":
+                # readers never wait for a save, and a commit needs no
+                # more than one sync
+                self.db.execute("PRAGMA journal_mode=WAL")
+                self.db.execute("PRAGMA synchronous=NORMAL")
+            self.db.execute(
+                "CREATE TABLE IF NOT EXISTS vars "
+                "(name TEXT PRIMARY KEY, value TEXT NOT NULL)")
+            self.db.execute(
+                "CREATE TABLE IF NOT EXISTS files "
+                "(name TEXT PRIMARY KEY, state TEXT, record TEXT NOT NULL)")
+            self.db.execute(
+                "CREATE INDEX IF NOT EXISTS files_state ON files (state)")
+
+
+    def load(self):
+        """
+        Returns a dict of the site's variables, and a list of its file
+        records sorted by name
+        """
+        with self._lock:
+            variables = {name: json.loads(value) for name, value
+                         in self.db.execute("SELECT name, value FROM vars")}
+            records = [json.loads(record) for record, in self.db.execute(
+                "SELECT record FROM files ORDER BY name")]
+        return variables, records
+
+
+    def save(self, variables=None, changed=(), removed=(), replace=False):
+        """
+        Writes in one transaction
+
+        Arguments:
+            - variables - a dict of the site's variables, replacing those
+              stored
+            - changed - file records to write
+            - removed - names of files to delete
+            - replace - if True, delete all files first, so that the
+              store holds just those in changed
+        """
+        encode = json.JSONEncoder().encode
+        with self._lock, self.db:
+            if variables is not None:
+                self.db.execute("DELETE FROM vars")
+                self.db.executemany(
+                    "INSERT INTO vars (name, value) VALUES (?, ?)",
+                    [(name, encode(value)) for name, value in variables.items()])
+            if replace:
+                self.db.execute("DELETE FROM files")
+            self.db.executemany(
+                "DELETE FROM files WHERE name = ?",
+                [(name,) for name in removed])
+            self.db.executemany(
+                "INSERT OR REPLACE INTO files (name, state, record) VALUES (?, ?, ?)",
+                [(rec['name'], rec.get('state', None), encode(rec))
+                 for rec in changed])
+
+
+    def getFile(self, name):
+        """
+        Returns the record of a file, or None
+        """
+        with self._lock:
+            row = self.db.execute(
+                "SELECT record FROM files WHERE name = ?", (name,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+
+    def filesByState(self, *states):
+        """
+        Returns the records of the files in any of the given states
+        """
+        with self._lock:
+            rows = self.db.execute(
+                "SELECT record FROM files WHERE state IN (%s) ORDER BY name"
+                % ", ".join("?" * len(states)), states).fetchall()
+        return [json.loads(record) for record, in rows]
+
+
+    def close(self):
+        with self._lock:
+            self.db.close()
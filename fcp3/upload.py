@@ -185,7 +185,7 @@ def main():
     # try to create the node
     try:
         n = node.FCPNode(host=args.fcpHost, port=args.fcpPort, verbosity=verbosity,
-                        logfile=sys.stderr)
+                        logfile=sys.stderr, gateway=True)
     except:
         if args.verbose:
             traceback.print_exc(file=sys.stderr)
@@ -220,7 +220,8 @@ def main():
             data = data.encode('utf-8')
         else:
             try:
-                data = open(infile, "rb").read()
+                # put() streams the file, so it is never fully in memory
+                data = open(infile, "rb")
             except:
                 n.shutdown()
                 usage("Failed to read input from file %s" % repr(infile))
@@ -259,6 +260,9 @@ def main():
         opts["realtime"] = True
         opts["persistence"] = "connection"
         opts["Global"] = False
+        if hasattr(opts.get("data", None), "seek"):
+            # the insert consumed the file, send it again from the start
+            opts["data"].seek(0)
         freenet_uri = n.put(uri,**opts)
         print(freenet_uri)
 
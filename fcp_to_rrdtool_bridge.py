@@ -73,7 +73,7 @@ if( 0 == len( stat_fields ) and not list_fields_flag ):
   usage();
   sys.exit( 1 );
 
-f = fcp.FCPNode( host = host, port = port );
+f = fcp.FCPNode( host = host, port = port, gateway = True );
 entry = f.refstats( WithVolatile = True );
 f.shutdown();
 if( list_fields_flag ):
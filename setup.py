@@ -16,6 +16,7 @@ if sys.version_info.major <= 2:
 else:
     scripts = ["freesitemgr", "pyNodeConfig",
                "fcpget", "fcpput", "fcpupload", "fcpgenkey", "fcpinvertkey", "fcpredirect", "fcpnames",
+               "fcpgateway",
                "fproxyproxy", "copyweb", "babcom_cli"  # , "freedisk"  # <- not yet reviewed
                ]
 if doze: